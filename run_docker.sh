@@ -6,5 +6,6 @@ docker run --rm \
   --net=host \
   -e DISPLAY=$DISPLAY \
   -v /tmp/.X11-unix:/tmp/.X11-unix \
+  -v "${FOSSILHUNT_DATA:-$PWD/data}":/data \
   --device /dev/dri:/dev/dri \
   fossil-hunt
@@ -0,0 +1,138 @@
+// Live game status of the operator page, pushed by the server on /events.
+// The elapsed time is kept by the browser, from the start time of the game.
+// The stream follows the sandbox of the game shown (the #sandbox-name text).
+
+(function () {
+    var startedAt = null;
+    var reveals = [];
+    var sandbox = null;
+    var events = null;
+
+    function setText(id, text) {
+        var element = document.getElementById(id);
+        if (element) {
+            element.textContent = text;
+        }
+    }
+
+    function setLines(id, lines) {
+        var element = document.getElementById(id);
+        if (!element) {
+            return;
+        }
+        element.replaceChildren.apply(
+            element,
+            lines.map(function (line) {
+                var div = document.createElement("div");
+                div.textContent = line;
+                return div;
+            })
+        );
+    }
+
+    function formatDuration(seconds) {
+        var h = Math.floor(seconds / 3600);
+        var m = Math.floor((seconds % 3600) / 60);
+        var s = seconds % 60;
+        return h + ":" + String(m).padStart(2, "0") + ":" + String(s).padStart(2, "0");
+    }
+
+    function currentSandbox() {
+        var element = document.getElementById("sandbox-name");
+        return element ? element.textContent : "";
+    }
+
+    function sandboxQuery() {
+        return "?sandbox=" + encodeURIComponent(sandbox);
+    }
+
+    function tick() {
+        if (currentSandbox() !== sandbox) {
+            connect();
+        }
+        if (startedAt !== null) {
+            var elapsed = Math.max(0, Math.floor(Date.now() / 1000 - startedAt));
+            setText("time-elapsed", "Temps écoulé : " + formatDuration(elapsed));
+        }
+    }
+
+    function showCount(data) {
+        setText(
+            "reveal-count",
+            "Fossiles découverts : " + data.seen_bones + "/" + data.fossils
+        );
+    }
+
+    function connect() {
+        if (events !== null) {
+            events.close();
+        }
+        sandbox = currentSandbox();
+        startedAt = null;
+        reveals = [];
+        setLines("reveal-log", reveals);
+        events = new EventSource("/events" + sandboxQuery());
+        listen(events);
+        var preview = document.getElementById("preview");
+        if (preview && preview.style.display !== "none") {
+            preview.src = "/preview.mjpg" + sandboxQuery();
+        }
+    }
+
+    function listen(events) {
+        events.addEventListener("state", function (event) {
+            var state = JSON.parse(event.data);
+            if (state.started_at !== startedAt) {
+                reveals = [];
+                setLines("reveal-log", reveals);
+            }
+            startedAt = state.running ? state.started_at : null;
+            tick();
+        });
+
+        events.addEventListener("reveal", function (event) {
+            var reveal = JSON.parse(event.data);
+            var time = new Date().toLocaleTimeString();
+            reveals.unshift(time + " : " + reveal.name + " découvert");
+            setLines("reveal-log", reveals.slice(0, 10));
+            showCount(reveal);
+        });
+
+        events.addEventListener("progress", function (event) {
+            showCount(JSON.parse(event.data));
+        });
+
+        events.addEventListener("perf", function (event) {
+            var perf = JSON.parse(event.data);
+            setLines("perf-panel", [
+                "Images/s : " + perf.display_fps + " affichées, " +
+                    perf.capture_fps + " captées",
+                "Temps de calcul : " + perf.total_p50_ms + " ms (p95 " +
+                    perf.total_p95_ms + " ms), gigue " + perf.jitter_ms + " ms",
+                "Images perdues : " + perf.dropped_capture + " en capture, " +
+                    perf.dropped_display + " à l'affichage",
+                "Qualité : " + perf.quality + (perf.quality_pinned ? " (fixée)" : " (auto)"),
+            ]);
+        });
+    }
+
+    // The preview stream only runs while it is shown
+    document.addEventListener("click", function (event) {
+        if (!event.target || event.target.id !== "preview-button") {
+            return;
+        }
+        var preview = document.getElementById("preview");
+        if (preview.style.display === "none") {
+            preview.src = "/preview.mjpg" + sandboxQuery();
+            preview.style.display = "block";
+            event.target.textContent = "Masquer l'aperçu";
+        } else {
+            preview.removeAttribute("src");
+            preview.style.display = "none";
+            event.target.textContent = "Afficher l'aperçu";
+        }
+    });
+
+    connect();
+    setInterval(tick, 1000);
+})();
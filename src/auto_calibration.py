@@ -0,0 +1,190 @@
+from typing import Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# Raw 11 bit Kinect depth: 2047 marks pixels without a measure. The raw value
+# is affine in 1/z, so a plane in space is still a plane in (x, y, raw).
+_INVALID_DEPTH = 2047
+# Pixels must have a measure in this share of the averaged frames
+_MIN_VALID_SHARE = 0.5
+# Sampling step of the plane fit, in pixels
+_FIT_STEP = 4
+_RANSAC_HYPOTHESES = 256
+# Largest distance to the floor plane of a floor pixel, in raw depth units
+_PLANE_TOLERANCE = 8.0
+# Depth step between neighbours that breaks the floor, in raw depth units
+_EDGE_STEP = 6.0
+# The floor must cover this share of the frame
+_MIN_FLOOR_SHARE = 0.05
+
+
+def average_depth(
+    frames: Sequence[np.array], invalid: int = _INVALID_DEPTH
+) -> Tuple[np.array, np.array]:
+    """
+    Average depth frames, ignoring the pixels without a measure
+
+    Args
+    ----
+    frames: Sequence[np.array]
+        raw depth frames of the same shape
+    invalid: int (OPTIONAL)
+        depth value of the pixels without a measure (0 is always invalid)
+
+    Returns
+    -------
+    tuple[np.array, np.array]
+        float32 mean depth, and the mask of the pixels measured in enough frames
+    """
+    total = np.zeros(frames[0].shape, dtype=np.float32)
+    count = np.zeros(frames[0].shape, dtype=np.float32)
+    for frame in frames:
+        valid = (frame > 0) & (frame < invalid)
+        np.add(total, frame, out=total, where=valid)
+        count += valid
+    valid = count >= _MIN_VALID_SHARE * len(frames)
+    mean = np.divide(total, count, out=np.zeros_like(total), where=valid)
+    return mean, valid
+
+
+def fit_plane(
+    depth: np.array,
+    valid: np.array,
+    tolerance: float = _PLANE_TOLERANCE,
+    hypotheses: int = _RANSAC_HYPOTHESES,
+    seed: int = 0,
+) -> np.array:
+    """
+    Fit the dominant plane depth = a * x + b * y + c, RANSAC style
+
+    Every hypothesis is drawn and scored at once on a sparse grid of pixels,
+    then the best one is refined by least squares on its inliers.
+
+    Args
+    ----
+    depth: np.array
+        mean depth frame
+    valid: np.array
+        mask of the pixels with a measure
+    tolerance: float (OPTIONAL)
+        largest distance to the plane of an inlier, in depth units
+    hypotheses: int (OPTIONAL)
+        number of planes drawn
+    seed: int (OPTIONAL)
+        seed of the draws, so a calibration can be reproduced
+
+    Returns
+    -------
+    np.array
+        (a, b, c) coefficients of the plane
+    """
+    ys, xs = np.nonzero(valid[::_FIT_STEP, ::_FIT_STEP])
+    if xs.size < 3:
+        raise ValueError("Not enough depth measures to fit the floor")
+    ys *= _FIT_STEP
+    xs *= _FIT_STEP
+    points = np.column_stack([xs, ys, np.ones_like(xs)]).astype(np.float64)
+    z = depth[ys, xs].astype(np.float64)
+
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, xs.size, size=(hypotheses, 3))
+    systems = points[samples]
+    # Degenerate (collinear) draws get a zero determinant and are dropped
+    usable = np.abs(np.linalg.det(systems)) > 1e-6
+    if not usable.any():
+        raise ValueError("Depth measures are degenerate, cannot fit the floor")
+    planes = np.linalg.solve(systems[usable], z[samples[usable]][..., None])[..., 0]
+
+    inliers = np.abs(points @ planes.T - z[:, None]) < tolerance
+    best = inliers[:, np.argmax(inliers.sum(axis=0))]
+    plane, *_ = np.linalg.lstsq(points[best], z[best], rcond=None)
+    return plane
+
+
+def _order_corners(corners: np.array) -> np.array:
+    # Top-left, top-right, bottom-right, bottom-left, as the controls
+    total = corners.sum(axis=1)
+    diff = corners[:, 1] - corners[:, 0]
+    return np.array(
+        [
+            corners[np.argmin(total)],
+            corners[np.argmin(diff)],
+            corners[np.argmax(total)],
+            corners[np.argmax(diff)],
+        ],
+        dtype=np.float32,
+    )
+
+
+def detect_corners(
+    frames: Sequence[np.array],
+    invalid: int = _INVALID_DEPTH,
+    tolerance: float = _PLANE_TOLERANCE,
+    edge_step: float = _EDGE_STEP,
+) -> np.array:
+    """
+    Find the corners of the sandbox in depth frames
+
+    The sand surface is the dominant plane of the averaged frames. Its pixels
+    are cut along the depth discontinuities (the rim of the box), and the
+    largest remaining region is approximated by a quadrilateral.
+
+    Args
+    ----
+    frames: Sequence[np.array]
+        raw depth frames of the empty, levelled sandbox
+    invalid: int (OPTIONAL)
+        depth value of the pixels without a measure
+    tolerance: float (OPTIONAL)
+        largest distance to the floor plane of a floor pixel, in depth units
+    edge_step: float (OPTIONAL)
+        depth step between neighbours that marks the rim, in depth units
+
+    Returns
+    -------
+    np.array
+        (4, 2) float32 corners, clockwise from the top-left one, in pixels
+    """
+    depth, valid = average_depth(frames, invalid)
+    a, b, c = fit_plane(depth, valid, tolerance)
+
+    height, width = depth.shape
+    xs = np.arange(width, dtype=np.float32)
+    ys = np.arange(height, dtype=np.float32)[:, None]
+    floor = valid & (np.abs(depth - (a * xs + b * ys + c)) < tolerance)
+
+    # Neighbours across the rim are both cut, whichever side they lie on
+    edges = np.zeros_like(floor)
+    step_x = np.abs(np.diff(depth, axis=1)) > edge_step
+    step_y = np.abs(np.diff(depth, axis=0)) > edge_step
+    edges[:, 1:] |= step_x
+    edges[:, :-1] |= step_x
+    edges[1:] |= step_y
+    edges[:-1] |= step_y
+    floor &= ~edges
+
+    floor = cv2.morphologyEx(
+        floor.view(np.uint8), cv2.MORPH_OPEN, np.ones((5, 5), np.uint8)
+    )
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(floor, connectivity=4)
+    if count < 2:
+        raise ValueError("No floor found in the depth frames")
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    if stats[largest, cv2.CC_STAT_AREA] < _MIN_FLOOR_SHARE * depth.size:
+        raise ValueError("The floor found is too small to be the sandbox")
+
+    contours, _ = cv2.findContours(
+        (labels == largest).view(np.uint8),
+        cv2.RETR_EXTERNAL,
+        cv2.CHAIN_APPROX_SIMPLE,
+    )
+    hull = cv2.convexHull(max(contours, key=cv2.contourArea))
+    perimeter = cv2.arcLength(hull, True)
+    for share in (0.01, 0.02, 0.04, 0.08):
+        quad = cv2.approxPolyDP(hull, share * perimeter, True)
+        if len(quad) == 4:
+            break
+    else:
+        quad = cv2.boxPoints(cv2.minAreaRect(hull))
+    return _order_corners(quad.reshape(4, 2).astype(np.float32))
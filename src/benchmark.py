@@ -0,0 +1,299 @@
+"""Headless benchmark of the per-frame pipeline of Game.
+
+Feeds deterministic synthetic depth frames through the same stage methods the
+processing thread uses, for the shipped scenes and for synthetic scenes of
+many fossils, and reports latency percentiles and throughput per stage.
+
+    python benchmark.py --output bench_results.json
+
+The process exits with status 1 when a budget of the budgets file is
+exceeded.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+import cv2
+import numpy as np
+from screeninfo import Monitor
+
+from frame_source import SyntheticSource
+from game import Game
+from init_ressources import Fossil
+
+_SHIPPED_SCENES = ["test", "trilobites", "allosaurus", "camarosaurs-lentus"]
+_SYNTHETIC_SIZES = [10, 50, 100, 200]
+_STAGES = [
+    "capture",
+    "warp",
+    "filter",
+    "mask",
+    "composite",
+    "count",
+    "present",
+    "imshow",
+    "total",
+]
+
+
+def synthetic_fossils(count: int, seed: int = 0) -> List[Fossil]:
+    """
+    Generate fossils with random elliptic textures and opaque masks
+
+    Args
+    ----
+    count: int
+        number of fossils
+    seed: int (OPTIONAL)
+        seed of the shapes, colors and depths
+
+    Returns
+    -------
+    list[Fossil]
+        the unplaced fossils
+    """
+    rng = np.random.default_rng(seed)
+    fossils = []
+    for i in range(count):
+        h, w = rng.integers(12, 40, size=2)
+        texture = np.zeros((h, w, 3), dtype=np.uint8)
+        mask = np.zeros((h, w), dtype=np.uint8)
+        color = [int(c) for c in rng.integers(40, 256, size=3)]
+        axes = (w // 2 - 1, h // 2 - 1)
+        cv2.ellipse(texture, (w // 2, h // 2), axes, 0, 0, 360, color, -1)
+        cv2.ellipse(mask, (w // 2, h // 2), axes, 0, 0, 360, 1, -1)
+        fossils.append(
+            Fossil(
+                name=f"synthetic {i}",
+                texture=texture,
+                mask=mask.view(bool),
+                depth=float(rng.random()),
+                x=-1,
+                y=-1,
+            )
+        )
+    return fossils
+
+
+def _percentiles(samples: np.array) -> Dict[str, float]:
+    ms = samples / 1e6
+    mean = float(ms.mean())
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": mean,
+        "fps": 1000 / mean if mean > 0 else float("inf"),
+    }
+
+
+def _run_frame(game: Game, data: np.array, times: Dict[str, list], show: bool):
+    """Run one frame through the stages, recording their times in ns"""
+    t = [time.perf_counter_ns()]
+    game._depth_callback(data, 0)
+    data = game._depth_slot.get()
+    t.append(time.perf_counter_ns())
+    data = game._warp(data)
+    t.append(time.perf_counter_ns())
+    depth_img = game._filter(data)
+    t.append(time.perf_counter_ns())
+    mask = game._reveal_mask(depth_img)
+    t.append(time.perf_counter_ns())
+    image = game._composite(mask)
+    t.append(time.perf_counter_ns())
+    game._count(mask)
+    t.append(time.perf_counter_ns())
+    image = game._present(image)
+    t.append(time.perf_counter_ns())
+    if show:
+        cv2.imshow("Benchmark", image)
+        cv2.waitKey(1)
+    t.append(time.perf_counter_ns())
+    if times is not None:
+        for i, stage in enumerate(_STAGES[:-1]):
+            times[stage].append(t[i + 1] - t[i])
+        times["total"].append(t[-1] - t[0])
+
+
+def bench_scene(game: Game, args) -> dict:
+    """
+    Benchmark the scene currently loaded in the game
+
+    Returns
+    -------
+    dict
+        stage statistics and allocation peak of the scene
+    """
+    source = SyntheticSource(fps=0, seed=args.seed)
+    game.depth_filter.reset()
+    for _ in range(args.warmup):
+        _run_frame(game, source.next_frame(), None, args.display)
+
+    times = {stage: [] for stage in _STAGES}
+    for _ in range(args.frames):
+        _run_frame(game, source.next_frame(), times, args.display)
+
+    # Allocations are measured apart, tracemalloc slows everything down
+    frames = [source.next_frame().copy() for _ in range(args.alloc_frames)]
+    tracemalloc.start()
+    alloc_peak = 0
+    for frame in frames:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        _run_frame(game, frame, None, args.display)
+        alloc_peak = max(alloc_peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return {
+        "fossils": len(game.fossils),
+        "placed": sum(f.bbox is not None for f in game.fossils),
+        "layers": game.scene.layers,
+        "seen_bones": game.seen_bones,
+        "stages": {
+            stage: _percentiles(np.array(samples, dtype=np.float64))
+            for stage, samples in times.items()
+        },
+        "alloc_peak_bytes": int(alloc_peak),
+    }
+
+
+def check_budgets(results: dict, budgets: dict) -> List[str]:
+    """
+    Compare the results with the budgets
+
+    The budgets file has the form
+        {
+            "stages": {"<stage>": {"p95_ms": float, ...}, ...},
+            "alloc_peak_bytes": int,
+            "scenes": {"<scene>": {<same keys, overriding the defaults>}}
+        }
+
+    Returns
+    -------
+    list[str]
+        a description of every exceeded budget
+    """
+    violations = []
+    for scene, result in results.items():
+        override = budgets.get("scenes", {}).get(scene, {})
+        stages = {**budgets.get("stages", {}), **override.get("stages", {})}
+        for stage, limits in stages.items():
+            for key, limit in limits.items():
+                value = result["stages"][stage][key]
+                if value > limit:
+                    violations.append(f"{scene}: {stage} {key} = {value:.3f} > {limit}")
+        alloc_limit = override.get("alloc_peak_bytes", budgets.get("alloc_peak_bytes"))
+        if alloc_limit is not None and result["alloc_peak_bytes"] > alloc_limit:
+            violations.append(
+                f"{scene}: alloc_peak_bytes = {result['alloc_peak_bytes']}"
+                f" > {alloc_limit}"
+            )
+    return violations
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", nargs="*", default=_SHIPPED_SCENES)
+    parser.add_argument("--synthetic", nargs="*", type=int, default=_SYNTHETIC_SIZES)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--alloc-frames", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--remap-mode", choices=["depth", "frame"], default="depth")
+    parser.add_argument("--projector", default="1920x1080")
+    parser.add_argument("--display", action="store_true", help="include imshow")
+    parser.add_argument(
+        "--quality", default="high", help="quality level, auto to let it adapt"
+    )
+    parser.add_argument(
+        "--process-scale", type=float, default=1.0, help="depth processing scale"
+    )
+    parser.add_argument(
+        "--full-redraw", action="store_true", help="disable incremental rendering"
+    )
+    parser.add_argument(
+        "--kernel", default="auto", help="reveal kernels: auto, compiled or numpy"
+    )
+    parser.add_argument(
+        "--raw-depth", action="store_true", help="compare the unfiltered mm depth"
+    )
+    parser.add_argument(
+        "--layers", type=int, default=3, help="most fossils stacked over a pixel"
+    )
+    parser.add_argument("--budgets", default="benchmark_budgets.json")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    width, height = (int(v) for v in args.projector.split("x"))
+    game = Game(
+        [],
+        source=SyntheticSource(fps=0),
+        projector=Monitor(x=0, y=0, width=width, height=height),
+        display=False,
+        remap_mode=args.remap_mode,
+        quality=args.quality,
+        incremental=not args.full_redraw,
+        process_scale=args.process_scale,
+        smoothing=not args.raw_depth,
+        kernel=args.kernel,
+        layers=args.layers,
+    )
+
+    results = {}
+    for scene in args.scenes:
+        with open(f"assets/configs/{scene}/config.json", "r") as f:
+            fossils_dict = json.load(f)
+        game._init_ressources(fossils_dict, seed=args.seed)
+        results[scene] = bench_scene(game, args)
+    for count in args.synthetic:
+        game._init_scene(synthetic_fossils(count, seed=args.seed), seed=args.seed)
+        results[f"synthetic-{count}"] = bench_scene(game, args)
+
+    budgets = {}
+    if args.budgets:
+        with open(args.budgets, "r") as f:
+            budgets = json.load(f)
+    violations = check_budgets(results, budgets)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "frames": args.frames,
+            "remap_mode": args.remap_mode,
+            "quality": args.quality,
+            "incremental": not args.full_redraw,
+            "process_scale": args.process_scale,
+            "smoothing": not args.raw_depth,
+            "kernel": game.kernel,
+            "layers": args.layers,
+            "projector": args.projector,
+        },
+        "scenes": results,
+        "violations": violations,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for scene, result in results.items():
+        total = result["stages"]["total"]
+        print(
+            f"{scene:>20}: placed {result['placed']:>3}/{result['fossils']:<3}"
+            f" p50 {total['p50_ms']:6.2f} ms  p95 {total['p95_ms']:6.2f} ms"
+            f"  p99 {total['p99_ms']:6.2f} ms  {total['fps']:7.1f} fps"
+            f"  alloc {result['alloc_peak_bytes']} B"
+        )
+    for violation in violations:
+        print("Budget exceeded:", violation)
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""Baked scenes: placed and stacked fossils saved as memory-mapped arrays.
+
+Starting a scene from its config decodes, rotates and places every texture
+before the first frame. Baking does it once and saves the result (the arrays
+of SceneLayers and the fossil metadata) in a bundle directory, which
+Game._init_ressources memory-maps whenever it starts the same config again:
+
+    python bundles.py trilobites allosaurus
+
+A bundle is looked up by the content of the config and the scene parameters,
+and is only used while the images it was baked from are unchanged.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import HEIGHT, LAYERS, WIDTH
+from init_ressources import (
+    Fossil,
+    SceneLayers,
+    _opaque_mask,
+    create_layers,
+    load_objects_texture,
+)
+from storage import atomic_save
+from texture_cache import file_hash
+
+# Where the bundles are saved, one directory per bundle
+_BUNDLES_DIR = os.environ.get("FOSSILHUNT_BUNDLES_DIR", "bundles")
+# Bumped whenever the layout of a bundle or the placement changes
+_BUNDLE_VERSION = 1
+# Arrays of a bundle, as <name>.npy: the SceneLayers fields, the expanded
+# images, and the opaque texels of the palette (the masks of the fossils)
+_ARRAYS = ("background", "z", "ids", "texels", "palette", "images", "opaque")
+_CONFIGS_DIR = "assets/configs"
+
+
+def _config_hash(fossils_dict: List[Dict]) -> str:
+    description = json.dumps(fossils_dict, sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def bundle_key(
+    fossils_dict: List[Dict], size: Tuple[int, int], layers: int, seed: int = None
+) -> str:
+    """
+    Name of the bundle of a scene
+
+    Args
+    ----
+    fossils_dict: list[dict]
+        the scene, as in the config files
+    size: tuple[int, int]
+        (width, height) of the sand box, in pixels
+    layers: int
+        most fossils stacked over a pixel
+    seed: int (OPTIONAL)
+        seed of the placement, None for the random placement of a game
+
+    Returns
+    -------
+    str
+        a key that changes whenever the config or a parameter changes
+    """
+    description = json.dumps(
+        {
+            "config": _config_hash(fossils_dict),
+            "size": list(size),
+            "layers": layers,
+            "seed": seed,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:16]
+
+
+def _bundle_path(key: str, bundles_dir: str = None) -> str:
+    return os.path.join(bundles_dir or _BUNDLES_DIR, key)
+
+
+def _image_state(path: str) -> dict:
+    stat = os.stat(path)
+    return {"sha1": file_hash(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _stale_image(path: str, state: dict) -> bool:
+    if not os.path.exists(path):
+        return True
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) == (state["size"], state["mtime_ns"]):
+        return False
+    # Touched, or copied with a new date: only a new content makes it stale
+    return file_hash(path) != state["sha1"]
+
+
+def bake_scene(
+    fossils_dict: List[Dict],
+    size: Tuple[int, int],
+    layers: int,
+    name: str = None,
+    seed: int = None,
+    bundles_dir: str = None,
+) -> str:
+    """
+    Place the fossils of a scene and save the result as a bundle
+
+    Args
+    ----
+    fossils_dict: list[dict]
+        the scene, as in the config files
+    size: tuple[int, int]
+        (width, height) of the sand box, in pixels
+    layers: int
+        most fossils stacked over a pixel
+    name: str (OPTIONAL)
+        name of the scene, older bundles of the same name are removed
+    seed: int (OPTIONAL)
+        seed of the placement, None for a random one, then frozen in the bundle
+    bundles_dir: str (OPTIONAL)
+        directory of the bundles
+
+    Returns
+    -------
+    str
+        directory of the bundle
+    """
+    key = bundle_key(fossils_dict, size, layers, seed)
+    fossils = load_objects_texture(fossils_dict, rng=np.random.default_rng(seed))
+    scene = create_layers(
+        fossils, sdbx_width=size[0], sdbx_height=size[1], layers=layers, seed=seed
+    )
+    opaque = np.concatenate(
+        [np.ones(scene.background.shape[:2], dtype=bool).ravel()]
+        + [_opaque_mask(f).ravel() for f in fossils]
+    )
+    arrays = {
+        "background": scene.background,
+        "z": scene.z,
+        "ids": scene.ids,
+        "texels": scene.texels,
+        "palette": scene.palette,
+        "images": scene.images(),
+        "opaque": opaque,
+    }
+
+    path = _bundle_path(key, bundles_dir)
+    os.makedirs(path, exist_ok=True)
+    for array_name, array in arrays.items():
+        atomic_save(
+            os.path.join(path, f"{array_name}.npy"),
+            lambda f: np.save(f, np.ascontiguousarray(array)),
+        )
+    description = {
+        "version": _BUNDLE_VERSION,
+        "baked_at": time.time(),
+        "name": name,
+        "config": _config_hash(fossils_dict),
+        "size": list(size),
+        "layers": layers,
+        "seed": seed,
+        "images": {
+            image: _image_state(image)
+            for image in sorted({fossil["path"] for fossil in fossils_dict})
+        },
+        "fossils": [
+            {
+                "name": f.name,
+                "depth": f.depth,
+                "x": f.x,
+                "y": f.y,
+                "area": f.area,
+                "bbox": f.bbox,
+                "shape": list(f.texture.shape[:2]),
+            }
+            for f in fossils
+        ],
+    }
+    # Saved last: it is what marks the directory as a complete bundle
+    atomic_save(
+        os.path.join(path, "bundle.json"),
+        lambda f: f.write(json.dumps(description, indent=2).encode("utf-8")),
+    )
+    if name is not None:
+        for other in list_bundles(bundles_dir):
+            if other["name"] == name and other["key"] != key:
+                shutil.rmtree(_bundle_path(other["key"], bundles_dir))
+    return path
+
+
+def load_bundle(
+    fossils_dict: List[Dict],
+    size: Tuple[int, int],
+    layers: int,
+    seed: int = None,
+    bundles_dir: str = None,
+) -> Optional[Tuple[List[Fossil], SceneLayers]]:
+    """
+    Load the baked scene of a config, memory-mapped
+
+    Args
+    ----
+    fossils_dict: list[dict]
+        the scene, as in the config files
+    size: tuple[int, int]
+        (width, height) of the sand box, in pixels
+    layers: int
+        most fossils stacked over a pixel
+    seed: int (OPTIONAL)
+        seed of the placement, see bake_scene
+    bundles_dir: str (OPTIONAL)
+        directory of the bundles
+
+    Returns
+    -------
+    tuple[list[Fossil], SceneLayers]
+        the placed fossils and the scene, None if the scene was never baked or
+        its bundle is stale
+    """
+    path = _bundle_path(bundle_key(fossils_dict, size, layers, seed), bundles_dir)
+    try:
+        with open(os.path.join(path, "bundle.json"), "r") as f:
+            description = json.load(f)
+    except FileNotFoundError:
+        return None
+    if description.get("version") != _BUNDLE_VERSION:
+        print(f"Bundle {path} has an older version: bake the scene again")
+        return None
+    if description["config"] != _config_hash(fossils_dict):
+        return None
+    stale = [
+        image
+        for image, state in description["images"].items()
+        if _stale_image(image, state)
+    ]
+    if stale:
+        print(f"Bundle {path} is stale ({', '.join(stale)}): bake the scene again")
+        return None
+
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in _ARRAYS
+    }
+    palette, opaque = arrays["palette"], arrays["opaque"]
+    fossils = []
+    # Textures are views of the palette, where they follow the background
+    start = arrays["background"].shape[0] * arrays["background"].shape[1]
+    for metadata in description["fossils"]:
+        h, w = metadata["shape"]
+        texels = slice(start, start + h * w)
+        start += h * w
+        f = Fossil(
+            name=metadata["name"],
+            texture=palette[texels].reshape(h, w, 3),
+            depth=metadata["depth"],
+            x=metadata["x"],
+            y=metadata["y"],
+            mask=opaque[texels].reshape(h, w),
+        )
+        f.area = metadata["area"]
+        f.bbox = tuple(metadata["bbox"]) if metadata["bbox"] is not None else None
+        fossils.append(f)
+    scene = SceneLayers(
+        arrays["background"],
+        arrays["z"],
+        arrays["ids"],
+        arrays["texels"],
+        palette,
+        images=arrays["images"],
+    )
+    return fossils, scene
+
+
+def list_bundles(bundles_dir: str = None) -> List[dict]:
+    """Key, name and bake time of the saved bundles"""
+    root = bundles_dir or _BUNDLES_DIR
+    if not os.path.isdir(root):
+        return []
+    bundles = []
+    for key in sorted(os.listdir(root)):
+        try:
+            with open(os.path.join(root, key, "bundle.json"), "r") as f:
+                description = json.load(f)
+        except FileNotFoundError:
+            continue
+        bundles.append(
+            {
+                "key": key,
+                "name": description.get("name"),
+                "baked_at": description.get("baked_at"),
+            }
+        )
+    return bundles
+
+
+def config_path(scene: str) -> str:
+    """Config file of a scene, given by name (a directory of assets/configs) or path"""
+    if os.path.exists(scene):
+        return scene
+    return os.path.join(_CONFIGS_DIR, scene, "config.json")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenes", nargs="+", help="scene names or config files")
+    parser.add_argument("--layers", type=int, default=LAYERS)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--bundles-dir", default=None)
+    args = parser.parse_args(argv)
+
+    for scene in args.scenes:
+        with open(config_path(scene), "r") as f:
+            fossils_dict = json.load(f)
+        start = time.perf_counter()
+        path = bake_scene(
+            fossils_dict,
+            (WIDTH, HEIGHT),
+            args.layers,
+            name=scene,
+            seed=args.seed,
+            bundles_dir=args.bundles_dir,
+        )
+        print(f"{scene}: baked in {time.perf_counter() - start:.2f} s, {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
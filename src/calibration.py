@@ -1,23 +1,39 @@
 import sys
+import threading
 
 import cv2
-import freenect
 import numpy as np
 from PyQt6.QtCore import QRectF, Qt, QTimer
-from PyQt6.QtGui import QBrush, QImage, QPixmap
+from PyQt6.QtGui import QBrush, QImage, QPainter, QPixmap
 from PyQt6.QtWidgets import (
     QApplication,
     QGraphicsItem,
-    QGraphicsPixmapItem,
     QGraphicsRectItem,
     QGraphicsScene,
     QGraphicsView,
     QHBoxLayout,
     QMainWindow,
+    QPushButton,
+    QVBoxLayout,
     QWidget,
 )
 
+try:
+    import freenect
+except ImportError:  # Lets the game run on recorded streams without libfreenect
+    freenect = None
+
+from auto_calibration import detect_corners
+from pipeline import FrameSlot
+from projection import RemapTable
+
 _H = None
+_FRAME_SIZE = (640, 480)
+_SANDBOX_CORNERS = [(0, 0), (640, 0), (640, 480), (0, 480)]
+# How often the GUI looks for a new frame, in ms (the Kinect runs at 30 fps)
+_POLL_INTERVAL = 10
+# Depth frames averaged by the automatic calibration
+_AUTO_FRAMES = 10
 
 
 class QControl(QGraphicsRectItem):
@@ -33,17 +49,81 @@ class QControl(QGraphicsRectItem):
 
     def itemChange(self, change, value):
         if change == QGraphicsItem.GraphicsItemChange.ItemPositionHasChanged:
-            self.parent.recompute_homography()
+            # Coalesced: the homography is recomputed once per displayed frame
+            self.parent.homography_dirty = True
         return super().itemChange(change, value)
 
 
+class FrameItem(QGraphicsItem):
+    def __init__(self, width, height):
+        """Scene item showing a video frame through a single pixmap
+
+        QGraphicsPixmapItem.setPixmap takes a new pixmap per frame; this item
+        owns its pixmap, so frames are painted into it without a detach or
+        an allocation.
+
+        Args
+        ----
+        width: int
+            width of the frames
+        height: int
+            height of the frames
+        """
+        super().__init__()
+        self.pixmap = QPixmap(width, height)
+        self.pixmap.fill(Qt.GlobalColor.black)
+
+    def boundingRect(self):
+        return QRectF(self.pixmap.rect())
+
+    def paint(self, painter, option, widget=None):
+        painter.drawPixmap(0, 0, self.pixmap)
+
+    def draw(self, image):
+        """Copy a frame into the pixmap and schedule a repaint"""
+        painter = QPainter(self.pixmap)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        self.update()
+
+
+class CaptureThread(threading.Thread):
+    def __init__(self, device=0):
+        """Grab Kinect video and depth frames away from the GUI thread
+
+        The blocking freenect sync calls return new arrays, so each pair is
+        handed over as is: the slot only ever keeps the newest one.
+
+        Args
+        ----
+        device: int (OPTIONAL)
+            index of the Kinect
+        """
+        super().__init__(name="calibration-capture", daemon=True)
+        self.slot = FrameSlot("calibration")
+        self.device = device
+        self.running = True
+
+    def run(self):
+        while self.running:
+            video = freenect.sync_get_video(self.device)
+            depth = freenect.sync_get_depth(self.device)
+            if video is None or depth is None:
+                continue
+            self.slot.put((video[0], depth[0]))
+
+    def stop(self):
+        self.running = False
+        self.slot.close()
+
+
 class QCalibrationApp(QMainWindow):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, device=0):
         super().__init__(parent)
 
-        self.rgb_item = QGraphicsPixmapItem()
-        self.unwrapped_item = QGraphicsPixmapItem()
-        self.depth_item = QGraphicsPixmapItem()
+        self.rgb_item = FrameItem(*_FRAME_SIZE)
+        self.unwrapped_item = FrameItem(*_FRAME_SIZE)
+        self.depth_item = FrameItem(*_FRAME_SIZE)
 
         self.lview = QGraphicsView()
         self.cview = QGraphicsView()
@@ -52,12 +132,13 @@ class QCalibrationApp(QMainWindow):
         self.cscene = QGraphicsScene()
         self.rscene = QGraphicsScene()
 
-        self.controls = [
-            QControl(self, 0, 0),
-            QControl(self, 630, 0),
-            QControl(self, 630, 470),
-            QControl(self, 0, 470),
-        ]
+        corners = [(0, 0), (630, 0), (630, 470), (0, 470)]
+        if _H is not None:
+            # Start from the current calibration (a loaded profile)
+            sandbox = np.array(_SANDBOX_CORNERS, dtype=np.float32).reshape(-1, 1, 2)
+            corners = cv2.perspectiveTransform(sandbox, np.linalg.inv(_H))
+            corners = [(float(x), float(y)) for x, y in corners.reshape(-1, 2)]
+        self.controls = [QControl(self, x, y) for x, y in corners]
 
         self.lscene.addItem(self.rgb_item)
         for control in self.controls:
@@ -72,49 +153,112 @@ class QCalibrationApp(QMainWindow):
         self.lview.setMinimumSize(640, 480)
         self.cview.setMinimumSize(640, 480)
         self.rview.setMinimumSize(640, 480)
+        rect = QRectF(0, 0, *_FRAME_SIZE)
+        for scene in (self.lscene, self.cscene, self.rscene):
+            scene.setSceneRect(rect)
+
+        # Display buffers, written in place every frame, and the QImages
+        # wrapping them
+        width, height = _FRAME_SIZE
+        self.rgb = np.zeros((height, width, 3), dtype=np.uint8)
+        self.unwrapped = np.zeros_like(self.rgb)
+        self.depth_rgb = np.zeros_like(self.rgb)
+        self.depth_warped = np.zeros_like(self.rgb)
+        self._depth8 = np.zeros((height, width), dtype=np.uint8)
+        self._images = {
+            id(buffer): QImage(
+                buffer.data,
+                width,
+                height,
+                buffer.strides[0],
+                QImage.Format.Format_RGB888,
+            )
+            for buffer in (self.rgb, self.unwrapped, self.depth_rgb, self.depth_warped)
+        }
+        # The warp only changes with the controls
+        self.remap = RemapTable(cv2.INTER_LINEAR)
+        self.homography_dirty = True
+        self.frame = None
+        # Depth frames collected for the automatic calibration, None when idle
+        self.auto_frames = None
+
+        self.auto_button = QPushButton("Calibrage automatique")
+        self.auto_button.clicked.connect(self.start_auto_calibration)
 
         central = QWidget()
-        layout = QHBoxLayout(central)
-        layout.addWidget(self.lview)
-        layout.addWidget(self.cview)
-        layout.addWidget(self.rview)
+        layout = QVBoxLayout(central)
+        views = QHBoxLayout()
+        views.addWidget(self.lview)
+        views.addWidget(self.cview)
+        views.addWidget(self.rview)
+        layout.addLayout(views)
+        layout.addWidget(self.auto_button)
         self.setCentralWidget(central)
 
+        self.capture = CaptureThread(device)
+        self.capture.start()
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.peek_frame)
-        self.timer.start(30)  # Kinect frame rate
+        self.timer.start(_POLL_INTERVAL)
 
     def peek_frame(self):
-        frame = freenect.sync_get_video(0)[0]
-        depth_frame = freenect.sync_get_depth(0)[0]
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        depth_frame = depth_frame.astype(np.uint8)
+        frames = self.capture.slot.get(timeout=0)
+        warp_changed = False
+        if self.homography_dirty:
+            self.homography_dirty = False
+            self.recompute_homography()
+            warp_changed = self.remap.update(_H, _FRAME_SIZE, _FRAME_SIZE)
+        if frames is not None:
+            frame, depth_frame = frames
+            cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.rgb)
+            # Same wrap-around as astype(np.uint8), without the temporary
+            np.copyto(self._depth8, depth_frame, casting="unsafe")
+            cv2.applyColorMap(
+                cv2.convertScaleAbs(self._depth8, alpha=0.03),
+                cv2.COLORMAP_JET,
+                dst=self.depth_rgb,
+            )
+            self.display_frame(self.rgb, self.rgb_item)
+            self.frame = frames
+            if self.auto_frames is not None:
+                self.collect_auto_frame(depth_frame)
+        elif not warp_changed or self.frame is None:
+            return
 
-        self.display_frame(frame, self.rgb_item, self.lscene)
         if _H is not None:
-            unwrapped = cv2.warpPerspective(frame, _H, (frame.shape[1], frame.shape[0]))
-            self.display_frame(unwrapped, self.unwrapped_item, self.cscene)
-
-        depth_rgb = cv2.applyColorMap(
-            cv2.convertScaleAbs(depth_frame, alpha=0.03), cv2.COLORMAP_JET
-        )
-        if _H is not None:
-            depth_rgb = cv2.warpPerspective(
-                depth_rgb, _H, (depth_rgb.shape[1], depth_rgb.shape[0])
+            self.display_frame(
+                self.remap.apply(self.rgb, dst=self.unwrapped), self.unwrapped_item
             )
-        self.display_frame(depth_rgb, self.depth_item, self.rscene)
-
-    def display_frame(self, frame, item, scene):
-        image = QImage(
-            frame.data,
-            frame.shape[1],
-            frame.shape[0],
-            frame.strides[0],
-            QImage.Format.Format_RGB888,
-        )
-        item.setPixmap(QPixmap.fromImage(image))
-        scene.setSceneRect(QRectF(image.rect()))  # Convert QRect to QRectF
+            self.display_frame(
+                self.remap.apply(self.depth_rgb, dst=self.depth_warped),
+                self.depth_item,
+            )
+        else:
+            self.display_frame(self.depth_rgb, self.depth_item)
+
+    def display_frame(self, frame, item):
+        item.draw(self._images[id(frame)])
+
+    def start_auto_calibration(self):
+        self.auto_button.setEnabled(False)
+        self.statusBar().showMessage("Mesure du bac à sable...")
+        self.auto_frames = []
+
+    def collect_auto_frame(self, depth_frame):
+        self.auto_frames.append(depth_frame)
+        if len(self.auto_frames) < _AUTO_FRAMES:
+            return
+        frames, self.auto_frames = self.auto_frames, None
+        self.auto_button.setEnabled(True)
+        try:
+            corners = detect_corners(frames)
+        except ValueError as e:
+            self.statusBar().showMessage(f"Échec du calibrage automatique : {e}")
+            return
+        # The controls stay movable for a fine adjustment
+        for control, (x, y) in zip(self.controls, corners):
+            control.setPos(float(x), float(y))
+        self.statusBar().showMessage("Coins détectés, ajustables à la main")
 
     def recompute_homography(self):
         try:
@@ -123,20 +267,23 @@ class QCalibrationApp(QMainWindow):
                 for control in self.controls
             ]
         except AttributeError:
-            coordinates = [(0, 0), (640, 0), (640, 480), (0, 480)]
+            coordinates = _SANDBOX_CORNERS
         src_pts = np.array(coordinates, dtype=np.float32)
-        dst_pts = np.array([(0, 0), (640, 0), (640, 480), (0, 480)], dtype=np.float32)
+        dst_pts = np.array(_SANDBOX_CORNERS, dtype=np.float32)
         global _H
         _H = cv2.getPerspectiveTransform(src_pts, dst_pts)
 
     def closeEvent(self, a0) -> None:
+        self.timer.stop()
+        self.capture.stop()
+        self.capture.join()
         freenect.sync_stop()
         a0.accept()
 
 
-def run_calibration():
+def run_calibration(device=0):
     freenect.sync_stop()
     App = QApplication(sys.argv)
-    win = QCalibrationApp()
+    win = QCalibrationApp(device=device)
     win.show()
     App.exec()
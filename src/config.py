@@ -0,0 +1,35 @@
+"""Settings shared by the game and the web front.
+
+The front imports them from here rather than from game.py, which only the
+worker process loads (see engine.py).
+"""
+
+from screeninfo import get_monitors
+
+# Size of the sandbox image, the scenes are placed at this size
+HEIGHT = 640
+WIDTH = 480
+# Most fossils stacked over a pixel, at different depths: digging shows the
+# deepest layer reached. 1 keeps the fossils side by side.
+LAYERS = 3
+# Share of a fossil's opaque pixels that must be dug out for it to count as seen
+REVEAL_THRESHOLD = 0.8
+
+
+def find_projector_screen(name=None):
+    monitors = get_monitors()
+    print(monitors)
+    if name is not None:
+        for monitor in monitors:
+            if monitor.name == name:
+                return monitor
+        print(f"Projector screen {name} not found")
+    if len(monitors) > 1:
+        for monitor in monitors:
+            if monitor.name.__contains__("HDMI"):
+                return monitor
+    print(
+        "Projector screen not found. Make sure the projector is connected (using"
+        " built-in display for now)."
+    )
+    return monitors[0]
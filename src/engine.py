@@ -0,0 +1,488 @@
+"""Game hosted in a worker process, driven by the web front.
+
+The front only talks to the worker through a command pipe (start, reload,
+stop, shutdown, ...), and reads the live counters of the game from a shared
+memory block the worker refreshes a few times per second, so no Dash
+callback ever waits on the game loop. A second block carries a downscaled
+JPEG preview of the projected frame, encoded only while the front asks for it.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+from metrics import STAGES
+
+# Scalar entries of the shared status, in Game.status
+_STATUS_FIELDS = [
+    "running",
+    "seen_bones",
+    "fossils",
+    "quality_level",
+    "quality_pinned",
+    "processed",
+    "displayed",
+    "captured",
+    "dropped_capture",
+    "dropped_display",
+    "depth_queue",
+    "display_queue",
+    "recorded",
+    "dropped_record",
+    "dropped_events",
+    "record_queue",
+    "process_fps",
+    "display_fps",
+    "capture_fps",
+    "callback_jitter_ms",
+]
+_FLOAT_FIELDS = {"process_fps", "display_fps", "capture_fps", "callback_jitter_ms"}
+_SUMMARY = ["p50", "p95", "max"]
+# Fossils whose progress fits in the shared status
+_MAX_FOSSILS = 1024
+# How often the worker refreshes the shared status, in seconds
+_PUBLISH_PERIOD = 0.1
+# How long the front waits for a command, loading a scene included
+_COMMAND_TIMEOUT = 30.0
+# Preview of the projected frame: rate, width, JPEG quality and largest image
+_PREVIEW_FPS = 5
+_PREVIEW_WIDTH = 320
+_PREVIEW_QUALITY = 70
+_PREVIEW_MAX_BYTES = 256 * 1024
+# The worker stops encoding previews when none was read for this long
+_PREVIEW_IDLE = 2.0
+
+
+class StatusBlock:
+    def __init__(self, name: str = None):
+        """Game status in shared memory, one writer and any number of readers
+
+        The block is a float64 array: a sequence number, the scalar fields,
+        the stage latency summaries, then the progress and area of each
+        fossil. The writer makes the sequence number odd while writing, and
+        readers retry until they read the same even number before and after
+        copying the block.
+
+        Args
+        ----
+        name: str (OPTIONAL)
+            name of an existing block to attach to, None to create one
+        """
+        self._stages_at = 1 + len(_STATUS_FIELDS)
+        self._progress_at = self._stages_at + len(STAGES) * len(_SUMMARY)
+        self._areas_at = self._progress_at + _MAX_FOSSILS
+        size = (self._areas_at + _MAX_FOSSILS) * 8
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=size
+        )
+        self.name = self._shm.name
+        self._data = np.ndarray((size // 8,), dtype=np.float64, buffer=self._shm.buf)
+        if name is None:
+            self._data.fill(0)
+
+    def write(self, status: dict) -> None:
+        data = self._data
+        data[0] += 1
+        for i, field in enumerate(_STATUS_FIELDS):
+            data[1 + i] = status.get(field, 0)
+        stages = status.get("stages_ms", {})
+        for i, stage in enumerate(STAGES):
+            for j, stat in enumerate(_SUMMARY):
+                data[self._stages_at + i * len(_SUMMARY) + j] = stages.get(
+                    stage, {}
+                ).get(stat, 0.0)
+        progress = status.get("progress", [])[:_MAX_FOSSILS]
+        n = len(progress)
+        data[self._progress_at : self._progress_at + n] = [
+            p["progress"] for p in progress
+        ]
+        data[self._areas_at : self._areas_at + n] = [p["area"] for p in progress]
+        data[0] += 1
+
+    def read(self, names: List[str] = ()) -> dict:
+        """
+        Copy of the status, in the format of Game.status
+
+        Args
+        ----
+        names: list[str] (OPTIONAL)
+            names of the fossils of the scene, which are not shared
+
+        Returns
+        -------
+        dict
+            the last status written
+        """
+        while True:
+            seq = self._data[0]
+            data = self._data.copy()
+            if seq % 2 == 0 and self._data[0] == seq:
+                break
+            time.sleep(0)
+        status = {}
+        for i, field in enumerate(_STATUS_FIELDS):
+            value = data[1 + i]
+            status[field] = float(value) if field in _FLOAT_FIELDS else int(value)
+        status["running"] = bool(status["running"])
+        status["quality_pinned"] = bool(status["quality_pinned"])
+        status["stages_ms"] = {
+            stage: {
+                stat: float(data[self._stages_at + i * len(_SUMMARY) + j])
+                for j, stat in enumerate(_SUMMARY)
+            }
+            for i, stage in enumerate(STAGES)
+        }
+        n = min(status["fossils"], _MAX_FOSSILS, len(names))
+        status["progress"] = [
+            {
+                "name": names[i],
+                "area": int(data[self._areas_at + i]),
+                "progress": float(data[self._progress_at + i]),
+            }
+            for i in range(n)
+        ]
+        return status
+
+    def close(self) -> None:
+        self._data = None
+        self._shm.close()
+
+    def unlink(self) -> None:
+        self._shm.unlink()
+
+
+class PreviewBlock:
+    def __init__(self, name: str = None):
+        """Latest preview JPEG in shared memory, one writer and any readers
+
+        A float64 header (sequence number, image size, time of the last
+        read) is followed by the bytes of the image. The sequence number
+        works as in StatusBlock.
+
+        Args
+        ----
+        name: str (OPTIONAL)
+            name of an existing block to attach to, None to create one
+        """
+        size = 32 + _PREVIEW_MAX_BYTES
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=size
+        )
+        self.name = self._shm.name
+        self._header = np.ndarray((4,), dtype=np.float64, buffer=self._shm.buf)
+        self._data = np.ndarray(
+            (_PREVIEW_MAX_BYTES,), dtype=np.uint8, buffer=self._shm.buf, offset=32
+        )
+        if name is None:
+            self._header.fill(0)
+
+    def wanted(self) -> bool:
+        """Whether a reader asked for a preview recently"""
+        return time.time() - self._header[2] < _PREVIEW_IDLE
+
+    def write(self, jpeg: np.array) -> None:
+        if len(jpeg) > _PREVIEW_MAX_BYTES:
+            return
+        header = self._header
+        header[0] += 1
+        self._data[: len(jpeg)] = jpeg
+        header[1] = len(jpeg)
+        header[0] += 1
+
+    def read(self) -> tuple:
+        """
+        Copy of the latest preview, which also keeps the previews coming
+
+        Returns
+        -------
+        tuple[int, bytes]
+            sequence number and JPEG bytes, (0, None) before the first image
+        """
+        self._header[2] = time.time()
+        while True:
+            seq = self._header[0]
+            image = self._data[: int(self._header[1])].tobytes()
+            if seq % 2 == 0 and self._header[0] == seq:
+                break
+            time.sleep(0)
+        return int(seq), image if seq else None
+
+    def close(self) -> None:
+        self._header = self._data = None
+        self._shm.close()
+
+    def unlink(self) -> None:
+        self._shm.unlink()
+
+
+def _serve(
+    conn, status_name: str, preview_name: str, game_options: dict, cpus: list
+) -> None:
+    """Main of the worker process: run the commands of the front"""
+    if cpus:
+        # Each sandbox keeps its cores: no GIL or cache sharing between games
+        os.sched_setaffinity(0, cpus)
+        cv2.setNumThreads(len(cpus))
+    # Imported here, so only the worker loads the game and opens the Kinect
+    from game import Game
+    from profiles import load_profile
+
+    status = StatusBlock(status_name)
+    preview = PreviewBlock(preview_name)
+    state = {"game": None, "runner": None, "profile": None}
+    alive = threading.Event()
+    alive.set()
+    # The block has a single writer at a time: the publisher, or stop
+    status_lock = threading.Lock()
+
+    def publish():
+        while alive.is_set():
+            with status_lock:
+                game = state["game"]
+                status.write(game.status() if game is not None else {})
+            time.sleep(_PUBLISH_PERIOD)
+
+    def shrink_latest(game, small):
+        # The composite is held, so not drawn over, only while it is resized
+        frame = game.hold_latest_frame()
+        try:
+            if frame is None:
+                return small, False
+            h, w = frame.shape[:2]
+            size = (_PREVIEW_WIDTH, _PREVIEW_WIDTH * h // w)
+            if small is None or small.shape[1::-1] != size:
+                small = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+            cv2.resize(frame, size, dst=small, interpolation=cv2.INTER_AREA)
+            return small, True
+        finally:
+            game.release_frame()
+
+    def encode_previews():
+        # Runs beside the game threads: the frame path only ever hands out
+        # its latest composite
+        small = None
+        while alive.is_set():
+            game = state["game"]
+            if game is not None and preview.wanted():
+                small, shrunk = shrink_latest(game, small)
+                if shrunk:
+                    ok, jpeg = cv2.imencode(
+                        ".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, _PREVIEW_QUALITY]
+                    )
+                    if ok:
+                        preview.write(jpeg.ravel())
+            time.sleep(1 / _PREVIEW_FPS)
+
+    def stop():
+        game = state["game"]
+        if game is None:
+            return
+        game.stop()
+        if state["runner"] is not None:
+            state["runner"].join()
+        game.destroy()
+        # Published before the reply, so the front never reads a stopped game
+        # as running
+        with status_lock:
+            state["game"] = state["runner"] = None
+            status.write({})
+
+    def calibrate(profile_path):
+        # Memory-maps the lookup tables saved with the profile
+        profile = load_profile(profile_path) if profile_path is not None else None
+        state["profile"] = profile
+        if state["game"] is not None:
+            state["game"].set_profile(profile)
+
+    def start(fossils_dict, profile_path):
+        calibrate(profile_path)
+        game = state["game"]
+        if game is not None and game.running:
+            game.reload(fossils_dict)
+            return
+        stop()
+        game = Game(fossils_dict, profile=state["profile"], **game_options)
+        game.start()
+        state["runner"] = threading.Thread(target=game.run, name="source", daemon=True)
+        state["runner"].start()
+        state["game"] = game
+
+    def reload(fossils_dict):
+        if state["game"] is None:
+            raise RuntimeError("No game is running")
+        state["game"].reload(fossils_dict)
+
+    def capture_baseline():
+        if state["game"] is None:
+            raise RuntimeError("No game is running")
+        state["game"].capture_baseline()
+
+    commands = {
+        "start": start,
+        "calibrate": calibrate,
+        "reload": reload,
+        "baseline": capture_baseline,
+        "stop": stop,
+    }
+    helpers = [
+        threading.Thread(target=publish, name="publish", daemon=True),
+        threading.Thread(target=encode_previews, name="preview", daemon=True),
+    ]
+    for helper in helpers:
+        helper.start()
+    try:
+        while True:
+            try:
+                seq, command, args = conn.recv()
+            except EOFError:
+                break
+            if command == "shutdown":
+                conn.send((seq, "ok", None))
+                break
+            try:
+                conn.send((seq, "ok", commands[command](*args)))
+            except (Exception, SystemExit) as e:
+                # Game exits when no Kinect can be opened: report it instead
+                conn.send((seq, "error", f"{type(e).__name__}: {e}"))
+    finally:
+        stop()
+        alive.clear()
+        for helper in helpers:
+            helper.join()
+        status.write({})
+        status.close()
+        preview.close()
+
+
+class GameProcess:
+    def __init__(self, cpus: list = None, **game_options):
+        """Front-side handle of a game running in a worker process
+
+        The worker is spawned on the first command and respawned if it died,
+        so games can be started and stopped any number of times.
+
+        Args
+        ----
+        cpus: list[int] (OPTIONAL)
+            CPUs the worker is pinned to, None for all of them
+        game_options: Any
+            keyword arguments of Game (display, remap_mode, device, ...)
+        """
+        self.cpus = cpus
+        self.game_options = game_options
+        self.names = []
+        self.started_at = None
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._conn = None
+        self._status = StatusBlock()
+        self._preview = PreviewBlock()
+        self._lock = threading.Lock()
+        # Number of the last command sent, echoed by its reply
+        self._seq = 0
+
+    def _spawn(self) -> None:
+        if self._process is not None and self._process.is_alive():
+            return
+        if self._conn is not None:
+            self._conn.close()
+        self._conn, child = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_serve,
+            args=(
+                child,
+                self._status.name,
+                self._preview.name,
+                self.game_options,
+                self.cpus,
+            ),
+            name="game",
+            daemon=True,
+        )
+        self._process.start()
+        child.close()
+
+    def _call(self, command: str, *args, timeout: float = _COMMAND_TIMEOUT):
+        with self._lock:
+            self._spawn()
+            self._seq += 1
+            self._conn.send((self._seq, command, args))
+            deadline = time.monotonic() + timeout
+            while True:
+                if not self._conn.poll(max(0.0, deadline - time.monotonic())):
+                    raise TimeoutError(
+                        f"The game did not answer {command} in {timeout} s"
+                    )
+                try:
+                    seq, result, value = self._conn.recv()
+                except EOFError:
+                    raise RuntimeError("The game process exited") from None
+                # Late replies of commands that timed out are dropped
+                if seq == self._seq:
+                    break
+        if result == "error":
+            raise RuntimeError(value)
+        return value
+
+    def start(self, fossils_dict: List[Dict], profile: str = None) -> None:
+        """
+        Start a game on a scene, or switch the running game to it
+
+        Args
+        ----
+        fossils_dict: list[dict]
+            the scene, as in the config files
+        profile: str (OPTIONAL)
+            directory of the calibration profile, None for no calibration
+        """
+        self._call("start", fossils_dict, profile)
+        self.names = [fossil["name"] for fossil in fossils_dict]
+        self.started_at = time.time()
+
+    def calibrate(self, profile: str = None) -> None:
+        """Switch to another calibration profile, at the next frame if running"""
+        self._call("calibrate", profile)
+
+    def reload(self, fossils_dict: List[Dict]) -> None:
+        """Switch the running game to another scene"""
+        self._call("reload", fossils_dict)
+        self.names = [fossil["name"] for fossil in fossils_dict]
+
+    def capture_baseline(self) -> None:
+        """Save the current depth as the sand surface of the calibration profile"""
+        self._call("baseline")
+
+    def stop(self) -> None:
+        """Stop the game and release the Kinect, the worker stays up"""
+        if self._process is not None and self._process.is_alive():
+            self._call("stop")
+        self.started_at = None
+
+    def status(self) -> dict:
+        """Last published status, read from shared memory without waiting"""
+        if self._process is None or not self._process.is_alive():
+            return {"running": False}
+        return {**self._status.read(self.names), "started_at": self.started_at}
+
+    def preview(self) -> tuple:
+        """
+        Latest preview of the projected frame, see PreviewBlock.read
+
+        Previews are only encoded while this is called regularly.
+        """
+        return self._preview.read()
+
+    def shutdown(self) -> None:
+        if self._process is not None and self._process.is_alive():
+            self._call("shutdown")
+            self._process.join()
+        self._process = None
+        for block in (self._status, self._preview):
+            block.close()
+            block.unlink()
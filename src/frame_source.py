@@ -0,0 +1,369 @@
+import os
+import sys
+from abc import ABC, abstractmethod
+import time
+import zipfile
+from typing import Callable, Iterator, Tuple
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+from recorder import RecordedSession
+
+try:
+    import freenect
+except ImportError:  # Replay and synthetic sources work without libfreenect
+    freenect = None
+
+# Depth frames are 640x480 millimeter maps (RESOLUTION_MEDIUM, DEPTH_MM)
+_FRAME_SHAPE = (480, 640)
+_KINECT_FPS = 30
+# Synthetic hand, in pixels: radius of the hand and of the area it digs
+_HAND_RADIUS = 30
+_DIG_RADIUS = 75
+
+
+class FrameSource(ABC):
+    """Base class of the depth frame sources used by Game.
+
+    A source pushes uint16 millimeter depth frames to a callback
+    `callback(frame, timestamp)`. The frame buffer may be reused by the source
+    once the callback returns.
+    """
+
+    def __init__(self):
+        self.running = False
+        self._callback = None
+
+    def set_callback(self, callback: Callable[[np.array, float], None]) -> None:
+        self._callback = callback
+
+    def start(self) -> None:
+        self.running = True
+
+    @abstractmethod
+    def run(self) -> None:
+        """Produce frames until `stop` is called (blocking)"""
+
+    def stop(self) -> None:
+        self.running = False
+
+    def close(self) -> None:
+        self.stop()
+
+
+class FreenectSource(FrameSource):
+    def __init__(self, device_index: int = 0):
+        """Live depth stream of a Kinect, through the freenect callback API
+
+        Args
+        ----
+        device_index: int (OPTIONAL)
+            index of the Kinect to open
+        """
+        super().__init__()
+        if freenect is None:
+            print("freenect is not installed, no Kinect can be opened")
+            sys.exit(1)
+        freenect.sync_stop()
+        self.ctx = freenect.init()
+        if self.ctx is None:
+            print("Failed to initialize freenect context")
+            sys.exit(1)
+        self.num_devices = freenect.num_devices(self.ctx)
+        if self.num_devices <= device_index:
+            print("No devices found")
+            freenect.shutdown(self.ctx)
+            sys.exit(1)
+        self.dev = freenect.open_device(self.ctx, device_index)
+        if self.dev is None:
+            print("Failed to open device")
+            freenect.shutdown(self.ctx)
+            sys.exit(1)
+        freenect.set_depth_callback(self.dev, self._depth_callback)
+        freenect.set_depth_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.DEPTH_MM)
+
+    def _depth_callback(self, dev, data, timestamp):
+        self._callback(data, timestamp)
+
+    def start(self):
+        super().start()
+        freenect.start_depth(self.dev)
+
+    def run(self):
+        while self.running:
+            freenect.process_events(self.ctx)
+
+    def close(self):
+        super().close()
+        freenect.stop_depth(self.dev)
+        freenect.stop_video(self.dev)
+        freenect.close_device(self.dev)
+        freenect.shutdown(self.ctx)
+
+
+def _open_npz_member(path: str, key: str):
+    """
+    Open an array of a .npz archive without loading it in memory
+
+    Args
+    ----
+    path: str
+        path of the archive
+    key: str
+        name of the array in the archive
+
+    Returns
+    -------
+    tuple[np.array, None] | tuple[None, tuple]
+        a read-only memmap when the member is stored uncompressed, otherwise
+        None and (shape, dtype, data offset in the decompressed member) so
+        that it can be streamed
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(key + ".npy")
+        with archive.open(info) as member:
+            if np.lib.format.read_magic(member) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(member)
+            else:
+                header = np.lib.format.read_array_header_2_0(member)
+            shape, fortran_order, dtype = header
+            header_size = member.tell()
+        if fortran_order:
+            raise ValueError(f"{path}: {key} must be stored in C order")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None, (shape, dtype, header_size)
+
+    # Skip the local file header to find where the member's bytes start
+    with open(path, "rb") as f:
+        f.seek(info.header_offset + 26)
+        name_size, extra_size = np.frombuffer(f.read(4), dtype="<u2")
+    offset = info.header_offset + 30 + int(name_size) + int(extra_size) + header_size
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape, offset=offset), None
+
+
+class Recording:
+    def __init__(self, path: str, key: str = "depth"):
+        """A recorded stream of uint16 depth frames, read lazily from disk
+
+        `.npy` files and uncompressed `.npz` archives are memory-mapped.
+        Compressed `.npz` archives are decompressed frame by frame while
+        iterating. An optional `timestamps` array (seconds) in an `.npz`
+        archive gives the original frame times. A directory is a session of
+        recorder.SessionRecorder, read chunk by chunk at its capture times.
+
+        Args
+        ----
+        path: str
+            path of the .npy or .npz recording, frames of shape (N, 480, 640),
+            or of a recorded session
+        key: str (OPTIONAL)
+            name of the frames array in a .npz archive
+        """
+        self.path = path
+        self.key = key
+        self.timestamps = None
+        self._stream = None
+        self._session = None
+        if os.path.isdir(path):
+            self._session = RecordedSession(path)
+            self.frames = None
+            self.timestamps = self._session.timestamps
+            self.length = len(self._session)
+            self.frame_shape = self._session.frame_shape
+            if self.length == 0:
+                raise ValueError(f"{path}: the recording has no frames")
+            return
+        if path.endswith(".npz"):
+            self.frames, self._stream = _open_npz_member(path, key)
+            with np.load(path) as archive:
+                if "timestamps" in archive.files:
+                    self.timestamps = archive["timestamps"]
+        else:
+            self.frames = np.load(path, mmap_mode="r")
+        shape = self.frames.shape if self.frames is not None else self._stream[0]
+        self.length = shape[0]
+        self.frame_shape = tuple(shape[1:])
+        if self.length == 0:
+            raise ValueError(f"{path}: the recording has no frames")
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self) -> Iterator[np.array]:
+        if self._session is not None:
+            yield from self._session
+            return
+        if self.frames is not None:
+            yield from self.frames
+            return
+
+        # Compressed archive: decompress one frame at a time
+        shape, dtype, header_size = self._stream
+        frame = np.empty(shape[1:], dtype=dtype)
+        view = memoryview(frame).cast("B")
+        with zipfile.ZipFile(self.path) as archive:
+            with archive.open(self.key + ".npy") as member:
+                member.read(header_size)
+                for _ in range(shape[0]):
+                    member.readinto(view)
+                    yield frame
+
+
+class ReplaySource(FrameSource):
+    def __init__(self, path: str, realtime: bool = True, loop: bool = True):
+        """Replay of a recorded depth stream
+
+        Args
+        ----
+        path: str
+            path of the .npy or .npz recording or of a recorded session (see
+            Recording)
+        realtime: bool (OPTIONAL)
+            pace the frames at their original rate, or send them unthrottled
+        loop: bool (OPTIONAL)
+            restart from the first frame at the end of the recording
+        """
+        super().__init__()
+        self.recording = Recording(path)
+        self.realtime = realtime
+        self.loop = loop
+
+    def _timestamps(self) -> Iterator[float]:
+        if self.recording.timestamps is not None:
+            yield from (float(t) for t in self.recording.timestamps)
+        else:
+            yield from (i / _KINECT_FPS for i in range(len(self.recording)))
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            first = None
+            for frame, timestamp in zip(self.recording, self._timestamps()):
+                if not self.running:
+                    return
+                if first is None:
+                    first = timestamp
+                if self.realtime:
+                    delay = (timestamp - first) - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                self._callback(frame, timestamp)
+            if not self.loop:
+                self.running = False
+
+
+def open_source(spec: str, device: int = 0) -> FrameSource:
+    """
+    Open a depth source from its description
+
+    Args
+    ----
+    spec: str
+        "kinect", "synthetic", or "replay:<path of a recording>" with the
+        optional ReplaySource flags as a query, e.g.
+        "replay:demo.npz?realtime=0&loop=0" to play it once, unthrottled
+    device: int (OPTIONAL)
+        index of the Kinect, for "kinect"
+
+    Returns
+    -------
+    FrameSource
+        the source, not started
+    """
+    if spec == "kinect":
+        return FreenectSource(device)
+    if spec == "synthetic":
+        return SyntheticSource()
+    if spec.startswith("replay:"):
+        path, _, query = spec[len("replay:") :].partition("?")
+        options = {}
+        for option, value in parse_qsl(query, strict_parsing=bool(query)):
+            if option not in ("realtime", "loop") or value not in ("0", "1"):
+                raise ValueError(f"Unknown replay option {option}={value} in {spec}")
+            options[option] = value == "1"
+        return ReplaySource(path, **options)
+    raise ValueError(f"Unknown source {spec}, expected kinect, synthetic or replay:")
+
+
+class SyntheticSource(FrameSource):
+    def __init__(
+        self,
+        fps: float = _KINECT_FPS,
+        sand_depth: int = 600,
+        dig_depth: int = 40,
+        seed: int = 0,
+    ):
+        """Generated depth stream: a hand moving over a flat sand surface,
+        digging a trail as it goes
+
+        Args
+        ----
+        fps: float (OPTIONAL)
+            frame rate, 0 for unthrottled
+        sand_depth: int (OPTIONAL)
+            distance from the Kinect to the sand surface, in millimeters
+        dig_depth: int (OPTIONAL)
+            maximum depth of the trail dug by the hand, in millimeters
+        seed: int (OPTIONAL)
+            seed of the sensor noise
+        """
+        super().__init__()
+        self.fps = fps
+        self.sand_depth = sand_depth
+        self.dig_depth = dig_depth
+        rng = np.random.default_rng(seed)
+        # A small bank of noise and dropout patterns, cycled through, keeps
+        # the generator cheap enough to outrun the game when unthrottled
+        self._noise = rng.normal(0, 2, size=(8,) + _FRAME_SHAPE).astype(np.float32)
+        self._holes = rng.random((8,) + _FRAME_SHAPE) < 0.01
+        ys, xs = np.mgrid[
+            -_DIG_RADIUS : _DIG_RADIUS + 1, -_DIG_RADIUS : _DIG_RADIUS + 1
+        ]
+        dist2 = (xs**2 + ys**2).astype(np.float32)
+        self._dig = dig_depth * np.exp(-dist2 / (2 * (_DIG_RADIUS / 3) ** 2))
+        self._hand = dist2 < _HAND_RADIUS**2
+        self._dug = np.zeros(_FRAME_SHAPE, dtype=np.float32)
+        self._depth = np.zeros(_FRAME_SHAPE, dtype=np.float32)
+        self._frame = np.zeros(_FRAME_SHAPE, dtype=np.uint16)
+        self.index = 0
+
+    def hand_position(self, index: int) -> Tuple[int, int]:
+        """Position (x, y) of the center of the hand at a given frame"""
+        # Amplitudes keep the digging window inside the frame
+        half_h, half_w = _FRAME_SHAPE[0] // 2, _FRAME_SHAPE[1] // 2
+        t = index / _KINECT_FPS
+        return (
+            int(half_w + (half_w - _DIG_RADIUS - 1) * np.sin(0.7 * t)),
+            int(half_h + (half_h - _DIG_RADIUS - 1) * np.sin(1.1 * t + 0.5)),
+        )
+
+    def next_frame(self) -> np.array:
+        """Generate the next frame (the returned buffer is reused)"""
+        x, y = self.hand_position(self.index)
+        r = _DIG_RADIUS
+        window = (slice(y - r, y + r + 1), slice(x - r, x + r + 1))
+        # The hand digs a little under and around itself at every frame
+        np.maximum(self._dug[window], self._dig, out=self._dug[window])
+
+        np.add(self._dug, self.sand_depth, out=self._depth)
+        self._depth += self._noise[self.index % len(self._noise)]
+        # The hand itself is much closer to the Kinect
+        self._depth[window][self._hand] = self.sand_depth - 250
+        # A few pixels without measure, like the real sensor
+        self._depth[self._holes[self.index % len(self._holes)]] = 0
+        np.copyto(self._frame, self._depth, casting="unsafe")
+        self.index += 1
+        return self._frame
+
+    def run(self):
+        start = time.perf_counter()
+        first = self.index
+        while self.running:
+            frame = self.next_frame()
+            timestamp = self.index / _KINECT_FPS
+            if self.fps:
+                delay = (self.index - first) / self.fps - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self._callback(frame, timestamp)
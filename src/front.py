@@ -1,10 +1,19 @@
-import datetime
+import atexit
 import json
 import os
+import time
 
+import calibration
+from bundles import bake_scene
 from calibration import run_calibration
+from config import HEIGHT, LAYERS, REVEAL_THRESHOLD, WIDTH, find_projector_screen
 from dash import Dash, Input, Output, State, callback, dcc, html, no_update
-from game import Game
+from engine import GameProcess
+from flask import Response, jsonify, request
+from metrics import to_prometheus
+from profiles import load_profile, save_profile
+from quality import QUALITY_LEVELS
+from sandboxes import load_sandboxes
 
 app = Dash(
     __name__,
@@ -14,8 +23,45 @@ app = Dash(
     prevent_initial_callbacks=True,
 )
 server = app.server
-game = None
+# "auto" lets the game lower its quality to keep up, a level name pins it
+_QUALITY = os.environ.get("FOSSILHUNT_QUALITY", "auto")
+# Scale of the depth processing, 0.5 filters the depth at 320x240
+_PROCESS_SCALE = float(os.environ.get("FOSSILHUNT_PROCESS_SCALE", "1"))
+# How deep the fossils are buried, see _DEPTH_PRESETS in game.py: "baseline"
+# measures them from the sand surface saved with the calibration
+_DEPTH_PRESET = os.environ.get("FOSSILHUNT_DEPTH_PRESET", "legacy")
+# Calibration profile of the sandbox, when sandboxes.json does not describe them
+_PROFILE = os.environ.get("FOSSILHUNT_PROFILE", "default")
+# Where the raw depth and reveal events of each game are recorded, one directory
+# per sandbox (see recorder.py); empty does not record
+_RECORD_DIR = os.environ.get("FOSSILHUNT_RECORD_DIR", "")
+# Disk space the recordings of a sandbox may take, in GB, the oldest go first
+_RECORD_QUOTA_GB = float(os.environ.get("FOSSILHUNT_RECORD_QUOTA_GB", "20"))
+# How often the event stream looks at the game status, in seconds
+_EVENTS_PERIOD = 0.2
+# Performance figures are sent at most this often, in seconds
+_PERF_PERIOD = 1.0
+# Comment line sent on an idle event stream, in seconds
+_KEEPALIVE_PERIOD = 15.0
+# How often the preview stream looks for a new image, in seconds
+_PREVIEW_PERIOD = 0.1
 customize_config = []
+sandboxes = {sandbox.name: sandbox for sandbox in load_sandboxes(None, _PROFILE)}
+_FIRST_SANDBOX = next(iter(sandboxes))
+# Game process of each sandbox, spawned by its first game
+games = {}
+# Calibration of each sandbox, loaded at startup so that a calibrated sandbox
+# can start a game right away
+profiles = {}
+for name, sandbox in sandboxes.items():
+    try:
+        profiles[name] = load_profile(sandbox.profile)
+    except FileNotFoundError:
+        profiles[name] = None
+    except ValueError as e:
+        # Saved by an older version: the sandbox has to be calibrated again
+        print(f"Ignoring the calibration of {name}: {e}")
+        profiles[name] = None
 model_dict = {
     "test": "assets/configs/test/config.json",
     "tribolites": "assets/configs/trilobites/config.json",
@@ -29,6 +75,19 @@ images_dict = {
     "IsoletusMaximus": "assets/configs/trilobites/images/IsoletusMaximus.png",
 }
 
+
+def _start_style(name):
+    # A game can start once the sandbox is calibrated
+    return {"display": "block" if profiles[name] is not None else "none"}
+
+
+def _sandbox(name):
+    """The sandbox of a request or callback, the first one by default"""
+    if isinstance(name, str) and name in sandboxes:
+        return sandboxes[name]
+    return sandboxes[_FIRST_SANDBOX]
+
+
 app.layout = html.Div(
     id="layout",
     children=[
@@ -48,6 +107,20 @@ app.layout = html.Div(
         html.Div(
             id="content-start",
             children=[
+                html.Div(
+                    dcc.Dropdown(
+                        list(sandboxes),
+                        _FIRST_SANDBOX,
+                        id="sandbox-dropdown",
+                        clearable=False,
+                    ),
+                    # Only useful on hosts with several sandboxes
+                    style=(
+                        {"margin-bottom": "20px"}
+                        if len(sandboxes) > 1
+                        else {"display": "none"}
+                    ),
+                ),
                 html.Div(
                     dcc.Dropdown(
                         ["test", "custom"], "test", id="model-dropdown", clearable=False
@@ -156,6 +229,12 @@ app.layout = html.Div(
                         ),
                     ],
                 ),
+                html.Button(
+                    "Préparer la scène",
+                    id="bake-button",
+                    n_clicks=0,
+                ),
+                html.Div(id="bake-status", style={"margin-bottom": "10px"}),
                 html.Button(
                     "Commencer la calibration",
                     id="start-calibration-button",
@@ -165,24 +244,37 @@ app.layout = html.Div(
                     "Commencer le jeu",
                     id="start-button",
                     n_clicks=0,
-                    style={"display": "none"},
+                    style=_start_style(_FIRST_SANDBOX),
                 ),
             ],
         ),
         html.Div(
             id="content-game",
+            # Filled by assets/live.js from the /events stream
             children=[
-                dcc.Interval(
-                    id="interval-component",
-                    interval=1000,  # in milliseconds
-                    n_intervals=0,
-                ),
+                # Read by assets/live.js, to follow the sandbox of the game
+                html.Div(children=[], id="sandbox-name", style={"display": "none"}),
                 html.Div(children=[], id="model-name", style={"margin-bottom": "5px"}),
                 html.Div(
                     children=[], id="time-elapsed", style={"margin-bottom": "20px"}
                 ),
+                html.Div(
+                    children=[], id="reveal-count", style={"margin-bottom": "5px"}
+                ),
+                html.Div(
+                    children=[],
+                    id="reveal-log",
+                    style={"margin-bottom": "20px", "font-size": "14px"},
+                ),
+                html.Div(
+                    children=[],
+                    id="perf-panel",
+                    style={"margin-bottom": "20px", "font-size": "14px"},
+                ),
+                html.Img(id="preview", style={"display": "none", "width": "320px"}),
+                html.Button("Afficher l'aperçu", id="preview-button"),
+                html.Button("Enregistrer la surface du sable", id="baseline-button"),
                 html.Button("Finir la partie", id="quit-button"),
-                html.Div(children=0, id="timer", style={"display": "none"}),
             ],
             style={"display": "none"},
         ),
@@ -205,15 +297,45 @@ app.layout = html.Div(
     Output("start-calibration-button", component_property="style"),
     Output("start-button", component_property="style"),
     Input("start-calibration-button", "n_clicks"),
+    State("sandbox-dropdown", "value"),
     prevent_initial_call=True,
 )
-def start_calibration(n_clicks):
+def start_calibration(n_clicks, name):
     if n_clicks > 0:
-        run_calibration()
+        sandbox = _sandbox(name)
+        # The window starts from the current calibration of the sandbox
+        profile = profiles[sandbox.name]
+        calibration._H = profile.homography if profile is not None else None
+        run_calibration(sandbox.device)
+        profile = save_profile(
+            sandbox.profile,
+            calibration._H,
+            projector=find_projector_screen(sandbox.screen),
+        )
+        profiles[sandbox.name] = profile
+        game = games.get(sandbox.name)
+        if game is not None and game.started_at is not None:
+            # Picked up by the running game at its next frame
+            try:
+                game.calibrate(profile.path)
+            except (RuntimeError, TimeoutError) as e:
+                print(f"Could not update the calibration of the game: {e}")
         return {"display": "none"}, {"display": "block"}
     return no_update
 
 
+@callback(
+    Output(
+        "start-calibration-button", component_property="style", allow_duplicate=True
+    ),
+    Output("start-button", component_property="style", allow_duplicate=True),
+    Input("sandbox-dropdown", "value"),
+    prevent_initial_call=True,
+)
+def select_sandbox(name):
+    return {"display": "block"}, _start_style(_sandbox(name).name)
+
+
 @callback(
     Output("bone-list", "children", allow_duplicate=True),
     Input("reset-bone-button", "n_clicks"),
@@ -231,6 +353,30 @@ def reset_config(n_clicks):
     return no_update
 
 
+@callback(
+    Output("bake-status", "children"),
+    Input("bake-button", "n_clicks"),
+    State("model-dropdown", "value"),
+    prevent_initial_call=True,
+)
+def bake(n_clicks, model):
+    # Placed once here, the scene then starts from its memory-mapped bundle
+    if n_clicks > 0:
+        config_path = model_dict.get(model)
+        if config_path is None:
+            return no_update
+        try:
+            with open(config_path, "r") as f:
+                fossils_dict = json.load(f)
+            start = time.perf_counter()
+            bake_scene(fossils_dict, (WIDTH, HEIGHT), LAYERS, name=model)
+        except (OSError, ValueError) as e:
+            print(f"Could not bake the scene {model}: {e}")
+            return f"Échec de la préparation : {e}"
+        return f"Scène {model} prête ({time.perf_counter() - start:.1f} s)"
+    return no_update
+
+
 @callback(
     Output("content-customize", component_property="style", allow_duplicate=True),
     Input("model-dropdown", "value"),
@@ -316,13 +462,13 @@ def submit_bone_list(n_clicks, bones):
     Output("content-start", component_property="style", allow_duplicate=True),
     Output("content-game", component_property="style", allow_duplicate=True),
     Output("model-name", "children"),
-    Output("time-elapsed", "children", allow_duplicate=True),
-    Output("timer", "children", allow_duplicate=True),
+    Output("sandbox-name", "children"),
     Input("start-button", "n_clicks"),
     State("model-dropdown", "value"),
+    State("sandbox-dropdown", "value"),
     prevent_initial_call=True,
 )
-def start_game(n_clicks, model):
+def start_game(n_clicks, model, name):
     if n_clicks > 0:
         config_path = None
         print(f"model : {model}")
@@ -337,48 +483,213 @@ def start_game(n_clicks, model):
         with open(config_path, "r") as f:
             fossils_dict = json.load(f)
 
-        global game
-        if game is not None:
-            game._init_ressources(fossils_dict)
-        else:
-            game = Game(fossils_dict)
-            game.start()
-            game.run()
+        sandbox = _sandbox(name)
+        game = games.get(sandbox.name)
+        if game is None:
+            # Each sandbox runs in its own process, spawned by its first game
+            game = GameProcess(
+                cpus=sandbox.cpus,
+                quality=_QUALITY,
+                process_scale=_PROCESS_SCALE,
+                depth_preset=_DEPTH_PRESET,
+                record_dir=(
+                    os.path.join(_RECORD_DIR, sandbox.name) if _RECORD_DIR else None
+                ),
+                record_quota=int(_RECORD_QUOTA_GB * 1024**3),
+                **sandbox.game_options(),
+            )
+            games[sandbox.name] = game
+            atexit.register(game.shutdown)
+        profile = profiles[sandbox.name]
+        try:
+            game.start(fossils_dict, profile.path if profile is not None else None)
+        except (RuntimeError, TimeoutError) as e:
+            print(f"Could not start the game: {e}")
+            return no_update
         return (
             {"display": "none"},
             {"display": "block"},
-            f"Modèle : {model}",
-            "Temps écoulé : 0:00:00",
-            0,
+            f"Modèle : {model}" + (f" ({sandbox.name})" if len(sandboxes) > 1 else ""),
+            sandbox.name,
         )
     return no_update
 
 
+def _game_status(name=None):
+    game = games.get(_sandbox(name).name)
+    if game is None:
+        return {"running": False}
+    return game.status()
+
+
+@server.route("/metrics")
+def metrics_prometheus():
+    if len(sandboxes) == 1:
+        text = to_prometheus(_game_status())
+    else:
+        text = "".join(
+            to_prometheus(_game_status(name), labels={"sandbox": name})
+            for name in sandboxes
+        )
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+@server.route("/metrics.json")
+def metrics_json():
+    return jsonify(_game_status(request.args.get("sandbox")))
+
+
+def _changes(status, last):
+    """The events to send for a status, given the last sent one"""
+    events = []
+    state = {"running": status["running"], "started_at": status.get("started_at")}
+    if state != last.get("state"):
+        events.append(("state", state))
+    if not status["running"]:
+        return events, {"state": state}
+
+    progress = [
+        {"name": p["name"], "progress": round(p["progress"], 2)}
+        for p in status["progress"]
+    ]
+    revealed = {
+        p["name"] for p in status["progress"] if p["progress"] >= REVEAL_THRESHOLD
+    }
+    for name in sorted(revealed - last.get("revealed", revealed)):
+        events.append(
+            (
+                "reveal",
+                {
+                    "name": name,
+                    "seen_bones": status["seen_bones"],
+                    "fossils": status["fossils"],
+                },
+            )
+        )
+    if progress != last.get("progress"):
+        events.append(
+            (
+                "progress",
+                {
+                    "seen_bones": status["seen_bones"],
+                    "fossils": status["fossils"],
+                    "progress": progress,
+                },
+            )
+        )
+
+    perf = last.get("perf")
+    if perf is None or time.monotonic() - last["perf_at"] >= _PERF_PERIOD:
+        total = status["stages_ms"]["total"]
+        perf = {
+            "display_fps": round(status["display_fps"]),
+            "capture_fps": round(status["capture_fps"]),
+            "total_p50_ms": round(total["p50"], 1),
+            "total_p95_ms": round(total["p95"], 1),
+            "jitter_ms": round(status["callback_jitter_ms"], 1),
+            "dropped_capture": status["dropped_capture"],
+            "dropped_display": status["dropped_display"],
+            "quality": QUALITY_LEVELS[status["quality_level"]]["name"],
+            "quality_pinned": status["quality_pinned"],
+        }
+        if perf != last.get("perf"):
+            events.append(("perf", perf))
+        last_perf_at = time.monotonic()
+    else:
+        last_perf_at = last["perf_at"]
+
+    return events, {
+        "state": state,
+        "revealed": revealed,
+        "progress": progress,
+        "perf": perf,
+        "perf_at": last_perf_at,
+    }
+
+
+@server.route("/events")
+def events():
+    """Server-sent events: state, reveal, progress and perf, on change only"""
+
+    name = request.args.get("sandbox")
+
+    def stream():
+        last = {}
+        idle = 0.0
+        while True:
+            changes, last = _changes(_game_status(name), last)
+            for event, data in changes:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            idle = 0.0 if changes else idle + _EVENTS_PERIOD
+            if idle >= _KEEPALIVE_PERIOD:
+                # Lets proxies and the browser know the stream is alive
+                yield ": keepalive\n\n"
+                idle = 0.0
+            time.sleep(_EVENTS_PERIOD)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@server.route("/preview.mjpg")
+def preview():
+    """Downscaled projector frames, as a multipart JPEG stream"""
+
+    name = _sandbox(request.args.get("sandbox")).name
+
+    def stream():
+        last = None
+        while True:
+            game = games.get(name)
+            if game is not None:
+                seq, image = game.preview()
+                if image is not None and seq != last:
+                    last = seq
+                    yield (
+                        b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + image + b"\r\n"
+                    )
+            time.sleep(_PREVIEW_PERIOD)
+
+    return Response(stream(), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+
 @callback(
-    Output("time-elapsed", "children", allow_duplicate=True),
-    Output("timer", "children", allow_duplicate=True),
-    Input("interval-component", "n_intervals"),
-    State("timer", "children"),
+    Output("baseline-button", "children"),
+    Input("baseline-button", "n_clicks"),
+    State("sandbox-name", "children"),
     prevent_initial_call=True,
 )
-def update_time_elapsed(n_intervals, timer):
-    if n_intervals:
-        timer += 1
-        return f"Temps écoulé : {datetime.timedelta(seconds=timer)}", timer
-    return no_update
+def capture_baseline(n_clicks, name):
+    # The sand must be levelled: it is the surface the burial depths start from
+    game = games.get(_sandbox(name).name)
+    if not n_clicks or game is None:
+        return no_update
+    try:
+        game.capture_baseline()
+    except (RuntimeError, TimeoutError) as e:
+        print(f"Could not save the sand surface: {e}")
+        return "Échec, réessayer"
+    return "Surface du sable enregistrée"
 
 
 @callback(
     Output("content-game", component_property="style", allow_duplicate=True),
     Output("content-start", component_property="style", allow_duplicate=True),
     Input("quit-button", "n_clicks"),
+    State("sandbox-name", "children"),
     prevent_initial_call=True,
 )
-def quit_game(n_clicks):
+def quit_game(n_clicks, name):
     if n_clicks > 0:
-        # global game
-        # game.destroy()
-        # game = None
+        game = games.get(_sandbox(name).name)
+        if game is not None:
+            try:
+                game.stop()
+            except (RuntimeError, TimeoutError) as e:
+                print(f"Could not stop the game: {e}")
         return {"display": "none"}, {"display": "block"}
     return no_update
 
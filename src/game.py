@@ -1,75 +1,276 @@
 import signal
 import sys
+import threading
+import time
+from collections import deque
 
 import cv2
-import freenect
 import numpy as np
-from screeninfo import get_monitors
 
-from init_ressources import create_textures, load_objects_texture
-from smooth_depthmap import remove_flickering
+from bundles import load_bundle
+from config import HEIGHT, LAYERS, WIDTH, find_projector_screen
+from frame_source import open_source
+from init_ressources import create_layers, load_objects_texture
+from kernels import NumpyKernels
+from kernels import select as select_kernel
+from metrics import Metrics
+from pipeline import BufferRing, FrameSlot
+from profiles import projector_geometry
+from projection import RemapTable
+from quality import QualityGovernor, redundant_levels
+from recorder import QUOTA_BYTES, SessionRecorder
+from reveal import RevealCounter
+from smooth_depthmap import TemporalSmoothing
 
-import calibration
-
-_HEIGHT = 640
-_WIDTH = 480
 _MAX_DEPTH = 630
 _A = 0.97
-
-
-def _find_projector_screen():
-    monitors = get_monitors()
-    print(monitors)
-    if len(monitors) > 1:
-        for monitor in monitors:
-            if monitor.name.__contains__("HDMI"):
-                return monitor
-    print(
-        "Projector screen not found. Make sure the projector is connected (using"
-        " built-in display for now)."
-    )
-    return monitors[0]
-
-
+# Weight of the newest frame in the temporal depth filter
+_FILTER_ALPHA = 0.5
 _WINDOW_NAME = "Projector"
-_PROJECTOR = _find_projector_screen()
 _FRAME_RATE = 60
+# Where the calibration lookup table is applied:
+#   "depth": to the depth frame, the composite is stretched by the window
+#   "frame": to the composite, straight from Kinect space to projector size
+_REMAP_MODE = "depth"
+# How long the worker threads wait for a frame before checking `running` again
+_STAGE_TIMEOUT = 0.1
+# Share of changed pixels above which the composite and the reveal counts are
+# recomputed over the whole frame rather than pixel by pixel
+_FULL_FRAME_SHARE = 0.05
+# Scale of the depth processing (filtering), relative to the 640x480 frames:
+# the filtered depth is upsampled back before the reveal comparison
+_PROCESS_SCALE = 1.0
+# Frames of pixel changes kept for the composite buffers that lag behind
+_CHANGE_HISTORY = 8
+# Depth, in mm, at which each pixel is revealed: base + near + (far - near) * z,
+# z being the burial depth of the scene (0 to 1 on the fossils, -1 elsewhere)
+#   "legacy": base 0, the _MAX_DEPTH and _A mapping of the first versions
+#   "baseline": base is the sand surface saved in the calibration profile
+_DEPTH_PRESETS = {
+    "legacy": {"near": _A * _MAX_DEPTH, "far": _MAX_DEPTH, "baseline": False},
+    "baseline": {"near": 20, "far": 80, "baseline": True},
+}
+_DEPTH_PRESET = "legacy"
+# Processed frames between two progress events of a recorded session
+_RECORD_PROGRESS_FRAMES = 30
+
+
+def _pixels(image):
+    return image.reshape(-1, 3).view(np.dtype((np.void, 3))).ravel()
 
 
 class Game:
-    def __init__(self, fossils_dict):
-        freenect.sync_stop()
+    def __init__(
+        self,
+        fossils_dict,
+        source=None,
+        projector=None,
+        display=True,
+        remap_mode=_REMAP_MODE,
+        quality="auto",
+        incremental=True,
+        process_scale=_PROCESS_SCALE,
+        profile=None,
+        depth_preset=_DEPTH_PRESET,
+        smoothing=True,
+        kernel="auto",
+        device=0,
+        screen=None,
+        layers=LAYERS,
+        record_dir=None,
+        record_quota=QUOTA_BYTES,
+    ):
         self.running = False
         self.seen_bones = 0
-        self._init_ctx()
+        self.display = display
+        self.remap_mode = remap_mode
+        # Only redraw and recount the pixels whose reveal state changed
+        self.incremental = incremental
+        # Calibration, see profiles.py: None projects the Kinect frame as is
+        self.profile = profile
+        if projector is None and profile is not None:
+            projector = profile.monitor()
+        if projector is None:
+            projector = find_projector_screen(screen)
+        self.projector = projector
+        self._depth_slot = FrameSlot("depth")
+        self._display_slot = FrameSlot("display")
+        self._threads = []
+        # Held by the processing thread around each frame, so a scene is only
+        # swapped between two frames
+        self._scene_lock = threading.Lock()
+        # Guards the composite buffer held by the preview against being picked
+        # by the processing thread
+        self._frame_lock = threading.Lock()
+        self._held_frame = None
+        self.processed_frames = 0
+        self.displayed_frames = 0
+        self.metrics = Metrics()
+        self.process_scale = process_scale
+        self.depth_preset = depth_preset
+        self.layers = layers
+        # Without smoothing, the raw millimeter frames are compared as is
+        self.smoothing = smoothing
+        # Per-pixel reveal steps, compiled when reveal_kernel.pyx is built
+        self.kernel, self._reveal_frame, self._reveal_changes = select_kernel(kernel)
+        # Full redraws of the incremental path, with their own scratch buffers
+        self._numpy_kernels = NumpyKernels()
+        # Tables are rebuilt off the processing thread, which keeps the
+        # current one until the new one is ready
+        if remap_mode == "frame":
+            self._remap = RemapTable(cv2.INTER_LINEAR, background=True)
+            self._projector_image = np.zeros(
+                (self.projector.height, self.projector.width, 3), dtype=np.uint8
+            )
+        else:
+            self._remap = RemapTable(cv2.INTER_NEAREST, background=True)
+        self._remap.store = profile
+        # Interpolation only matters when the composite is remapped
+        self.governor = QualityGovernor(
+            1000 / _FRAME_RATE,
+            quality,
+            skip=redundant_levels(
+                ("interpolation", "scale") if remap_mode == "frame" else ("scale",)
+            ),
+        )
+        self._display_cost = 0
+        self._apply_quality()
+        self._process_shape = self._target_shape
+        self.depth_filter = TemporalSmoothing(self._process_shape, alpha=_FILTER_ALPHA)
+        self._captured = BufferRing((WIDTH, HEIGHT), np.uint16)
+        # Opt-in recording of the raw depth and the reveal events, a session
+        # per start, see recorder.py
+        self.record_dir = record_dir
+        self.record_quota = record_quota
+        self.recorder = None
+        self.device = device
+        self._init_source(source)
         self._init_ressources(fossils_dict)
         # self._init_handlers()
-        self._init_callback()
 
-    def _init_ressources(self, fossils_dict):
-        self.bg_img, self.fg_img, self.z_img, self.id_img = create_textures(
-            load_objects_texture(fossils_dict),
-            sdbx_width=_WIDTH,
-            sdbx_height=_HEIGHT,
+    def _load_scene(self, fossils_dict, seed=None):
+        # A baked scene is memory-mapped, see bundles.py, anything else is
+        # decoded and placed by _init_scene
+        baked = load_bundle(fossils_dict, (WIDTH, HEIGHT), self.layers, seed)
+        if baked is not None:
+            return baked
+        rng = np.random.default_rng(seed)
+        return load_objects_texture(fossils_dict, rng=rng), None
+
+    def _init_ressources(self, fossils_dict, seed=None):
+        fossils, scene = self._load_scene(fossils_dict, seed=seed)
+        self._init_scene(fossils, seed=seed, scene=scene)
+
+    def reload(self, fossils_dict, seed=None):
+        """Load another scene, swapped in between two frames when running"""
+        fossils, scene = self._load_scene(fossils_dict, seed=seed)
+        with self._scene_lock:
+            self._init_scene(fossils, seed=seed, scene=scene)
+        self._record_scene()
+
+    def set_profile(self, profile):
+        """Use another calibration profile, from the next frame on"""
+        if profile is not None and profile.projector is not None:
+            if profile.projector != projector_geometry(self.projector):
+                print(
+                    f"Profile {profile.name} was saved for another projector"
+                    " screen, the window stays where it is until a restart"
+                )
+        with self._scene_lock:
+            self.profile = profile
+            self._remap.store = profile
+            self._init_thresholds()
+
+    def capture_baseline(self):
+        """Save the current depth as the sand surface of the calibration profile"""
+        if self.profile is None:
+            raise RuntimeError("Calibrate before measuring the sand surface")
+        with self._scene_lock:
+            if self._last_depth is None:
+                raise RuntimeError("No depth frame processed yet")
+            depth = self._last_depth.astype(np.float32)
+            valid = depth > 0
+            if not valid.any():
+                raise RuntimeError("No depth measured")
+            # Holes take the typical depth of the sand
+            depth[~valid] = np.median(depth[valid])
+            self.profile.save_baseline(np.rint(depth).astype(np.uint16))
+            self._init_thresholds()
+
+    def _init_thresholds(self):
+        # Once per scene or profile: the per-frame test is a single comparison
+        preset = _DEPTH_PRESETS[self.depth_preset]
+        base = 0
+        if preset["baseline"]:
+            if self.profile is not None and self.profile.baseline is not None:
+                base = self.profile.baseline
+            else:
+                print("No sand surface in the calibration profile, using depth 0")
+        near, far = preset["near"], preset["far"]
+        # One threshold per layer, sorted like the layers; never reached (inf,
+        # 65535) where a layer is empty
+        thresholds = base + near + (far - near) * self.scene.z
+        # Rounded up, so a raw integer depth d reveals a pixel when d >= threshold.
+        # Filtered depths are fractional and compared to the exact thresholds.
+        self.reveal_depth = np.clip(np.ceil(thresholds - 1e-6), 0, 65535).astype(
+            np.uint16
         )
+        self._reveal_depth_float = thresholds.astype(np.float32)
 
-        self.z_img = _A + (1 - _A) * self.z_img
-
-    def _init_ctx(self):
-        self.ctx = freenect.init()
-        if self.ctx is None:
-            print("Failed to initialize freenect context")
-            sys.exit(1)
-        self.num_devices = freenect.num_devices(self.ctx)
-        if self.num_devices < 1:
-            print("No devices found")
-            freenect.shutdown(self.ctx)
-            sys.exit(1)
-        self.dev = freenect.open_device(self.ctx, 0)
-        if self.dev is None:
-            print("Failed to open device")
-            freenect.shutdown(self.ctx)
-            sys.exit(1)
+    def _init_scene(self, fossils, seed=None, scene=None):
+        self.fossils = fossils
+        if scene is None:
+            scene = create_layers(
+                self.fossils,
+                sdbx_width=WIDTH,
+                sdbx_height=HEIGHT,
+                layers=self.layers,
+                seed=seed,
+            )
+        self.scene = scene
+        self.reveal = RevealCounter(self.fossils, self.scene.ids)
+        self._init_thresholds()
+        self._init_buffers()
+
+    def _init_buffers(self):
+        # Every per-frame intermediate lives here, sized once per scene
+        self._warped = np.zeros(self._process_shape, dtype=np.uint16)
+        self._upsampled = np.zeros(
+            (WIDTH, HEIGHT), dtype=np.float32 if self.smoothing else np.uint16
+        )
+        self._last_depth = None
+        # Number of layers revealed at each pixel, 0 where none is
+        self._levels = np.zeros((WIDTH, HEIGHT), dtype=np.uint8)
+        # One composite waiting, one on screen, one read by the preview encoder
+        # (see hold_latest_frame) and one drawn
+        self._frames = BufferRing((WIDTH, HEIGHT, 3), np.uint8, count=4)
+        # Incremental rendering: the levels of the previous frame, the pixels
+        # whose level changed in each of the last frames, and the frame each
+        # composite buffer was last drawn for (None until it is drawn once)
+        self._previous_levels = np.zeros((WIDTH, HEIGHT), dtype=np.uint8)
+        self._change_buffer = np.zeros(WIDTH * HEIGHT, dtype=np.int64)
+        self._changes = np.zeros(0, dtype=np.int64)
+        self._mask_number = 0
+        self._history = deque(maxlen=_CHANGE_HISTORY)
+        self._drawn = [None] * len(self._frames.buffers)
+        # Full redraws reveal, draw and count in one pass: the composite and
+        # the counts of the levels _reveal_mask returned last
+        self._revealed_image = None
+        self._counts = np.zeros(len(self.fossils), dtype=np.int64)
+        # What each number of revealed layers shows, and flat views of it
+        # and of the ids for the pixel by pixel updates, indexed by
+        # layer * pixels + pixel
+        self._images = self.scene.images()
+        self._image_pixels = _pixels(self._images)
+        self._ids = self.scene.ids.ravel()
+
+    def _init_source(self, source):
+        # Live Kinect by default, recordings and generators for dev and CI,
+        # given as sources or as open_source descriptions
+        if source is None or isinstance(source, str):
+            source = open_source(source or "kinect", self.device)
+        self.source = source
+        self.source.set_callback(self._depth_callback)
 
     def _sighandler(self, signal, frame):
         if signal in (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT):
@@ -82,70 +283,348 @@ class Game:
         signal.signal(signal.SIGTERM, self._sighandler)
         signal.signal(signal.SIGQUIT, self._sighandler)
 
-    def _display(self, image):
-        cv2.namedWindow(_WINDOW_NAME, cv2.WINDOW_NORMAL)
-        cv2.moveWindow(_WINDOW_NAME, _PROJECTOR.x, _PROJECTOR.y)
+    def _init_window(self):
+        # The window stretches whatever it is given to the projector
+        cv2.namedWindow(_WINDOW_NAME, cv2.WINDOW_NORMAL | cv2.WINDOW_FREERATIO)
+        cv2.moveWindow(_WINDOW_NAME, self.projector.x, self.projector.y)
         cv2.setWindowProperty(
             _WINDOW_NAME,
             cv2.WND_PROP_FULLSCREEN,
             cv2.WINDOW_FULLSCREEN,
         )
-        resized_image = cv2.resize(
-            image,
-            (_PROJECTOR.width, _PROJECTOR.height),
-            interpolation=cv2.INTER_AREA,
+
+    def _display(self, image):
+        cv2.imshow(_WINDOW_NAME, self._present(image))
+        if cv2.waitKey(1) & 0xFF == ord("q"):
+            self.running = False
+            self.source.stop()
+
+    def _apply_quality(self):
+        settings = self.governor.settings
+        # Taken by the processing at the next frame, or in depth remap mode
+        # once the table warping to that size is built, see _update_remap
+        scale = self.process_scale * settings["scale"]
+        self._target_shape = (round(WIDTH * scale), round(HEIGHT * scale))
+        if self.remap_mode == "frame":
+            # Depth is never interpolated, only the projected image
+            self._remap.set_interpolation(settings["interpolation"])
+
+    def _depth_callback(self, data, timestamp):
+        # Runs inside the source (libfreenect event processing for a Kinect):
+        # only hand the frame over. The buffer belongs to the source and is
+        # reused, hence the copy.
+        self.metrics.record_callback()
+        frame = self._captured.acquire(*self._depth_slot.in_use())
+        np.copyto(frame, data)
+        self._depth_slot.put(frame)
+        recorder = self.recorder
+        if recorder is not None:
+            # A copy into a free buffer, or a dropped frame: never a wait
+            recorder.record_frame(data, timestamp)
+
+    def _update_remap(self):
+        # Only rebuilds the table when the homography or the sizes changed
+        if self.remap_mode == "frame":
+            dst_size = (self.projector.width, self.projector.height)
+        else:
+            # Warped straight to the processing size
+            dst_size = self._target_shape[::-1]
+        H = self.profile.homography if self.profile is not None else None
+        self._remap.update(H, (HEIGHT, WIDTH), dst_size)
+        if self.remap_mode == "depth":
+            # The size of the table applied, the new one may still be building
+            shape = self._remap.dst_size[::-1]
+        else:
+            shape = self._target_shape
+        if shape != self._process_shape:
+            self._resize_processing(shape)
+
+    def _resize_processing(self, shape):
+        # Only when the quality level changes the processing scale
+        self._process_shape = shape
+        self._warped = np.zeros(shape, dtype=np.uint16)
+        self.depth_filter.resize(shape)
+
+    # The per-frame stages, called in order by _process_frame (and one by one
+    # by benchmark.py)
+
+    def _warp(self, data):
+        self._update_remap()
+        if self.remap_mode == "depth":
+            return self._remap.apply(data, dst=self._warped)
+        if self._process_shape != data.shape:
+            # Nearest, averaging would blend holes (0) into the depth
+            return cv2.resize(
+                data,
+                self._process_shape[::-1],
+                dst=self._warped,
+                interpolation=cv2.INTER_NEAREST,
+            )
+        return data
+
+    def _filter(self, data):
+        if not self.smoothing:
+            return data
+        return self.depth_filter.apply(data)
+
+    def _full_frame(self, changes):
+        return (
+            not self.incremental or len(changes) > _FULL_FRAME_SHARE * self._levels.size
         )
-        cv2.imshow(_WINDOW_NAME, resized_image)
-        cv2.waitKey(int(1 / _FRAME_RATE * 1000))  # wait match fps
-
-    def _depth_callback(self, dev, data, timestamp):
-        if calibration._H is not None:
-            data = cv2.warpPerspective(data, calibration._H, (data.shape[1], data.shape[0]))
-        depth_img = np.minimum(data, _MAX_DEPTH) / _MAX_DEPTH
-        depth_img = remove_flickering(depth_map=depth_img, kernel_size=11, alpha=0.5)
-        mask_z = self.z_img <= depth_img
-        new_image = np.zeros((_WIDTH, _HEIGHT, 3), dtype=np.uint8)
-        new_image[mask_z] = self.fg_img[mask_z]
-        new_image[~mask_z] = self.bg_img[~mask_z]
-
-        bones_mask = self.id_img != -1
-        bones_curr_mask = (
-            (new_image[:, :, 0] != 0)
-            & (new_image[:, :, 1] != 0)
-            & (new_image[:, :, 2] != 0)
+
+    def _reveal_mask(self, depth_img):
+        if depth_img.shape != self._levels.shape:
+            # The depth is smooth at this scale: the edges of the mask come
+            # from the full resolution fossil depth map it is compared to
+            depth_img = cv2.resize(
+                depth_img,
+                (HEIGHT, WIDTH),
+                dst=self._upsampled,
+                interpolation=cv2.INTER_LINEAR,
+            )
+        # The previous levels are kept to find the pixels that changed
+        self._levels, self._previous_levels = self._previous_levels, self._levels
+        if depth_img.dtype == np.uint16:
+            thresholds = self.reveal_depth
+        else:
+            thresholds = self._reveal_depth_float
+        self._last_depth = depth_img
+        if not self.incremental:
+            image = self._acquire_frame()
+            self._reveal_frame(
+                depth_img,
+                thresholds,
+                self._images,
+                self.scene.ids,
+                self._levels,
+                image,
+                self._counts,
+            )
+            self._revealed_image = image
+            return self._levels
+        count = self._reveal_changes(
+            depth_img,
+            thresholds,
+            self._previous_levels,
+            self._levels,
+            self._change_buffer,
         )
+        # Kept in the history: a copy, the buffer is reused by the next frame
+        self._changes = self._change_buffer[:count].copy()
+        self._mask_number += 1
+        self._history.append((self._mask_number, self._changes))
+        return self._levels
 
-        curr = new_image[:, :, 0]
-        uni_curr, count_curr = np.unique(
-            self.id_img[bones_curr_mask], return_counts=True
+    def _composite(self, levels):
+        if self._revealed_image is not None:
+            new_image, self._revealed_image = self._revealed_image, None
+            return new_image
+        new_image = self._acquire_frame()
+        i = self._frames.index(new_image)
+        changes = self._changes_since(self._drawn[i])
+        if changes is None or self._full_frame(changes):
+            self._numpy_kernels.composite(levels, self._images, new_image)
+        else:
+            # The buffer still holds the frame it was last drawn for: only the
+            # pixels whose level changed since then are redrawn
+            index = levels.ravel()[changes].astype(np.int64) * levels.size
+            pixels = np.take(self._image_pixels, index + changes)
+            np.put(_pixels(new_image), changes, pixels)
+        self._drawn[i] = self._mask_number if self.incremental else None
+        return new_image
+
+    def _changes_since(self, number):
+        """Pixels changed after the given mask, None if they are not known"""
+        if number is None or not self.incremental:
+            return None
+        if number == self._mask_number:
+            return self._changes[:0]
+        if not self._history or self._history[0][0] > number + 1:
+            return None
+        changes = [c for n, c in self._history if n > number]
+        return changes[0] if len(changes) == 1 else np.concatenate(changes)
+
+    def _count(self, levels):
+        # Incremental counts rely on _count seeing every level map _reveal_mask
+        # returns, which _process_frame guarantees
+        if not self.incremental:
+            self.seen_bones = self.reveal.set_counts(self._counts)
+            return
+        if self._full_frame(self._changes):
+            self.seen_bones = self.reveal.update(levels)
+            return
+        changes = self._changes
+        new = levels.ravel()[changes]
+        old = self._previous_levels.ravel()[changes]
+        gained, lost = [], []
+        for layer in range(self.scene.layers):
+            # A layer is revealed at a pixel when its level is above it
+            ids = self._ids[layer * levels.size + changes]
+            gained.append(ids[(old <= layer) & (new > layer)])
+            lost.append(ids[(new <= layer) & (old > layer)])
+        self.seen_bones = self.reveal.apply_changes(
+            np.concatenate(gained), np.concatenate(lost)
         )
-        uni_id, count_id = np.unique(self.id_img, return_counts=True)
 
-        self.seen_bones = 0
-        for x, cnt in zip(uni_curr, count_curr):
-            p = cnt / np.sum(self.id_img == x)
-            if p > 0.8:
-                self.seen_bones += 1
+    def _present(self, image):
+        if self.remap_mode == "frame":
+            return self._remap.apply(image, dst=self._projector_image)
+        return image
 
-        self._display(new_image)
-        if cv2.waitKey(1) & 0xFF == ord("q"):
-            self.running = False
+    def _process_frame(self, data):
+        stamps = [time.perf_counter_ns()]
+        data = self._warp(data)
+        stamps.append(time.perf_counter_ns())
+        depth_img = self._filter(data)
+        stamps.append(time.perf_counter_ns())
+        levels = self._reveal_mask(depth_img)
+        stamps.append(time.perf_counter_ns())
+        new_image = self._composite(levels)
+        stamps.append(time.perf_counter_ns())
+        seen_bones = self.seen_bones
+        self._count(levels)
+        stamps.append(time.perf_counter_ns())
+        self.metrics.record_stages(stamps)
+        if self.recorder is not None:
+            if self.seen_bones != seen_bones:
+                self._record_progress("reveal")
+            elif self.processed_frames % _RECORD_PROGRESS_FRAMES == 0:
+                self._record_progress("progress")
+        # A frame has to get through both threads within the budget
+        if self.governor.observe(max(stamps[-1] - stamps[0], self._display_cost)):
+            self._apply_quality()
+        return new_image
+
+    def _process_loop(self):
+        while self.running:
+            data = self._depth_slot.get(timeout=_STAGE_TIMEOUT)
+            if data is None:
+                continue
+            with self._scene_lock:
+                image = self._process_frame(data)
+            self._display_slot.put(image)
+            self.processed_frames += 1
 
-    def _init_callback(self):
-        freenect.set_depth_callback(self.dev, self._depth_callback)
-        freenect.set_depth_mode(self.dev, freenect.RESOLUTION_MEDIUM, freenect.DEPTH_MM)
+    def _display_loop(self):
+        self._init_window()
+        while self.running:
+            image = self._display_slot.get(timeout=_STAGE_TIMEOUT)
+            if image is None:
+                continue
+            start = time.perf_counter_ns()
+            self._display(image)
+            self._display_cost = time.perf_counter_ns() - start
+            self.displayed_frames += 1
+            self.metrics.record_display()
+
+    def _record_scene(self):
+        if self.recorder is None:
+            return
+        self.recorder.record_event(
+            "scene",
+            fossils=[fossil.name for fossil in self.fossils],
+            layers=self.scene.layers,
+            depth_preset=self.depth_preset,
+            profile=self.profile.name if self.profile is not None else None,
+        )
+        self._record_progress("progress")
+
+    def _record_progress(self, kind):
+        self.recorder.record_event(
+            kind,
+            seen_bones=self.seen_bones,
+            progress=np.round(self.reveal.progress, 4).tolist(),
+        )
+
+    def stats(self):
+        """Pipeline counters: processed/displayed frames, drops and queue depths"""
+        return {
+            "processed": self.processed_frames,
+            "displayed": self.displayed_frames,
+            "captured": self._depth_slot.put_count,
+            "dropped_capture": self._depth_slot.dropped,
+            "dropped_display": self._display_slot.dropped,
+            "depth_queue": self._depth_slot.depth(),
+            "display_queue": self._display_slot.depth(),
+        }
+
+    def status(self):
+        """Everything the operator page shows: counters, timings and reveal"""
+        return {
+            "running": self.running,
+            "seen_bones": self.seen_bones,
+            "fossils": len(self.fossils),
+            "quality_level": self.governor.level,
+            "quality_pinned": self.governor.pinned,
+            **self.stats(),
+            **(self.recorder.stats() if self.recorder is not None else {}),
+            **self.metrics.snapshot(),
+            "progress": self.progress,
+        }
+
+    def _acquire_frame(self):
+        with self._frame_lock:
+            return self._frames.acquire(*self._display_slot.in_use(), self._held_frame)
+
+    def hold_latest_frame(self):
+        """
+        The newest composite, about to be shown or on screen, which is not
+        drawn over until release_frame is called
+        """
+        with self._frame_lock:
+            waiting, shown = self._display_slot.in_use()
+            self._held_frame = waiting if waiting is not None else shown
+            return self._held_frame
+
+    def release_frame(self):
+        """Let the composite of hold_latest_frame be drawn over again"""
+        with self._frame_lock:
+            self._held_frame = None
+
+    @property
+    def progress(self):
+        """Revealed share of each fossil of the scene"""
+        return self.reveal.report()
 
     def start(self):
-        freenect.start_depth(self.dev)
+        if self.record_dir is not None:
+            self.recorder = SessionRecorder(
+                self.record_dir, (WIDTH, HEIGHT), quota_bytes=self.record_quota
+            )
+            print(f"Recording the session in {self.recorder.start()}")
+            self._record_scene()
         self.running = True
+        self._depth_slot.reopen()
+        self._display_slot.reopen()
+        self._threads = [
+            threading.Thread(target=self._process_loop, name="process", daemon=True),
+        ]
+        if self.display:
+            self._threads.append(
+                threading.Thread(target=self._display_loop, name="display", daemon=True)
+            )
+        for thread in self._threads:
+            thread.start()
+        self.source.start()
 
     def run(self):
-        while self.running:
-            freenect.process_events(self.ctx)
+        self.source.run()
+
+    def stop(self):
+        self.running = False
+        self.source.stop()
+        self._depth_slot.close()
+        self._display_slot.close()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+        if self.recorder is not None:
+            # Kept for its counters until the next start
+            self.recorder.stop()
 
     def destroy(self):
-        freenect.stop_depth(self.dev)
-        freenect.stop_video(self.dev)
-        freenect.close_device(self.dev)
-        freenect.shutdown(self.ctx)
-        cv2.destroyAllWindows()
+        self.stop()
+        self.source.close()
+        if self.display:
+            cv2.destroyAllWindows()
@@ -1,12 +1,32 @@
+import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple
 
 import cv2
 import numpy as np
 
+from texture_cache import TextureCache, default_cache, texture_key
+
+# Size, in pixels, of the cells of the coarse occupancy grid used for placement
+_PLACEMENT_CELL = 4
+# Threads decoding the textures of a cold start
+_LOAD_WORKERS = min(8, os.cpu_count() or 1)
+# Part of the texture cache key: change it when _prepare_texture cleans the
+# alpha channel differently
+_MASK_CLEANING = "median5"
+
 
 class Fossil:
-    def __init__(self, name: str, texture: np.array, depth: int, x: int, y: int):
+    def __init__(
+        self,
+        name: str,
+        texture: np.array,
+        depth: int,
+        x: int,
+        y: int,
+        mask: np.array = None,
+    ):
         """Initialize the fossil object
 
         Args
@@ -14,22 +34,30 @@ class Fossil:
         name: str
             name of the object
         texture: np.array
-            texture of the object
+            BGR texture of the object
         depth: int
             depth of the object
         x: int
             x position of the object's center in the background
         y: int
             y position of the object's center in the background
+        mask: np.array (OPTIONAL)
+            boolean mask of the opaque texels, None for an opaque texture
         """
         self.name = name
         self.x = x
         self.y = y
         self.depth = depth
         self.texture = texture
+        self.mask = mask
+        # Set once the fossil is placed by create_layers
+        self.area = 0
+        self.bbox = None
 
 
-def apply_random_rotation(texture: np.array, angle: int = None) -> np.array:
+def apply_random_rotation(
+    texture: np.array, angle: int = None, interpolation: int = cv2.INTER_LINEAR
+) -> np.array:
     """
     Apply a random rotation to the texture
 
@@ -39,6 +67,8 @@ def apply_random_rotation(texture: np.array, angle: int = None) -> np.array:
         the texture to rotate
     angle: int (OPTIONAL)
         the angle of the rotation
+    interpolation: int (OPTIONAL)
+        OpenCV interpolation flag, INTER_NEAREST for masks
 
     Returns
     -------
@@ -58,55 +88,73 @@ def apply_random_rotation(texture: np.array, angle: int = None) -> np.array:
     M[0, 2] += (new_w / 2) - (w / 2)
     M[1, 2] += (new_h / 2) - (h / 2)
 
-    rotated_image = cv2.warpAffine(texture, M, (new_w, new_h))
+    rotated_image = cv2.warpAffine(texture, M, (new_w, new_h), flags=interpolation)
     return rotated_image
 
 
-def overlay_transparent(bg: np.array, overlay: np.array, x: int, y: int) -> np.array:
+def _prepare_texture(
+    path: str, scale_factor: float, size: Tuple[int, int]
+) -> Tuple[np.array, np.array]:
     """
-    Overlay a transparent image on a background image
-
-    Args
-    ----
-    bg: np.array
-        the background image
-    overlay: np.array
-        the overlay image
-    x: int
-        top left x position of the overlay image
-    y: int
-        top left y position of the overlay image
+    Decode and resize a texture, and clean its alpha channel
 
     Returns
     -------
-    np.array
-        the background image with the overlay image
+    tuple[np.array, np.array]
+        the BGR texture and the boolean mask of its opaque texels (None for
+        an opaque image)
     """
-    # Extract the alpha mask of the RGBA image, convert to RGB
-    b, g, r, a = cv2.split(overlay)
-    overlay_color = cv2.merge((b, g, r))
-
-    # Apply some simple filtering to remove edge noise
-    mask = cv2.medianBlur(a, 5)
-
-    h, w, _ = overlay_color.shape
-    roi = bg[y : y + h, x : x + w]
-
-    # Black-out the area behind the logo in our original ROI
-    img1_bg = cv2.bitwise_and(roi, roi, mask=cv2.bitwise_not(mask))
-
-    # Mask out the logo from the logo image.
-    img2_fg = cv2.bitwise_and(overlay_color, overlay_color, mask=mask)
-
-    # Update the original image with our new ROI
-    bg[y : y + h, x : x + w] = cv2.add(img1_bg, img2_fg)
-
-    return bg
-
-
-def load_objects_texture(fossils_dict: List[Dict[str, str]]) -> List[Fossil]:
+    texture = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if texture is None:
+        raise FileNotFoundError(f"Could not read the texture {path}")
+    if texture.ndim == 2:
+        texture = cv2.cvtColor(texture, cv2.COLOR_GRAY2BGR)
+
+    if scale_factor is not None:
+        texture = cv2.resize(
+            texture,
+            (
+                int(texture.shape[1] * scale_factor),
+                int(texture.shape[0] * scale_factor),
+            ),
+        )
+    if size is not None:
+        texture = cv2.resize(texture, (size[0], size[1]))
+
+    if texture.shape[-1] != 4:
+        return texture, None
+    # Some simple filtering to remove edge noise: a texel is either fully
+    # opaque or fully transparent
+    mask = cv2.medianBlur(np.ascontiguousarray(texture[:, :, 3]), 5) > 0
+    return texture[:, :, :3], mask
+
+
+def _rotate_texture(
+    texture: np.array, mask: np.array, angle: int
+) -> Tuple[np.array, np.array]:
+    """Rotate a prepared texture and its opaque mask (None for opaque ones)"""
+    texture = apply_random_rotation(texture, angle=angle)
+    if mask is not None:
+        # Nearest texels: the cleaned mask stays all or nothing
+        mask = apply_random_rotation(
+            mask.view(np.uint8), angle=angle, interpolation=cv2.INTER_NEAREST
+        ).view(bool)
+    return texture, mask
+
+
+def load_objects_texture(
+    fossils_dict: List[Dict[str, str]],
+    cache: TextureCache = None,
+    rng: np.random.Generator = None,
+) -> List[Fossil]:
     """Load the objects texture from the objects folder
 
+    Decoded and resized textures are kept in a cache keyed by the content of
+    the image and the preprocessing parameters, so a texture is only decoded
+    again when the image or its parameters change; the rotation, drawn anew
+    at every load, is applied to the cached texture. The textures are loaded
+    in parallel.
+
     Args
     ----
     fossils_dict: list[dict[str, str]]
@@ -117,47 +165,233 @@ def load_objects_texture(fossils_dict: List[Dict[str, str]]) -> List[Fossil]:
             "scale_factor": float,      (OPTIONAL)
             "size": tuple[int, int]     (OPTIONAL)
             "rotation": int             (OPTIONAL)
+            "depth": float              (OPTIONAL, 0 to 1, random by default)
         }
-    min_depth: int
-        min depth of each fossil
-    max_depth: int
-        max depth of each fossil
+    cache: TextureCache (OPTIONAL)
+        the texture cache, the process-wide one by default
+    rng: np.random.Generator (OPTIONAL)
+        draws the rotations and depths, seed it for a reproducible scene
     """
-    fossils = []
-    for fossil in fossils_dict:
-        # Load params
-        path, name = fossil["path"], fossil["name"]
-
-        # Load (and resize) the texture
-        texture = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-
-        scale_factor = fossil.get("scale_factor", None)
-        if scale_factor is not None:
-            texture = cv2.resize(
-                texture,
-                (
-                    int(texture.shape[1] * scale_factor),
-                    int(texture.shape[0] * scale_factor),
-                ),
-            )
-        size = fossil.get("size")
-        if size is not None:
-            texture = cv2.resize(texture, (size[0], size[1]))
+    cache = cache if cache is not None else default_cache
+    rng = rng if rng is not None else np.random.default_rng()
 
+    # Random draws stay sequential, in the same order as the fossils, so a
+    # seeded load does not depend on the thread scheduling
+    jobs = []
+    for fossil in fossils_dict:
         rotation = fossil.get("rotation")
-        texture = apply_random_rotation(texture, angle=rotation)
-        depth = np.random.random()
+        angle = rotation if rotation is not None else int(rng.integers(0, 361))
+        params = {
+            "scale_factor": fossil.get("scale_factor", None),
+            "size": fossil.get("size"),
+            "mask": _MASK_CLEANING,
+        }
+        # Drawn even when given, so the other draws do not depend on it
+        depth = rng.random()
+        if fossil.get("depth") is not None:
+            depth = float(fossil["depth"])
+        jobs.append((fossil, params, angle, depth))
+
+    def load(job):
+        fossil, params, angle, _ = job
+        path = fossil["path"]
+        texture, mask = cache.get(
+            texture_key(path, **params),
+            lambda: _prepare_texture(path, params["scale_factor"], params["size"]),
+        )
+        return _rotate_texture(texture, mask, angle)
+
+    with ThreadPoolExecutor(max_workers=_LOAD_WORKERS) as pool:
+        textures = list(pool.map(load, jobs))
 
-        f = Fossil(name=name, x=-1, y=-1, depth=depth, texture=texture)
+    fossils = []
+    for (fossil, _, _, depth), (texture, mask) in zip(jobs, textures):
+        f = Fossil(
+            name=fossil["name"], x=-1, y=-1, depth=depth, texture=texture, mask=mask
+        )
         fossils.append(f)
     return fossils
 
 
-def create_textures(
-    fossils: List[Fossil], sdbx_width: int, sdbx_height: int
-) -> Tuple[np.array, np.array, np.array, np.array]:
+class OccupancyGrid:
+    def __init__(self, height: int, width: int, cell: int = 1, capacity: int = 1):
+        """Initialize an empty occupancy map of the sand box
+
+        The map is kept at a resolution of one count per `cell` x `cell`
+        pixels, and a summed-area table of the full cells answers "is this
+        rectangle free" in O(1) for every position at once.
+
+        Args
+        ----
+        height: int
+            height of the sand box, in pixels
+        width: int
+            width of the sand box, in pixels
+        cell: int (OPTIONAL)
+            size of a cell of the map, in pixels
+        capacity: int (OPTIONAL)
+            number of textures a cell can hold, one per layer of the scene
+        """
+        self.height = height
+        self.width = width
+        self.cell = cell
+        self.capacity = capacity
+        self.occupied = np.zeros(
+            (-(-height // cell), -(-width // cell)), dtype=np.uint8
+        )
+        self._sat = None
+
+    def mark(self, top: int, left: int, opaque: np.array) -> None:
+        """
+        Mark the cells covered by the opaque pixels of a placed texture
+
+        Args
+        ----
+        top: int
+            top row of the texture, in pixels
+        left: int
+            left column of the texture, in pixels
+        opaque: np.array
+            boolean mask of the opaque pixels of the texture
+        """
+        c = self.cell
+        h, w = opaque.shape
+        # Pad the mask to whole cells, then reduce each cell to one flag
+        pad_top, pad_left = top % c, left % c
+        rows = -(-(pad_top + h) // c)
+        cols = -(-(pad_left + w) // c)
+        padded = np.zeros((rows * c, cols * c), dtype=bool)
+        padded[pad_top : pad_top + h, pad_left : pad_left + w] = opaque
+        cells = padded.reshape(rows, c, cols, c).any(axis=(1, 3))
+        r0, c0 = top // c, left // c
+        region = self.occupied[r0 : r0 + rows, c0 : c0 + cols]
+        cells = cells[: region.shape[0], : region.shape[1]]
+        np.minimum(region + cells, self.capacity, out=region)
+        self._sat = None
+
+    def sample(self, h: int, w: int, rng: np.random.Generator) -> Tuple[int, int]:
+        """
+        Draw a random top-left position where a h x w rectangle only covers
+        cells that are not full
+
+        Args
+        ----
+        h: int
+            height of the rectangle, in pixels
+        w: int
+            width of the rectangle, in pixels
+        rng: np.random.Generator
+            the random generator to draw with
+
+        Returns
+        -------
+        tuple[int, int]
+            (top, left) position in pixels, or None if the rectangle fits
+            nowhere
+        """
+        c = self.cell
+        if c > 1:
+            # Only cell-aligned positions, which must also fit in the sand box
+            rows, cols = -(-h // c), -(-w // c)
+            max_top, max_left = (self.height - h) // c, (self.width - w) // c
+        else:
+            rows, cols = h, w
+            max_top, max_left = self.height - h, self.width - w
+        if max_top < 0 or max_left < 0:
+            return None
+
+        if self._sat is None:
+            full = (self.occupied >= self.capacity).view(np.uint8)
+            self._sat = cv2.integral(full)
+        sat = self._sat
+        n, m = max_top + 1, max_left + 1
+        # Number of full cells under the rectangle, for every position
+        covered = (
+            sat[rows : rows + n, cols : cols + m]
+            - sat[:n, cols : cols + m]
+            - sat[rows : rows + n, :m]
+            + sat[:n, :m]
+        )
+        free = np.flatnonzero(covered == 0)
+        if len(free) == 0:
+            return None
+        top, left = divmod(int(free[rng.integers(len(free))]), m)
+        return top * c, left * c
+
+
+def _opaque_mask(fossil: Fossil) -> np.array:
+    if fossil.mask is None:
+        return np.ones(fossil.texture.shape[:2], dtype=bool)
+    return fossil.mask
+
+
+class SceneLayers:
+    def __init__(
+        self,
+        background: np.array,
+        z: np.array,
+        ids: np.array,
+        texels: np.array,
+        palette: np.array,
+        images: np.array = None,
+    ):
+        """The placed fossils, stacked in a few layers sorted by depth
+
+        Every pixel holds up to `layers` fossils, the shallowest in layer 0.
+        When the sand is dug down to the k-th layer of a pixel, the pixel shows
+        texels[k]: the background for k = 0, the texel of layer k - 1 otherwise.
+
+        Args
+        ----
+        background: np.array
+            BGR image shown where nothing is revealed
+        z: np.array
+            float32 (layers, ...) burial depth of each layer, 0 to 1, sorted
+            along the first axis, inf where a layer is empty
+        ids: np.array
+            int64 (layers, ...) fossil index of each layer, -1 where empty
+        texels: np.array
+            int32 (layers + 1, ...) index in the palette of the color shown
+            when each number of layers is revealed
+        palette: np.array
+            uint8 (n, 3) BGR colors: the background pixels, then the fossil
+            textures in the order of the fossils
+        images: np.array (OPTIONAL)
+            the expanded images, see images, when they were saved
+        """
+        self.background = background
+        self.z = z
+        self.ids = ids
+        self.texels = texels
+        self.palette = palette
+        self._images = images
+
+    @property
+    def layers(self) -> int:
+        return len(self.z)
+
+    def images(self) -> np.array:
+        """BGR image shown for each number of revealed layers, expanded once
+        so that drawing a frame does not go through the palette"""
+        if self._images is None:
+            self._images = np.take(self.palette, self.texels, axis=0)
+        return self._images
+
+
+def create_layers(
+    fossils: List[Fossil],
+    sdbx_width: int,
+    sdbx_height: int,
+    layers: int = 1,
+    seed: int = None,
+) -> SceneLayers:
     """
-    Create the initial background, the texture background and the depth background
+    Place the fossils and stack them in layers
+
+    Fossils are placed at random positions where their bounding box does not
+    cover any pixel already holding `layers` opaque fossil pixels, so fossils
+    overlap each other when there is more than one layer. The fossils that
+    fit nowhere are left unplaced (bbox None) and reported.
 
     Args
     ----
@@ -167,84 +401,139 @@ def create_textures(
         the width of the background
     sdbx_height: int
         the height of the background
+    layers: int (OPTIONAL)
+        most fossils stacked over a pixel, 1 to keep them side by side
+    seed: int (OPTIONAL)
+        seed of the placement, for a reproducible scene
 
     Returns
     -------
-    tuple[np.array, np.array, np.array]
-        the initial background, the texture background and the depth background
+    SceneLayers
+        the scene, with only as many layers as the fossils actually use
+    """
+    rng = np.random.default_rng(seed)
+    positions = []
+    # Positions are drawn on a coarse grid first, and only checked pixel by
+    # pixel when the coarse grid has no room left
+    coarse = OccupancyGrid(
+        sdbx_height, sdbx_width, cell=_PLACEMENT_CELL, capacity=layers
+    )
+    fine = OccupancyGrid(sdbx_height, sdbx_width, capacity=layers)
+    unplaced = []
+    for f in fossils:
+        theight, twidth = f.texture.shape[:2]
+        position = coarse.sample(theight, twidth, rng)
+        if position is None:
+            position = fine.sample(theight, twidth, rng)
+        positions.append(position)
+        if position is None:
+            unplaced.append(f.name)
+            continue
+        top, left = position
+        f.y = top + theight // 2 + theight % 2
+        f.x = left + twidth // 2 + twidth % 2
+
+        # Only opaque texels belong to the fossil: a later fossil may use the
+        # transparent padding of this one's bounding box
+        opaque = _opaque_mask(f)
+        coarse.mark(top, left, opaque)
+        fine.mark(top, left, opaque)
+
+        f.area = int(np.count_nonzero(opaque))
+        # (row_start, row_end, col_start, col_end) in the returned,
+        # transposed images
+        f.bbox = (left, left + twidth, top, top + theight)
+    if unplaced:
+        print(f"No room left in the sand box for: {', '.join(unplaced)}")
+
+    scene = stack_fossils(fossils, positions, sdbx_height, sdbx_width, layers)
+    # Swap width and height of each layer (copied so the per-frame path works
+    # on C-contiguous arrays, not strided views)
+    return SceneLayers(
+        np.ascontiguousarray(np.transpose(scene.background, (1, 0, 2))),
+        np.ascontiguousarray(np.transpose(scene.z, (0, 2, 1))),
+        np.ascontiguousarray(np.transpose(scene.ids, (0, 2, 1))),
+        np.ascontiguousarray(np.transpose(scene.texels, (0, 2, 1))),
+        scene.palette,
+    )
+
+
+def stack_fossils(
+    fossils: List[Fossil],
+    positions: List[Tuple[int, int]],
+    height: int,
+    width: int,
+    layers: int,
+) -> SceneLayers:
     """
+    Stack placed fossils in layers sorted by depth
 
-    init_bg = np.full((sdbx_height, sdbx_width, 3), 0, dtype=np.uint8)
-    depth_bg = np.full((sdbx_height, sdbx_width), -1, dtype=np.float32)
-    id_bg = np.full((sdbx_height, sdbx_width), -1, dtype=int)
-    texture_bg = init_bg.copy()
-    for i, f in enumerate(fossils):
+    The fossils are drawn from the shallowest to the deepest, each opaque
+    texel going to the first empty layer of its pixel, so the layers of every
+    pixel end up sorted by depth. Regions running past the edges of the sand
+    box are clipped.
+
+    Args
+    ----
+    fossils: list[Fossil]
+        the fossils, whose index is written in the id layers
+    positions: list[tuple[int, int]]
+        (top, left) position of each fossil, None for an unplaced fossil
+    height: int
+        height of the sand box, in pixels
+    width: int
+        width of the sand box, in pixels
+    layers: int
+        most fossils over a pixel, see create_layers
+
+    Returns
+    -------
+    SceneLayers
+        the scene, trimmed to the layers in use
+    """
+    background = np.zeros((height, width, 3), dtype=np.uint8)
+    z = np.full((layers, height, width), np.inf, dtype=np.float32)
+    ids = np.full((layers, height, width), -1, dtype=np.int64)
+    # The background pixels come first in the palette, so that texels[0] is
+    # the identity
+    pixels = np.arange(height * width, dtype=np.int32).reshape(height, width)
+    texels = np.repeat(pixels[None], layers + 1, axis=0)
+    # Placed or not, every texture has its slot in the palette
+    colors = [background.reshape(-1, 3)] + [f.texture.reshape(-1, 3) for f in fossils]
+    starts = np.cumsum([len(c) for c in colors])
+    filled = np.zeros((height, width), dtype=np.int64)
+
+    order = sorted(range(len(fossils)), key=lambda i: fossils[i].depth)
+    for i in order:
+        f, position, start = fossils[i], positions[i], starts[i]
         theight, twidth = f.texture.shape[:2]
-        half_theight = theight // 2 + theight % 2
-        half_twidth = twidth // 2 + twidth % 2
-        min_y = half_theight
-        max_y = sdbx_height - half_theight
-        min_x = half_twidth
-        max_x = sdbx_width - half_twidth
-        print("sH", sdbx_height)
-        print("sw", sdbx_width)
-        print("th", theight)
-        print("tw", twidth)
-
-        if max_x - min_x < theight or max_y - min_y < twidth:
+        if position is None:
+            continue
+        top, left = position
+        r0, r1 = max(top, 0), min(top + theight, height)
+        c0, c1 = max(left, 0), min(left + twidth, width)
+        if r0 >= r1 or c0 >= c1:
             continue
-        randomize_count = 0
-        while randomize_count < 10:
-            y = random.randint(min_y, max_y)
-            x = random.randint(min_x, max_x)
-
-            if np.all(
-                texture_bg[
-                    y - half_theight : y + half_theight,
-                    x - half_twidth : x + half_twidth,
-                ]
-                == 0
-            ):
-                f.y = y
-                f.x = x
-
-                if f.texture.shape[-1] != 4:
-                    texture_bg[
-                        y - half_theight : y + half_theight,
-                        x - half_twidth : x + half_twidth :,
-                    ] = f.texture
-                else:
-                    texture_bg = overlay_transparent(
-                        texture_bg, f.texture, x=x - half_twidth, y=y - half_theight
-                    )
-
-                depth_bg[
-                    y - half_theight : y + half_theight,
-                    x - half_twidth : x + half_twidth,
-                ] = f.depth
-                print(
-                    "y - half_theight",
-                    y - half_theight,
-                    "y - half_theight",
-                    y + half_theight,
-                )
-                print(
-                    "x - half_theight",
-                    x - half_twidth,
-                    "x + half_theight",
-                    x + half_twidth,
-                )
-                print(f.texture.shape)
-                id_bg[
-                    y - half_theight : y + half_theight,
-                    x - half_twidth : x + half_twidth,
-                ] = i
-                break
-            randomize_count += 1
-
-    # Swap width and height of each bg
-    init_bg = np.transpose(init_bg, (1, 0, 2))
-    texture_bg = np.transpose(texture_bg, (1, 0, 2))
-    depth_bg = np.transpose(depth_bg)
-    id_bg = np.transpose(id_bg)
-    return init_bg, texture_bg, depth_bg, id_bg
+        src = (slice(r0 - top, r1 - top), slice(c0 - left, c1 - left))
+        dst = (slice(r0, r1), slice(c0, c1))
+
+        opaque = _opaque_mask(f)[src]
+        rows, cols = np.nonzero(opaque)
+        texel = start + (rows + r0 - top) * twidth + cols + c0 - left
+        rows += r0
+        cols += c0
+        layer = filled[rows, cols]
+        z[layer, rows, cols] = f.depth
+        ids[layer, rows, cols] = i
+        texels[layer + 1, rows, cols] = texel
+        filled[dst] += opaque
+
+    # Only the layers some pixel uses are compared every frame
+    used = max(int(filled.max()), 1)
+    return SceneLayers(
+        background,
+        z[:used],
+        ids[:used],
+        texels[: used + 1],
+        np.concatenate(colors),
+    )
@@ -0,0 +1,158 @@
+import cv2
+import numpy as np
+
+try:
+    import reveal_kernel
+except ImportError:  # Not built: the NumPy versions below give the same output
+    reveal_kernel = None
+
+# "auto" picks the compiled kernels when they are built
+_KERNEL = "auto"
+
+
+class NumpyKernels:
+    """The reveal kernels in NumPy, with the scratch buffers they reuse
+
+    The buffers are sized on the first frame of a scene and kept while the
+    frame shape and the scene stay the same: a frame allocates nothing the size
+    of the frame.
+    """
+
+    def __init__(self):
+        self._shape = None
+        self._ids = None
+
+    def _scratch(self, levels):
+        if levels.shape != self._shape:
+            self._shape = levels.shape
+            # Per-pixel test results
+            self._mask = np.zeros(levels.shape, dtype=bool)
+        return self._mask
+
+    def reveal_levels(self, depth, thresholds, levels):
+        """Number of layers revealed at each pixel, in the uint8 levels output"""
+        mask = self._scratch(levels)
+        # The layers of a pixel are sorted by depth: the revealed ones come first
+        np.greater_equal(depth, thresholds[0], out=levels.view(bool))
+        for layer in thresholds[1:]:
+            np.greater_equal(depth, layer, out=mask)
+            np.add(levels, mask.view(np.uint8), out=levels)
+
+    def composite(self, levels, images, image):
+        """Draw the deepest revealed layer of each pixel, see SceneLayers.images"""
+        mask = self._scratch(levels)
+        np.copyto(image, images[0])
+        # Deeper layers drawn last, over the shallower ones
+        cv2.copyTo(images[1], levels, image)
+        for level in range(2, len(images)):
+            np.greater_equal(levels, level, out=mask)
+            cv2.copyTo(images[level], mask.view(np.uint8), image)
+
+    def reveal_frame(self, depth, thresholds, images, ids, levels, image, counts):
+        """
+        Reveal a whole frame: levels, composite and revealed pixels of each fossil
+
+        Args
+        ----
+        depth: np.array
+            uint16 or float32 depth, in mm
+        thresholds: np.array
+            reveal depths of the layers of the pixels, of the same type as depth
+        images: np.array
+            BGR image shown for each number of revealed layers
+        ids: np.array
+            int64 fossil id of the layers of the pixels, -1 where empty
+        levels: np.array
+            uint8 output, number of layers revealed at each pixel
+        image: np.array
+            BGR output, the composite
+        counts: np.array
+            int64 output, revealed pixels of each fossil
+        """
+        self.reveal_levels(depth, thresholds, levels)
+        self.composite(levels, images, image)
+        levels = levels.ravel()
+        counts[:] = 0
+        for layer, (pixels, labels, level, mask, key) in enumerate(self._layers(ids)):
+            # Only the pixels the layer covers: their level, whether it reveals
+            # the layer, and then their fossil id + 1 where it does, 0 elsewhere
+            np.take(levels, pixels, out=level, mode="clip")
+            np.greater(level, layer, out=mask)
+            np.copyto(key, mask)
+            np.multiply(key, labels, out=key)
+            counts += np.bincount(key, minlength=len(counts) + 1)[1:]
+
+    def _layers(self, ids):
+        # Once per scene: the pixels covered by each layer, their fossil ids
+        # + 1, and the per-frame buffers of their size
+        if ids is not self._ids:
+            self._ids = ids
+            self._covered = []
+            for layer_ids in ids.reshape(len(ids), -1):
+                pixels = np.flatnonzero(layer_ids >= 0)
+                self._covered.append(
+                    (
+                        pixels,
+                        layer_ids[pixels] + 1,
+                        np.zeros(len(pixels), dtype=np.uint8),
+                        np.zeros(len(pixels), dtype=bool),
+                        np.zeros(len(pixels), dtype=np.int64),
+                    )
+                )
+        return self._covered
+
+    def reveal_changes(self, depth, thresholds, previous, levels, changes):
+        """
+        Reveal levels of a frame and the pixels that changed since the previous
+        one
+
+        Args
+        ----
+        depth: np.array
+            uint16 or float32 depth, in mm
+        thresholds: np.array
+            reveal depths of the layers of the pixels, of the same type as depth
+        previous: np.array
+            uint8 levels of the previous frame
+        levels: np.array
+            uint8 output, number of layers revealed at each pixel
+        changes: np.array
+            int64 output, filled with the flat indices of the changed pixels
+
+        Returns
+        -------
+        int
+            the number of changed pixels, at the start of changes
+        """
+        self.reveal_levels(depth, thresholds, levels)
+        mask = self._scratch(levels).ravel()
+        np.not_equal(levels.ravel(), previous.ravel(), out=mask)
+        changed = np.flatnonzero(mask)
+        changes[: len(changed)] = changed
+        return len(changed)
+
+
+def select(name: str = _KERNEL):
+    """
+    Reveal kernels by name
+
+    Args
+    ----
+    name: str (OPTIONAL)
+        "compiled", "numpy", or "auto" for compiled when it is built
+
+    Returns
+    -------
+    tuple[str, Callable, Callable]
+        the name of the kernels picked, reveal_frame and reveal_changes
+    """
+    if name == "auto":
+        name = "compiled" if reveal_kernel is not None else "numpy"
+    if name == "compiled":
+        if reveal_kernel is None:
+            raise ValueError("The compiled reveal kernel is not built")
+        return name, reveal_kernel.reveal_frame, reveal_kernel.reveal_changes
+    if name == "numpy":
+        kernels = NumpyKernels()
+        return name, kernels.reveal_frame, kernels.reveal_changes
+    raise ValueError(f"Unknown kernel {name}, expected auto, compiled or numpy")
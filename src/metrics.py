@@ -0,0 +1,160 @@
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+
+# Number of samples kept per series, about 4 s of frames at 60 fps
+_HISTORY = 256
+STAGES = ["warp", "filter", "mask", "composite", "count", "total"]
+# "0" turns the recording of samples off, the status then reports no timings
+_ENABLED = os.environ.get("FOSSILHUNT_METRICS", "1") != "0"
+
+
+class RingBuffer:
+    def __init__(self, size: int = _HISTORY):
+        """Fixed-size history of float samples, overwritten oldest first
+
+        Args
+        ----
+        size: int (OPTIONAL)
+            number of samples kept
+        """
+        self._data = np.zeros(size, dtype=np.float64)
+        self._index = 0
+        self.count = 0
+
+    def push(self, value: float) -> None:
+        self._data[self._index] = value
+        self._index = (self._index + 1) % len(self._data)
+        self.count += 1
+
+    def values(self) -> np.array:
+        """Copy of the kept samples, oldest first"""
+        if self.count < len(self._data):
+            return self._data[: self.count].copy()
+        return np.roll(self._data, -self._index)
+
+
+def _summary(values: np.array) -> Dict[str, float]:
+    if len(values) == 0:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "max": float(values.max())}
+
+
+class Metrics:
+    def __init__(self, size: int = _HISTORY, enabled: bool = _ENABLED):
+        """Hot-path instrumentation of the game
+
+        Recording a sample is an array store in a ring buffer; every
+        aggregation is left to `snapshot`, which runs on the reader's side.
+
+        Args
+        ----
+        size: int (OPTIONAL)
+            number of samples kept per series
+        enabled: bool (OPTIONAL)
+            record samples, FOSSILHUNT_METRICS=0 turns it off by default
+        """
+        self.enabled = enabled
+        self.stages = {stage: RingBuffer(size) for stage in STAGES}
+        self.processed = RingBuffer(size)
+        self.displayed = RingBuffer(size)
+        self.callbacks = RingBuffer(size)
+
+    def record_stages(self, stamps: List[int]) -> None:
+        """
+        Record the times of one processed frame
+
+        Args
+        ----
+        stamps: list[int]
+            perf_counter_ns before the first stage and after each stage
+        """
+        if not self.enabled:
+            return
+        for i, stage in enumerate(STAGES[:-1]):
+            self.stages[stage].push(stamps[i + 1] - stamps[i])
+        self.stages["total"].push(stamps[-1] - stamps[0])
+        self.processed.push(stamps[-1])
+
+    def record_callback(self) -> None:
+        if self.enabled:
+            self.callbacks.push(time.perf_counter_ns())
+
+    def record_display(self) -> None:
+        if self.enabled:
+            self.displayed.push(time.perf_counter_ns())
+
+    @staticmethod
+    def _rate(stamps: np.array) -> float:
+        if len(stamps) < 2 or stamps[-1] == stamps[0]:
+            return 0.0
+        return (len(stamps) - 1) * 1e9 / (stamps[-1] - stamps[0])
+
+    def snapshot(self) -> dict:
+        """
+        Aggregate the kept samples
+
+        Returns
+        -------
+        dict
+            stage latencies (ms), processing/display/capture fps and callback
+            jitter (standard deviation of the capture intervals, ms)
+        """
+        intervals = np.diff(self.callbacks.values()) / 1e6
+        return {
+            "stages_ms": {
+                stage: _summary(ring.values() / 1e6)
+                for stage, ring in self.stages.items()
+            },
+            "process_fps": self._rate(self.processed.values()),
+            "display_fps": self._rate(self.displayed.values()),
+            "capture_fps": self._rate(self.callbacks.values()),
+            "callback_jitter_ms": float(intervals.std()) if len(intervals) else 0.0,
+        }
+
+
+def to_prometheus(status: dict, prefix: str = "fossilhunt", labels: dict = None) -> str:
+    """
+    Render a game status as Prometheus text exposition format
+
+    Args
+    ----
+    status: dict
+        the status returned by Game.status
+    prefix: str (OPTIONAL)
+        prefix of every metric name
+    labels: dict (OPTIONAL)
+        labels added to every sample, such as the sandbox of the game
+
+    Returns
+    -------
+    str
+        one line per sample
+    """
+    # Leading the labels of every sample, each followed by a comma
+    common = "".join(
+        '{}="{}",'.format(key, str(value).replace('"', "'"))
+        for key, value in (labels or {}).items()
+    )
+    only = f"{{{common[:-1]}}}" if common else ""
+    lines = []
+    for key, value in status.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f"{prefix}_{key}{only} {value}")
+    for stage, summary in status.get("stages_ms", {}).items():
+        for stat, value in summary.items():
+            lines.append(
+                f'{prefix}_stage_ms{{{common}stage="{stage}",stat="{stat}"}} {value:.4f}'
+            )
+    for i, fossil in enumerate(status.get("progress", [])):
+        name = fossil["name"].replace('"', "'")
+        lines.append(
+            f'{prefix}_fossil_progress{{{common}id="{i}",name="{name}"}}'
+            f' {fossil["progress"]:.4f}'
+        )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,133 @@
+import threading
+
+import numpy as np
+
+
+class FrameSlot:
+    """Single-slot mailbox between two pipeline stages.
+
+    The slot only ever holds the newest frame: a producer never waits, and
+    putting a frame while the previous one is still unread replaces it and
+    counts it as dropped.
+    """
+
+    def __init__(self, name: str):
+        """Initialize the slot
+
+        Args
+        ----
+        name: str
+            name of the slot, used when reporting counters
+        """
+        self.name = name
+        self.put_count = 0
+        self.dropped = 0
+        self._frame = None
+        self._taken = None
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, frame) -> None:
+        """
+        Store a frame in the slot, replacing (and dropping) any unread one
+
+        Args
+        ----
+        frame: Any
+            the frame to hand over to the next stage
+        """
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.put_count += 1
+            self._cond.notify()
+
+    def get(self, timeout: float = None):
+        """
+        Take the newest frame out of the slot
+
+        Args
+        ----
+        timeout: float (OPTIONAL)
+            maximum time to wait for a frame, in seconds
+
+        Returns
+        -------
+        Any
+            the newest frame, or None on timeout or once the slot is closed
+        """
+        with self._cond:
+            if self._frame is None and not self._closed:
+                self._cond.wait(timeout)
+            frame, self._frame = self._frame, None
+            if frame is not None:
+                self._taken = frame
+            return frame
+
+    def in_use(self) -> tuple:
+        """The frame waiting in the slot and the last one handed to the consumer"""
+        with self._cond:
+            return self._frame, self._taken
+
+    def depth(self) -> int:
+        """Number of frames currently waiting in the slot (0 or 1)"""
+        return 0 if self._frame is None else 1
+
+    def close(self) -> None:
+        """Wake up any waiting consumer, further gets return immediately"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self) -> None:
+        """Reset the slot so it can be used again after a close"""
+        with self._cond:
+            self._closed = False
+            self._frame = None
+            self._taken = None
+
+
+class BufferRing:
+    def __init__(self, shape: tuple, dtype, count: int = 3):
+        """Initialize a fixed set of preallocated frame buffers
+
+        With one buffer waiting in a slot and one held by the consumer, three
+        buffers are enough for the producer to always find a free one.
+
+        Args
+        ----
+        shape: tuple
+            shape of each buffer
+        dtype: np.dtype
+            type of each buffer
+        count: int (OPTIONAL)
+            number of buffers
+        """
+        self.buffers = [np.zeros(shape, dtype=dtype) for _ in range(count)]
+
+    def acquire(self, *busy) -> np.array:
+        """
+        Pick a buffer that is not one of the busy ones
+
+        Args
+        ----
+        busy: np.array
+            buffers still in use downstream (None entries are ignored)
+
+        Returns
+        -------
+        np.array
+            a buffer the producer can overwrite
+        """
+        for buffer in self.buffers:
+            if all(buffer is not other for other in busy):
+                return buffer
+        raise RuntimeError("No free buffer in the ring")
+
+    def index(self, buffer: np.array) -> int:
+        """Position of a buffer of the ring"""
+        for i, other in enumerate(self.buffers):
+            if other is buffer:
+                return i
+        raise ValueError("The buffer is not part of the ring")
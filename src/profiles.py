@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+from screeninfo import Monitor
+
+from storage import atomic_save
+
+# Where the profiles are saved, one directory per profile
+_PROFILES_DIR = os.environ.get("FOSSILHUNT_PROFILES_DIR", "profiles")
+# Bumped whenever the layout of a profile directory changes
+_PROFILE_VERSION = 1
+_PROJECTOR_FIELDS = ("name", "x", "y", "width", "height")
+
+
+def _homography_key(H: np.array) -> str:
+    return "none" if H is None else hashlib.sha1(H.tobytes()).hexdigest()[:16]
+
+
+def projector_geometry(monitor) -> dict:
+    """Position, size and name of a screeninfo monitor, as saved in a profile"""
+    return {field: getattr(monitor, field) for field in _PROJECTOR_FIELDS}
+
+
+class CalibrationProfile:
+    def __init__(
+        self,
+        path: str,
+        homography: np.array,
+        projector: dict = None,
+        baseline: np.array = None,
+    ):
+        """A saved calibration: homography, projector and derived lookup tables
+
+        Profiles are directories holding .npy files, so the per-pixel lookup
+        tables derived from the homography are memory-mapped rather than
+        rebuilt at every start. A profile is the `store` of the RemapTable of
+        the game using it.
+
+        Args
+        ----
+        path: str
+            directory of the profile
+        homography: np.array
+            3x3 homography from Kinect space to the sandbox, or None
+        projector: dict (OPTIONAL)
+            projector geometry, see projector_geometry
+        baseline: np.array (OPTIONAL)
+            uint16 depth of the levelled sand, in mm, in the space the game
+            compares depths in
+        """
+        self.path = path
+        self.homography = homography
+        self.projector = projector
+        self.baseline = baseline
+
+    def save_baseline(self, baseline: np.array) -> None:
+        """Save the depth of the levelled sand, see the baseline depth preset"""
+        path = os.path.join(self.path, "baseline.npy")
+        atomic_save(path, lambda f: np.save(f, baseline))
+        self.baseline = np.load(path, mmap_mode="r")
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    def monitor(self) -> Optional[Monitor]:
+        """The projector as a screeninfo monitor, None if not saved"""
+        if self.projector is None:
+            return None
+        return Monitor(**self.projector)
+
+    def _table_path(
+        self,
+        H: np.array,
+        src_size: Tuple[int, int],
+        dst_size: Tuple[int, int],
+        interpolation: int,
+        name: str,
+    ) -> str:
+        # Keyed by the homography too: a table never outlives its homography
+        (sw, sh), (dw, dh) = src_size, dst_size
+        key = f"{_homography_key(H)}-{sw}x{sh}-{dw}x{dh}-{interpolation}"
+        return os.path.join(self.path, "tables", f"{key}.{name}.npy")
+
+    def load_maps(self, H, src_size, dst_size, interpolation) -> Optional[tuple]:
+        """
+        Load saved remap tables, memory-mapped
+
+        Args
+        ----
+        H: np.array
+            homography the tables were built from, or None
+        src_size: tuple[int, int]
+            (width, height) of the source image
+        dst_size: tuple[int, int]
+            (width, height) of the destination image
+        interpolation: int
+            OpenCV interpolation flag the tables were built for
+
+        Returns
+        -------
+        tuple[np.array, np.array]
+            the two cv2.remap maps, None if they were never saved
+        """
+        paths = [
+            self._table_path(H, src_size, dst_size, interpolation, name)
+            for name in ("map1", "map2")
+        ]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return tuple(np.load(path, mmap_mode="r") for path in paths)
+
+    def save_maps(self, H, src_size, dst_size, interpolation, maps) -> None:
+        """Save remap tables built for this profile, see load_maps"""
+        os.makedirs(os.path.join(self.path, "tables"), exist_ok=True)
+        for name, array in zip(("map1", "map2"), maps):
+            if array is None:
+                # No fractional map with nearest interpolation
+                array = np.zeros(0, dtype=np.uint16)
+            path = self._table_path(H, src_size, dst_size, interpolation, name)
+            atomic_save(path, lambda f: np.save(f, array))
+
+
+def profile_path(name: str, profiles_dir: str = None) -> str:
+    return os.path.join(profiles_dir or _PROFILES_DIR, name)
+
+
+def save_profile(
+    name: str, homography: np.array, projector=None, profiles_dir: str = None
+) -> CalibrationProfile:
+    """
+    Save a calibration as a named profile, replacing any previous one
+
+    Args
+    ----
+    name: str
+        name of the profile
+    homography: np.array
+        3x3 homography from Kinect space to the sandbox, or None
+    projector: Monitor | dict (OPTIONAL)
+        the projector screen, or its geometry
+    profiles_dir: str (OPTIONAL)
+        directory of the profiles
+
+    Returns
+    -------
+    CalibrationProfile
+        the saved profile
+    """
+    path = profile_path(name, profiles_dir)
+    os.makedirs(path, exist_ok=True)
+    if projector is not None and not isinstance(projector, dict):
+        projector = projector_geometry(projector)
+
+    h_path = os.path.join(path, "homography.npy")
+    if homography is None:
+        if os.path.exists(h_path):
+            os.remove(h_path)
+    else:
+        homography = np.array(homography, dtype=np.float64)
+        atomic_save(h_path, lambda f: np.save(f, homography))
+    # The sand surface and the tables of the previous homography are stale
+    if os.path.exists(os.path.join(path, "baseline.npy")):
+        os.remove(os.path.join(path, "baseline.npy"))
+    tables = os.path.join(path, "tables")
+    if os.path.isdir(tables):
+        current = _homography_key(homography) + "-"
+        for table in os.listdir(tables):
+            if not table.startswith(current):
+                os.remove(os.path.join(tables, table))
+    # Saved last: it is what marks the directory as a complete profile
+    description = {
+        "version": _PROFILE_VERSION,
+        "saved_at": time.time(),
+        "projector": projector,
+    }
+    atomic_save(
+        os.path.join(path, "profile.json"),
+        lambda f: f.write(json.dumps(description, indent=2).encode("utf-8")),
+    )
+    return CalibrationProfile(path, homography, projector)
+
+
+def load_profile(name: str, profiles_dir: str = None) -> CalibrationProfile:
+    """
+    Load a profile
+
+    Args
+    ----
+    name: str
+        name of the profile, or path of its directory
+    profiles_dir: str (OPTIONAL)
+        directory of the profiles
+
+    Returns
+    -------
+    CalibrationProfile
+        the profile, raises FileNotFoundError if it does not exist
+    """
+    path = name if os.sep in name else profile_path(name, profiles_dir)
+    with open(os.path.join(path, "profile.json"), "r") as f:
+        description = json.load(f)
+    if description.get("version") != _PROFILE_VERSION:
+        raise ValueError(
+            f"Profile {path} has version {description.get('version')},"
+            f" expected {_PROFILE_VERSION}: calibrate again"
+        )
+    h_path = os.path.join(path, "homography.npy")
+    homography = np.load(h_path) if os.path.exists(h_path) else None
+    b_path = os.path.join(path, "baseline.npy")
+    baseline = np.load(b_path, mmap_mode="r") if os.path.exists(b_path) else None
+    return CalibrationProfile(path, homography, description.get("projector"), baseline)
@@ -0,0 +1,208 @@
+import threading
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+
+def _same_homography(H, other) -> bool:
+    if H is None or other is None:
+        return H is None and other is None
+    return np.array_equal(H, other)
+
+
+def _same_inputs(inputs: tuple, other: tuple) -> bool:
+    return _same_homography(inputs[0], other[0]) and inputs[1:] == other[1:]
+
+
+class RemapTable:
+    def __init__(self, interpolation: int = cv2.INTER_NEAREST, background=False):
+        """Initialize an empty lookup table
+
+        The table folds a homography and a rescaling into a single
+        `cv2.remap`, stored in OpenCV's fixed-point format. It is only rebuilt
+        by `update` when one of its inputs changes.
+
+        Args
+        ----
+        interpolation: int (OPTIONAL)
+            OpenCV interpolation flag used when applying the table
+        background: bool (OPTIONAL)
+            once a first table is built, build the next ones in a thread: the
+            current table is applied until `update` swaps the new one in
+        """
+        self.interpolation = interpolation
+        # Where built tables are saved and loaded back (a CalibrationProfile)
+        self.store = None
+        self.background = background
+        self.identity = True
+        self.version = 0
+        self._maps = None
+        self._H = None
+        self._src_size = None
+        self._dst_size = None
+        # Inputs (H, src_size, dst_size, interpolation) of the table wanted,
+        # of the table being built in the background, and that table once
+        # built, with its maps
+        self._wanted = (None, None, None, interpolation)
+        self._building = None
+        self._built = None
+
+    @property
+    def dst_size(self) -> Tuple[int, int]:
+        """(width, height) of the images the table currently produces"""
+        return self._dst_size
+
+    def update(
+        self, H: np.array, src_size: Tuple[int, int], dst_size: Tuple[int, int]
+    ) -> bool:
+        """
+        Rebuild the table if the homography or one of the sizes changed
+
+        Args
+        ----
+        H: np.array
+            3x3 homography from the source image to a destination image of the
+            same size, or None for no warp
+        src_size: tuple[int, int]
+            (width, height) of the source image
+        dst_size: tuple[int, int]
+            (width, height) of the destination image
+
+        Returns
+        -------
+        bool
+            whether another table is now applied
+        """
+        wanted_H, _, _, interpolation = self._wanted
+        if not _same_homography(H, wanted_H):
+            wanted_H = None if H is None else np.array(H, dtype=np.float64)
+        self._wanted = (wanted_H, src_size, dst_size, interpolation)
+        return self._refresh()
+
+    def set_interpolation(self, interpolation: int) -> None:
+        """
+        Change the interpolation, rebuilding the table if there is one
+
+        Args
+        ----
+        interpolation: int
+            OpenCV interpolation flag used when applying the table
+        """
+        H, src_size, dst_size, _ = self._wanted
+        self._wanted = (H, src_size, dst_size, interpolation)
+        if self.version == 0:
+            self.interpolation = interpolation
+            return
+        self._refresh()
+
+    def _installed(self) -> tuple:
+        return self._H, self._src_size, self._dst_size, self.interpolation
+
+    def _refresh(self) -> bool:
+        # Read before the built table: the builder stores its table, then
+        # clears _building
+        building = self._building
+        built, swapped = self._built, False
+        if built is not None:
+            self._built = None
+            self._install(*built)
+            swapped = True
+        wanted = self._wanted
+        if self.version > 0 and _same_inputs(wanted, self._installed()):
+            return swapped
+        if self.background and self.version > 0:
+            if building is None:
+                self._building = wanted
+                threading.Thread(
+                    target=self._build_background,
+                    args=(wanted,),
+                    name="remap",
+                    daemon=True,
+                ).start()
+            return swapped
+        self._install(wanted, self._build(wanted))
+        return True
+
+    def _build_background(self, inputs: tuple) -> None:
+        # Loading, computing and saving the table all happen here, off the
+        # thread applying the current one
+        self._built = (inputs, self._build(inputs))
+        self._building = None
+
+    def _build(self, inputs: tuple):
+        H, src_size, dst_size, interpolation = inputs
+        if H is None and src_size == dst_size:
+            return None
+        store = self.store
+        maps = None
+        if store is not None:
+            maps = store.load_maps(H, src_size, dst_size, interpolation)
+        if maps is None:
+            maps = self._compute(H, src_size, dst_size, interpolation)
+            if store is not None:
+                store.save_maps(H, src_size, dst_size, interpolation, maps)
+        return maps
+
+    def _install(self, inputs: tuple, maps) -> None:
+        self.version += 1
+        self._H, self._src_size, self._dst_size, self.interpolation = inputs
+        self.identity = maps is None
+        # Swapped in one assignment: the table may be applied from another
+        # thread while it is rebuilt
+        self._maps = None if maps is None else (*maps, self.interpolation)
+
+    @staticmethod
+    def _compute(H, src_size, dst_size, interpolation):
+        src_w, src_h = src_size
+        dst_w, dst_h = dst_size
+        # Pixel centers map to pixel centers: x_dst + 0.5 = s * (x_src + 0.5)
+        sx, sy = dst_w / src_w, dst_h / src_h
+        scale = np.array(
+            [[sx, 0.0, (sx - 1) / 2], [0.0, sy, (sy - 1) / 2], [0.0, 0.0, 1.0]]
+        )
+        M = scale if H is None else scale @ H
+        inv = np.linalg.inv(M)
+
+        xs, ys = np.meshgrid(
+            np.arange(dst_w, dtype=np.float64), np.arange(dst_h, dtype=np.float64)
+        )
+        den = inv[2, 0] * xs + inv[2, 1] * ys + inv[2, 2]
+        map_x = ((inv[0, 0] * xs + inv[0, 1] * ys + inv[0, 2]) / den).astype(np.float32)
+        map_y = ((inv[1, 0] * xs + inv[1, 1] * ys + inv[1, 2]) / den).astype(np.float32)
+        return cv2.convertMaps(
+            map_x,
+            map_y,
+            cv2.CV_16SC2,
+            nninterpolation=interpolation == cv2.INTER_NEAREST,
+        )
+
+    def apply(self, src: np.array, dst: np.array = None) -> np.array:
+        """
+        Resample an image through the table
+
+        Args
+        ----
+        src: np.array
+            the source image, of the size given to `update`
+        dst: np.array (OPTIONAL)
+            preallocated destination image
+
+        Returns
+        -------
+        np.array
+            the resampled image (src itself when the table is the identity)
+        """
+        maps = self._maps
+        if maps is None:
+            return src
+        map1, map2, interpolation = maps
+        return cv2.remap(
+            src,
+            map1,
+            map2 if map2 is not None and map2.size else None,
+            interpolation,
+            dst=dst,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
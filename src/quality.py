@@ -0,0 +1,125 @@
+from typing import Iterable, Set
+
+import cv2
+import numpy as np
+
+# From best to cheapest:
+#   interpolation: of the projector resize, when the composite is remapped
+#   scale: of the depth processing, relative to the scale the game was given
+QUALITY_LEVELS = [
+    {"name": "high", "interpolation": cv2.INTER_LINEAR, "scale": 1.0},
+    {"name": "medium", "interpolation": cv2.INTER_NEAREST, "scale": 1.0},
+    {"name": "low", "interpolation": cv2.INTER_NEAREST, "scale": 0.75},
+    {"name": "minimal", "interpolation": cv2.INTER_NEAREST, "scale": 0.5},
+]
+# Frames measured before each decision
+_WINDOW = 30
+# Share of the frame budget above which quality steps down, and below which
+# it steps up again
+_OVERRUN = 0.9
+_HEADROOM = 0.5
+# Quality only steps up after this many windows in a row with headroom
+_STEP_UP_WINDOWS = 4
+
+
+def quality_level(name: str) -> int:
+    """Index of a quality level from its name"""
+    for i, level in enumerate(QUALITY_LEVELS):
+        if level["name"] == name:
+            return i
+    names = ", ".join(level["name"] for level in QUALITY_LEVELS)
+    raise ValueError(f"Unknown quality {name}, expected auto or one of {names}")
+
+
+def redundant_levels(settings: Iterable[str]) -> Set[int]:
+    """
+    Levels that change none of the given settings from the level above them
+
+    Args
+    ----
+    settings: Iterable[str]
+        the keys of QUALITY_LEVELS that have an effect
+
+    Returns
+    -------
+    set[int]
+        indices of the levels the governor can skip
+    """
+    settings = list(settings)
+    return {
+        i
+        for i in range(1, len(QUALITY_LEVELS))
+        if all(QUALITY_LEVELS[i][key] == QUALITY_LEVELS[i - 1][key] for key in settings)
+    }
+
+
+class QualityGovernor:
+    def __init__(self, budget_ms: float, quality: str = "auto", skip=()):
+        """Pick the quality level that keeps the frames within their budget
+
+        Frame costs are collected over windows of frames. When the 90th
+        percentile of a window overruns the budget, quality steps down one
+        level right away; it only steps back up after several windows in a
+        row well under the budget, so the level does not flap between two
+        neighbours.
+
+        Args
+        ----
+        budget_ms: float
+            time available per frame, in milliseconds
+        quality: str (OPTIONAL)
+            "auto", or the name of a level to pin
+        skip: Iterable[int] (OPTIONAL)
+            levels stepped over, see redundant_levels
+        """
+        self.budget_ns = budget_ms * 1e6
+        self.pinned = quality != "auto"
+        self.level = quality_level(quality) if self.pinned else 0
+        self._levels = [i for i in range(len(QUALITY_LEVELS)) if i not in set(skip)]
+        self._costs = np.zeros(_WINDOW, dtype=np.float64)
+        self._count = 0
+        self._calm_windows = 0
+
+    @property
+    def settings(self) -> dict:
+        return QUALITY_LEVELS[self.level]
+
+    def observe(self, cost_ns: int) -> bool:
+        """
+        Record the cost of a frame
+
+        Args
+        ----
+        cost_ns: int
+            time spent on the frame, in nanoseconds
+
+        Returns
+        -------
+        bool
+            whether the quality level changed
+        """
+        if self.pinned:
+            return False
+        self._costs[self._count] = cost_ns
+        self._count += 1
+        if self._count < _WINDOW:
+            return False
+        self._count = 0
+
+        cost = np.percentile(self._costs, 90)
+        if cost > _OVERRUN * self.budget_ns:
+            self._calm_windows = 0
+            lower = [i for i in self._levels if i > self.level]
+            if lower:
+                self.level = lower[0]
+                return True
+        elif cost < _HEADROOM * self.budget_ns:
+            self._calm_windows += 1
+            higher = [i for i in self._levels if i < self.level]
+            if self._calm_windows >= _STEP_UP_WINDOWS and higher:
+                self._calm_windows = 0
+                self.level = higher[-1]
+                return True
+        else:
+            self._calm_windows = 0
+        return False
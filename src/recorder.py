@@ -0,0 +1,446 @@
+"""Background recording of play sessions: raw depth frames and reveal events.
+
+Recording is opted into per host (FOSSILHUNT_RECORD_DIR) to tune the reveal
+thresholds on real sessions and replay them (`replay:<session directory>`).
+The frame path only copies each depth frame into a free preallocated buffer
+and queues it; a writer thread compresses and saves it. When the disk falls
+behind, no buffer is free and the frame is dropped and counted, never waited
+for.
+
+Every start of a game records a session, a directory of the recordings root:
+
+    session.json          frame shape and dtype, start time
+    chunk-000000.depth    compressed frames, back to back
+    chunk-000000.index    one record per frame (_INDEX): where it is in .depth
+    events.jsonl          scene and reveal events, one JSON object per line
+
+Frames are stored as their low then high byte planes, compressed with zlib:
+the high bytes of millimeter depths barely change and compress away. The
+writer starts a new chunk every `chunk_frames` frames, and removes the oldest
+chunks of the root once its chunks and event files take more than its quota.
+"""
+
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+# Frames waiting for the writer: 2 s of Kinect frames, 600 kB each
+_QUEUE_FRAMES = 60
+# Events waiting for the writer, on top of the frames
+_QUEUE_EVENTS = 256
+# Frames of a chunk, 30 s at 30 fps
+_CHUNK_FRAMES = 900
+# Size of the recordings root above which the oldest chunks are removed
+QUOTA_BYTES = 20 * 1024**3
+# zlib level: 1 keeps up with 30 fps on one core, higher levels barely help
+_LEVEL = 1
+_SESSION_FILE = "session.json"
+_EVENTS_FILE = "events.jsonl"
+# Where each frame is: its number in the stream (dropped frames leave gaps),
+# the source timestamp, the wall time of the capture, and its bytes in the
+# chunk's .depth file
+_INDEX = np.dtype(
+    [
+        ("number", "<i8"),
+        ("timestamp", "<f8"),
+        ("time", "<f8"),
+        ("offset", "<i8"),
+        ("size", "<i8"),
+    ]
+)
+
+
+def _chunk_paths(session: str, chunk: int) -> Tuple[str, str]:
+    base = os.path.join(session, f"chunk-{chunk:06d}")
+    return base + ".depth", base + ".index"
+
+
+def _closed_chunks(root: str) -> List[Tuple[Tuple[str, ...], int]]:
+    """
+    Files of the sessions of a root, chunk by chunk, oldest first
+
+    Returns
+    -------
+    list[tuple[tuple[str, ...], int]]
+        the files of each chunk (depth and index) and their size; the events
+        of a session go with its last chunk, or alone when it has none
+    """
+    chunks = []
+    for name in sorted(os.listdir(root)):
+        session = os.path.join(root, name)
+        if not os.path.isdir(session):
+            continue
+        files = []
+        for file_name in sorted(os.listdir(session)):
+            if file_name.endswith(".depth"):
+                depth = os.path.join(session, file_name)
+                files.append([depth, depth[: -len(".depth")] + ".index"])
+        events = os.path.join(session, _EVENTS_FILE)
+        if os.path.exists(events):
+            if files:
+                files[-1].append(events)
+            else:
+                files.append([events])
+        for paths in files:
+            size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+            chunks.append((tuple(paths), size))
+    return chunks
+
+
+def _compress(frame: np.array, planes: np.array, level: int) -> bytes:
+    np.copyto(planes, frame.view(np.uint8).reshape(-1, 2).T)
+    return zlib.compress(planes, level)
+
+
+def _decompress(data: bytes, frame: np.array) -> np.array:
+    planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    frame.view(np.uint8).reshape(-1, 2)[:] = planes.T
+    return frame
+
+
+class SessionRecorder:
+    def __init__(
+        self,
+        root: str,
+        frame_shape: Tuple[int, int] = (480, 640),
+        queue_frames: int = _QUEUE_FRAMES,
+        chunk_frames: int = _CHUNK_FRAMES,
+        quota_bytes: int = QUOTA_BYTES,
+        level: int = _LEVEL,
+    ):
+        """Records depth frames and events to disk from a background thread
+
+        Args
+        ----
+        root: str
+            recordings root, each session is a new directory of it
+        frame_shape: tuple[int, int] (OPTIONAL)
+            shape of the uint16 depth frames
+        queue_frames: int (OPTIONAL)
+            frames that may wait for the writer before new ones are dropped
+        chunk_frames: int (OPTIONAL)
+            frames of a chunk file
+        quota_bytes: int (OPTIONAL)
+            most bytes of chunks kept in the root, older sessions included
+        level: int (OPTIONAL)
+            zlib compression level
+        """
+        self.root = root
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_frames = chunk_frames
+        self.quota_bytes = quota_bytes
+        self.level = level
+        self.path = None
+        self.frames = 0
+        self.recorded = 0
+        # Dropped for want of a free buffer, and by the writer (quota, errors):
+        # each counter has a single thread writing it
+        self.dropped = 0
+        self._skipped = 0
+        self.dropped_events = 0
+        self._skipped_events = 0
+        self.errors = 0
+        self.bytes_written = 0
+        # Buffers the writer is not using, taken by record_frame. Filled, so
+        # that their pages are mapped before the first frame is copied
+        self._free = deque(
+            np.full(self.frame_shape, 0, dtype=np.uint16) for _ in range(queue_frames)
+        )
+        self._queue = queue.Queue(maxsize=queue_frames + _QUEUE_EVENTS)
+        self._thread = None
+        self._chunk = -1
+        self._chunk_count = 0
+        self._depth_file = None
+        self._index_file = None
+        self._events_file = None
+        # Files the writer may remove for the quota, a chunk at a time, oldest
+        # first; the events of the running session are counted but kept
+        self._closed = deque()
+        self._root_bytes = 0
+
+    def start(self) -> str:
+        """Open a new session and start the writer
+
+        Returns
+        -------
+        str
+            directory of the session
+        """
+        os.makedirs(self.root, exist_ok=True)
+        self._closed = deque(_closed_chunks(self.root))
+        self._root_bytes = sum(size for _, size in self._closed)
+        name = time.strftime("%Y%m%d-%H%M%S")
+        path, suffix = os.path.join(self.root, name), 1
+        while os.path.exists(path):
+            path = os.path.join(self.root, f"{name}-{suffix}")
+            suffix += 1
+        os.makedirs(path)
+        self.path = path
+        with open(os.path.join(path, _SESSION_FILE), "w") as f:
+            json.dump(
+                {
+                    "shape": list(self.frame_shape),
+                    "dtype": "<u2",
+                    "started_at": time.time(),
+                    "chunk_frames": self.chunk_frames,
+                },
+                f,
+                indent=2,
+            )
+        self._events_file = open(os.path.join(path, _EVENTS_FILE), "a")
+        self._thread = threading.Thread(
+            target=self._write_loop, name="recorder", daemon=True
+        )
+        self._thread.start()
+        return path
+
+    def record_frame(self, frame: np.array, timestamp: float) -> bool:
+        """
+        Queue a copy of a depth frame, without ever waiting for the disk
+
+        Args
+        ----
+        frame: np.array
+            uint16 depth frame, may be reused once this returns
+        timestamp: float
+            timestamp given by the source
+
+        Returns
+        -------
+        bool
+            False if the frame was dropped
+        """
+        if self._thread is None:
+            return False
+        number = self.frames
+        self.frames += 1
+        try:
+            buffer = self._free.popleft()
+        except IndexError:
+            self.dropped += 1
+            return False
+        np.copyto(buffer, frame)
+        try:
+            self._queue.put_nowait(("frame", number, timestamp, time.time(), buffer))
+        except queue.Full:
+            self._free.append(buffer)
+            self.dropped += 1
+            return False
+        return True
+
+    def record_event(self, kind: str, **fields) -> bool:
+        """
+        Queue an event, saved as a JSON line with its kind, time and the
+        number of the last frame recorded before it
+
+        Returns
+        -------
+        bool
+            False if the event was dropped
+        """
+        if self._thread is None:
+            return False
+        event = {"type": kind, "time": time.time(), "frame": self.frames - 1}
+        event.update(fields)
+        try:
+            self._queue.put_nowait(("event", event))
+        except queue.Full:
+            self.dropped_events += 1
+            return False
+        return True
+
+    def stop(self) -> None:
+        """Write what is queued, then close the session"""
+        if self._thread is None:
+            return
+        thread, self._thread = self._thread, None
+        # Blocks the caller, not the frame path: the game is stopping
+        self._queue.put(None)
+        thread.join()
+        # Frames of a source still running when the writer stopped
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None and item[0] == "frame":
+                self._free.append(item[-1])
+        self._close_chunk()
+        self._events_file.close()
+        self._events_file = None
+
+    def stats(self) -> dict:
+        """Recorded and dropped frames, and frames waiting for the writer"""
+        return {
+            "recorded": self.recorded,
+            "dropped_record": self.dropped + self._skipped,
+            "dropped_events": self.dropped_events + self._skipped_events,
+            "record_queue": self._queue.qsize(),
+            "record_errors": self.errors,
+            "record_bytes": self.bytes_written,
+        }
+
+    def _write_loop(self) -> None:
+        planes = np.zeros((2, int(np.prod(self.frame_shape))), dtype=np.uint8)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                if item[0] == "event":
+                    self._write_event(item[1])
+                    continue
+                _, number, timestamp, wall_time, buffer = item
+                try:
+                    # zlib releases the GIL: the game threads keep running
+                    data = _compress(buffer, planes, self.level)
+                finally:
+                    self._free.append(buffer)
+                self._write_frame(data, number, timestamp, wall_time)
+            except OSError as e:
+                # Full or missing disk: lose this item, keep the game going
+                self.errors += 1
+                if item[0] == "frame":
+                    self._skipped += 1
+                else:
+                    self._skipped_events += 1
+                if self.errors == 1:
+                    print(f"Recording to {self.path} failed: {e}")
+
+    def _write_event(self, event: dict) -> None:
+        line = json.dumps(event) + "\n"
+        size = len(line.encode("utf-8"))
+        if not self._fit(size):
+            self._skipped_events += 1
+            return
+        self._events_file.write(line)
+        self._events_file.flush()
+        self._root_bytes += size
+        self.bytes_written += size
+
+    def _write_frame(self, data: bytes, number: int, timestamp, wall_time) -> None:
+        if self._depth_file is None or self._chunk_count >= self.chunk_frames:
+            self._open_chunk()
+        record = np.zeros(1, dtype=_INDEX)
+        if not self._fit(len(data) + record.nbytes):
+            self._skipped += 1
+            return
+        record[0] = (number, timestamp, wall_time, self._depth_file.tell(), len(data))
+        self._depth_file.write(data)
+        self._index_file.write(record.tobytes())
+        self._chunk_count += 1
+        self._root_bytes += len(data) + record.nbytes
+        self.bytes_written += len(data) + record.nbytes
+        self.recorded += 1
+
+    def _fit(self, size: int) -> bool:
+        # Only closed chunks are removed: the open one stays consistent
+        while self._root_bytes + size > self.quota_bytes and self._closed:
+            files, chunk_size = self._closed.popleft()
+            for path in files:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._root_bytes -= chunk_size
+            session = os.path.dirname(files[0])
+            if session != self.path and not any(
+                name.endswith(".depth") for name in os.listdir(session)
+            ):
+                shutil.rmtree(session)
+        return self._root_bytes + size <= self.quota_bytes
+
+    def _open_chunk(self) -> None:
+        self._close_chunk()
+        self._chunk += 1
+        self._chunk_count = 0
+        depth, index = _chunk_paths(self.path, self._chunk)
+        self._depth_file = open(depth, "wb")
+        self._index_file = open(index, "wb")
+
+    def _close_chunk(self) -> None:
+        if self._depth_file is None:
+            return
+        size = self._depth_file.tell() + self._index_file.tell()
+        self._depth_file.close()
+        self._index_file.close()
+        self._closed.append(((self._depth_file.name, self._index_file.name), size))
+        self._depth_file = self._index_file = None
+
+
+class RecordedSession:
+    def __init__(self, path: str):
+        """A session saved by SessionRecorder, read frame by frame
+
+        Frames whose bytes were not all written (the recording was killed)
+        are left out.
+
+        Args
+        ----
+        path: str
+            directory of the session
+        """
+        self.path = path
+        with open(os.path.join(path, _SESSION_FILE), "r") as f:
+            description = json.load(f)
+        self.frame_shape = tuple(description["shape"])
+        self.dtype = np.dtype(description["dtype"])
+        chunks, indexes = [], []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".index"):
+                continue
+            depth = os.path.join(path, name[: -len(".index")] + ".depth")
+            if not os.path.exists(depth):
+                continue
+            with open(os.path.join(path, name), "rb") as f:
+                raw = f.read()
+            index = np.frombuffer(
+                raw[: len(raw) // _INDEX.itemsize * _INDEX.itemsize], dtype=_INDEX
+            )
+            index = index[index["offset"] + index["size"] <= os.path.getsize(depth)]
+            chunks.append(np.full(len(index), len(indexes), dtype=np.int64))
+            indexes.append((depth, index))
+        self._depths = [depth for depth, _ in indexes]
+        self.index = (
+            np.concatenate([index for _, index in indexes])
+            if indexes
+            else np.zeros(0, dtype=_INDEX)
+        )
+        self._chunks = np.concatenate(chunks) if chunks else np.zeros(0, np.int64)
+        # Seconds since the first frame kept, at the pace of the capture
+        self.timestamps = (
+            self.index["time"] - self.index["time"][0] if len(self.index) else None
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i: int, out: np.array = None) -> np.array:
+        """Frame i of the session, read from its chunk"""
+        record = self.index[i]
+        with open(self._depths[self._chunks[i]], "rb") as f:
+            f.seek(int(record["offset"]))
+            data = f.read(int(record["size"]))
+        if out is None:
+            out = np.empty(self.frame_shape, dtype=self.dtype)
+        return _decompress(data, out)
+
+    def __iter__(self) -> Iterator[np.array]:
+        frame = np.empty(self.frame_shape, dtype=self.dtype)
+        for chunk, depth in enumerate(self._depths):
+            records = self.index[self._chunks == chunk]
+            with open(depth, "rb") as f:
+                for record in records:
+                    f.seek(int(record["offset"]))
+                    yield _decompress(f.read(int(record["size"])), frame)
+
+    def events(self) -> List[dict]:
+        """Events of the session, in the order they were recorded"""
+        path = os.path.join(self.path, _EVENTS_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,141 @@
+from typing import List
+
+import numpy as np
+
+from config import REVEAL_THRESHOLD
+from init_ressources import Fossil
+
+
+class RevealCounter:
+    def __init__(
+        self,
+        fossils: List[Fossil],
+        ids: np.array,
+        threshold: float = REVEAL_THRESHOLD,
+    ):
+        """Initialize the per-fossil reveal accounting
+
+        Everything that does not change during a game (which pixels belong to
+        which fossil, and how many opaque pixels each fossil has) is computed
+        here once, so that `update` is a single gather and segmented sum over
+        the fossil pixels.
+
+        Args
+        ----
+        fossils: list[Fossil]
+            the fossils of the scene, as placed by create_layers
+        ids: np.array
+            the id layers of the scene (-1 outside of fossils), see
+            SceneLayers, or a single id map
+        threshold: float (OPTIONAL)
+            revealed share above which a fossil counts as seen
+        """
+        self.threshold = threshold
+        self.names = [f.name for f in fossils]
+        self.areas = np.array([f.area for f in fossils], dtype=np.int64)
+        ids = ids.reshape(-1, ids.shape[-2] * ids.shape[-1])
+        # Flat indices of the opaque fossil pixels and their layer, grouped
+        # fossil by fossil (and in raster order inside each fossil's bounding
+        # box): a pixel is revealed down to a layer when its level is above it
+        layer, index = np.nonzero(ids >= 0)
+        ids = ids[layer, index]
+        order = np.argsort(ids, kind="stable")
+        self._index = index[order]
+        self._layer = layer[order].astype(np.uint8)
+        self._present = np.unique(ids)
+        starts = np.searchsorted(ids[order], self._present)
+        ends = np.append(starts[1:], len(index))
+        # The gathered mask is summed as uint8 (an int64 sum would copy it),
+        # in chunks of at most 255 pixels so that no chunk sum overflows
+        chunks = [np.arange(start, end, 255) for start, end in zip(starts, ends)]
+        self._chunk_starts = np.concatenate(chunks) if chunks else np.zeros(0, int)
+        self._fossil_chunks = np.cumsum([0] + [len(c) for c in chunks[:-1]])
+        # Per-frame buffers, so that `update` does not allocate
+        self._gathered = np.zeros(len(self._index), dtype=np.uint8)
+        self._chunks = np.zeros(len(self._chunk_starts), dtype=np.uint8)
+        self._counts = np.zeros(len(self._present), dtype=np.int64)
+        self.revealed = np.zeros(len(fossils), dtype=np.int64)
+        self.progress = np.zeros(len(fossils), dtype=np.float64)
+        self.seen_bones = 0
+
+    def update(self, levels: np.array) -> int:
+        """
+        Recount the revealed pixels of every fossil
+
+        Args
+        ----
+        levels: np.array
+            uint8 number of layers revealed at each pixel, or a boolean map
+            of the pixels where the single layer is visible
+
+        Returns
+        -------
+        int
+            the number of fossils revealed above the threshold
+        """
+        if len(self._index) == 0:
+            return 0
+        # mode="clip" lets take write straight into `out` (the indices are valid)
+        np.take(
+            levels.view(np.uint8).ravel(), self._index, out=self._gathered, mode="clip"
+        )
+        np.greater(self._gathered, self._layer, out=self._gathered.view(bool))
+        np.add.reduceat(
+            self._gathered, self._chunk_starts, dtype=np.uint8, out=self._chunks
+        )
+        np.add.reduceat(
+            self._chunks, self._fossil_chunks, dtype=np.int64, out=self._counts
+        )
+        self.revealed[self._present] = self._counts
+        return self._update_progress()
+
+    def set_counts(self, counts: np.array) -> int:
+        """
+        Take revealed pixel counts computed elsewhere (see kernels.py)
+
+        Args
+        ----
+        counts: np.array
+            revealed pixels of each fossil
+
+        Returns
+        -------
+        int
+            the number of fossils revealed above the threshold
+        """
+        self.revealed[:] = counts
+        return self._update_progress()
+
+    def apply_changes(self, gained: np.array, lost: np.array) -> int:
+        """
+        Update the counts from the pixels that changed since the last update
+
+        Args
+        ----
+        gained: np.array
+            id map values of the pixels revealed since the last update
+        lost: np.array
+            id map values of the pixels covered again since the last update
+
+        Returns
+        -------
+        int
+            the number of fossils revealed above the threshold
+        """
+        n = len(self.revealed)
+        # Shifted by one, so the background (-1) lands in a dropped bin
+        self.revealed += np.bincount(gained + 1, minlength=n + 1)[1:]
+        self.revealed -= np.bincount(lost + 1, minlength=n + 1)[1:]
+        return self._update_progress()
+
+    def _update_progress(self) -> int:
+        np.divide(self.revealed, self.areas, out=self.progress, where=self.areas > 0)
+        self.seen_bones = int(np.count_nonzero(self.progress > self.threshold))
+        return self.seen_bones
+
+    def report(self) -> List[dict]:
+        """Per-fossil progress, as a list of dicts"""
+        return [
+            {"name": name, "area": int(area), "progress": float(progress)}
+            for name, area, progress in zip(self.names, self.areas, self.progress)
+        ]
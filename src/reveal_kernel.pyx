@@ -0,0 +1,91 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+# distutils: extra_compile_args = -O3
+"""Compiled per-pixel reveal steps, each fused into a single call
+
+Built with `cythonize -i reveal_kernel.pyx` (see the Dockerfile). kernels.py
+falls back to NumPy, with identical output, when the module is not built.
+"""
+
+from libc.stdint cimport int64_t, uint8_t, uint16_t, uint64_t
+from libc.string cimport memcmp, memcpy
+
+ctypedef fused depth_t:
+    uint16_t
+    float
+
+
+cdef inline void _reveal_levels(
+    depth_t* d, depth_t[:, :, ::1] thresholds, uint8_t* m, Py_ssize_t size
+) noexcept nogil:
+    # Branchless and layer by layer, so the compiler vectorizes it. The layers
+    # of a pixel are sorted by depth: the revealed ones come first.
+    cdef Py_ssize_t i, layer
+    cdef depth_t* t = &thresholds[0, 0, 0]
+    for i in range(size):
+        m[i] = d[i] >= t[i]
+    for layer in range(1, thresholds.shape[0]):
+        t = &thresholds[layer, 0, 0]
+        for i in range(size):
+            m[i] += d[i] >= t[i]
+
+
+def reveal_frame(
+    depth_t[:, ::1] depth,
+    depth_t[:, :, ::1] thresholds,
+    const uint8_t[:, :, :, ::1] images,
+    const int64_t[:, :, ::1] ids,
+    uint8_t[:, ::1] levels,
+    uint8_t[:, :, ::1] image,
+    int64_t[::1] counts,
+):
+    cdef Py_ssize_t size = depth.shape[0] * depth.shape[1]
+    cdef Py_ssize_t i, j, layer, n = counts.shape[0]
+    cdef int64_t k
+    cdef uint64_t word
+    cdef uint8_t* m = &levels[0, 0]
+    cdef const int64_t* f = &ids[0, 0, 0]
+    cdef const uint8_t* src = &images[0, 0, 0, 0]
+    cdef uint8_t* dst = &image[0, 0, 0]
+    with nogil:
+        counts[:] = 0
+        _reveal_levels(&depth[0, 0], thresholds, m, size)
+        memcpy(dst, src, size * 3)
+        # Only the pixels where something is revealed are drawn and counted,
+        # found 8 at a time
+        for i in range(0, size, 8):
+            if i + 8 <= size:
+                memcpy(&word, m + i, 8)
+                if word == 0:
+                    continue
+            for j in range(i, min(i + 8, size)):
+                if m[j] == 0:
+                    continue
+                memcpy(dst + 3 * j, src + 3 * (m[j] * size + j), 3)
+                for layer in range(m[j]):
+                    k = f[layer * size + j]
+                    if 0 <= k < n:
+                        counts[k] += 1
+
+
+def reveal_changes(
+    depth_t[:, ::1] depth,
+    depth_t[:, :, ::1] thresholds,
+    const uint8_t[:, ::1] previous,
+    uint8_t[:, ::1] levels,
+    int64_t[::1] changes,
+):
+    cdef Py_ssize_t size = depth.shape[0] * depth.shape[1]
+    cdef Py_ssize_t i, j, count = 0
+    cdef uint8_t* m = &levels[0, 0]
+    cdef const uint8_t* p = &previous[0, 0]
+    with nogil:
+        _reveal_levels(&depth[0, 0], thresholds, m, size)
+        # Few pixels change between frames: compare 8 of them at a time
+        for i in range(0, size, 8):
+            if i + 8 <= size and memcmp(m + i, p + i, 8) == 0:
+                continue
+            for j in range(i, min(i + 8, size)):
+                if m[j] != p[j]:
+                    changes[count] = j
+                    count += 1
+    return count
@@ -0,0 +1,108 @@
+"""Sandboxes driven by this host, each with its own game process.
+
+A museum with several sandboxes runs them from one PC: every sandbox pairs a
+Kinect with a projector screen, a calibration profile and a scene, and its
+game runs in its own worker process pinned to its own CPUs. The sandboxes are
+described in a JSON file (FOSSILHUNT_SANDBOXES), a list of objects:
+
+    [
+        {"name": "Bac 1", "device": 0, "screen": "HDMI-1", "profile": "bac1"},
+        {"name": "Bac 2", "device": 1, "screen": "HDMI-2", "profile": "bac2",
+         "cpus": [4, 5, 6, 7]},
+        {"name": "Démo", "source": "replay:recordings/demo.npz"}
+    ]
+
+Without the file, the host runs a single sandbox on the first Kinect.
+"""
+
+import json
+import os
+from typing import List
+
+# Description of the sandboxes of the host
+_SANDBOXES_FILE = os.environ.get("FOSSILHUNT_SANDBOXES", "sandboxes.json")
+_DEFAULT_NAME = "default"
+
+
+class Sandbox:
+    def __init__(
+        self,
+        name: str,
+        device: int = 0,
+        screen: str = None,
+        profile: str = None,
+        source: str = None,
+        cpus: List[int] = None,
+    ):
+        """One sandbox of the host
+
+        Args
+        ----
+        name: str
+            name shown on the operator page
+        device: int (OPTIONAL)
+            index of its Kinect
+        screen: str (OPTIONAL)
+            name of its projector monitor, None to look for an HDMI one
+        profile: str (OPTIONAL)
+            name of its calibration profile, defaults to the sandbox name
+        source: str (OPTIONAL)
+            depth source other than the Kinect, see frame_source.open_source
+        cpus: list[int] (OPTIONAL)
+            CPUs its game is pinned to, None to get a share of the host's
+        """
+        self.name = name
+        self.device = device
+        self.screen = screen
+        self.profile = profile if profile is not None else name
+        self.source = source
+        self.cpus = cpus
+
+    def game_options(self) -> dict:
+        """Keyword arguments of Game for this sandbox"""
+        return {"device": self.device, "screen": self.screen, "source": self.source}
+
+
+def load_sandboxes(path: str = None, default_profile: str = None) -> List[Sandbox]:
+    """
+    Load the sandboxes of the host
+
+    Args
+    ----
+    path: str (OPTIONAL)
+        JSON description of the sandboxes
+    default_profile: str (OPTIONAL)
+        calibration profile of the single sandbox used without a description
+
+    Returns
+    -------
+    list[Sandbox]
+        the sandboxes, with their CPUs assigned
+    """
+    path = path or _SANDBOXES_FILE
+    if not os.path.exists(path):
+        return [Sandbox(_DEFAULT_NAME, profile=default_profile)]
+    with open(path, "r") as f:
+        sandboxes = [Sandbox(**description) for description in json.load(f)]
+    names = [sandbox.name for sandbox in sandboxes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Sandbox names must be unique in {path}")
+    assign_cpus(sandboxes)
+    return sandboxes
+
+
+def assign_cpus(sandboxes: List[Sandbox]) -> None:
+    """Share the CPUs not given to any sandbox between the others, in place"""
+    pending = [sandbox for sandbox in sandboxes if sandbox.cpus is None]
+    if len(sandboxes) < 2 or not pending:
+        # A single game may use every core
+        return
+    taken = {cpu for sandbox in sandboxes if sandbox.cpus for cpu in sandbox.cpus}
+    free = [cpu for cpu in sorted(os.sched_getaffinity(0)) if cpu not in taken]
+    if not free:
+        return
+    share = max(1, len(free) // len(pending))
+    for i, sandbox in enumerate(pending):
+        # With fewer CPUs than sandboxes, some sandboxes share one
+        start = (i * share) % len(free)
+        sandbox.cpus = free[start : start + share]
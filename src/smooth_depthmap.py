@@ -1,28 +1,72 @@
 import cv2
+import numpy as np
 
 
 class TemporalSmoothing:
-    def __init__(self, alpha=0.1):
+    def __init__(self, shape, alpha=0.5):
+        """Initialize the depth filter
+
+        The filter keeps its state across frames: it is meant to be created
+        once per game and fed every depth frame. All the buffers are
+        allocated here, `apply` only updates them in place.
+
+        Args
+        ----
+        shape: tuple[int, int]
+            shape of the depth frames
+        alpha: float
+            weight of the current frame in the exponential moving average
+        """
         self.alpha = alpha
-        self.prev_frame = None
+        self.state = np.zeros(shape, dtype=np.float32)
+        self._valid = np.zeros(shape, dtype=np.uint8)
+        self._seen = np.zeros(shape, dtype=np.uint8)
+        self._new = np.zeros(shape, dtype=np.uint8)
 
-    def apply(self, current_frame):
-        if self.prev_frame is None:
-            self.prev_frame = current_frame
-            return current_frame
+    def reset(self):
+        """Forget the previous frames"""
+        self.state.fill(0)
+        self._seen.fill(0)
 
-        smoothed_frame = (1 - self.alpha) * self.prev_frame + self.alpha * current_frame
-        self.prev_frame = smoothed_frame
-        return smoothed_frame
+    def resize(self, shape):
+        """
+        Carry the filter state over to frames of another shape
 
+        Args
+        ----
+        shape: tuple[int, int]
+            shape of the next depth frames
+        """
+        size = (shape[1], shape[0])
+        # Nearest: interpolating would blend unseen pixels (0) into the depth
+        self.state = cv2.resize(self.state, size, interpolation=cv2.INTER_NEAREST)
+        self._seen = cv2.resize(self._seen, size, interpolation=cv2.INTER_NEAREST)
+        self._valid = np.zeros(shape, dtype=np.uint8)
+        self._new = np.zeros(shape, dtype=np.uint8)
+
+    def apply(self, current_frame):
+        """
+        Blend a depth frame into the filter state
 
-def remove_flickering(depth_map, kernel_size=5, alpha=0.1):
-    # Apply Gaussian filter
-    smoothed_map = cv2.GaussianBlur(depth_map, (kernel_size, kernel_size), 0)
+        Pixels where the Kinect has no measure (value 0) are holes: they keep
+        the last valid depth instead of being blended in. Pixels seen for the
+        first time take the measured depth directly.
 
-    # Apply temporal smoothing if needed
-    # (Assuming you have a TemporalSmoothing class as shown above)
-    temporal_smoothing = TemporalSmoothing(alpha=alpha)
-    smoothed_map = temporal_smoothing.apply(smoothed_map)
+        Args
+        ----
+        current_frame: np.array
+            the depth frame (uint16 or float32), 0 where invalid
 
-    return smoothed_map
+        Returns
+        -------
+        np.array
+            the filtered float32 depth, owned by the filter (do not modify)
+        """
+        cv2.compare(current_frame, 0, cv2.CMP_GT, dst=self._valid)
+        cv2.bitwise_not(self._seen, dst=self._new)
+        cv2.bitwise_and(self._new, self._valid, dst=self._new)
+        # alpha=1 copies the first measure of a pixel into the state
+        cv2.accumulateWeighted(current_frame, self.state, 1.0, mask=self._new)
+        cv2.accumulateWeighted(current_frame, self.state, self.alpha, mask=self._valid)
+        cv2.bitwise_or(self._seen, self._valid, dst=self._seen)
+        return self.state
@@ -0,0 +1,24 @@
+import os
+import threading
+from typing import BinaryIO, Callable
+
+
+def atomic_save(path: str, write: Callable[[BinaryIO], None]) -> None:
+    """
+    Save a file so that its readers never see it partially written
+
+    The content is written to a temporary file next to `path`, which then
+    replaces it in one rename.
+
+    Args
+    ----
+    path: str
+        path of the file
+    write: Callable[[BinaryIO], None]
+        writes the content to the binary file it is given
+    """
+    # Unique per writer, several processes may save the same file at once
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from storage import atomic_save
+
+# Memory budget of the default cache
+_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# On-disk store of the default cache, shared by the games of the host; unset
+# keeps the textures in memory only
+_DISK_DIR = os.environ.get("FOSSILHUNT_TEXTURE_CACHE_DIR") or None
+# Arrays stored per entry, on disk as <key>.<name>.npy
+_ARRAYS = ("bgr", "mask")
+# Hashes remembered by file_hash, far more than the images of a scene
+_HASH_MEMO = 1024
+
+Entry = Tuple[np.array, Optional[np.array]]
+
+
+@lru_cache(maxsize=_HASH_MEMO)
+def _content_hash(path: str, mtime_ns: int, size: int) -> str:
+    # The modification time and size only key the memo: a change of either
+    # is a new file to hash
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """
+    Hash of the content of a file, recomputed only when the file changes
+
+    Args
+    ----
+    path: str
+        path of the file
+
+    Returns
+    -------
+    str
+        hex sha1 of the file content
+    """
+    stat = os.stat(path)
+    return _content_hash(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def texture_key(path: str, **params) -> str:
+    """
+    Content-addressed key of a preprocessed texture
+
+    Args
+    ----
+    path: str
+        path of the source image
+    params: Any
+        every parameter of the preprocessing (scale, size, rotation, ...)
+
+    Returns
+    -------
+    str
+        a key that changes whenever the image content or a parameter changes
+    """
+    description = json.dumps(params, sort_keys=True)
+    return hashlib.sha1((file_hash(path) + description).encode("utf-8")).hexdigest()
+
+
+class TextureCache:
+    def __init__(self, max_bytes: int = _DEFAULT_MAX_BYTES, disk_dir: str = None):
+        """Initialize the cache of preprocessed textures
+
+        Entries are (BGR texture, opaque mask or None) pairs of read-only
+        arrays, kept in memory in least-recently-used order within a byte
+        budget. With a disk directory, entries are also saved as .npy files
+        and loaded back memory-mapped, so they outlive the process.
+
+        Args
+        ----
+        max_bytes: int (OPTIONAL)
+            memory budget of the in-memory entries
+        disk_dir: str (OPTIONAL)
+            directory of the on-disk store, None for memory only
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _size(entry: Entry) -> int:
+        return sum(a.nbytes for a in entry if a is not None)
+
+    def _insert(self, key: str, entry: Entry) -> None:
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.bytes += self._size(entry)
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+
+    def _disk_path(self, key: str, name: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.{name}.npy")
+
+    def _load_disk(self, key: str) -> Optional[Entry]:
+        if self.disk_dir is None or not os.path.exists(self._disk_path(key, "bgr")):
+            return None
+        arrays = []
+        for name in _ARRAYS:
+            path = self._disk_path(key, name)
+            arrays.append(
+                np.load(path, mmap_mode="r") if os.path.exists(path) else None
+            )
+        return tuple(arrays)
+
+    def _save_disk(self, key: str, entry: Entry) -> None:
+        # The mask goes first: a reader takes the BGR file as the complete entry
+        for name, array in reversed(list(zip(_ARRAYS, entry))):
+            if array is not None:
+                atomic_save(self._disk_path(key, name), lambda f: np.save(f, array))
+
+    def get(self, key: str, create: Callable[[], Entry]) -> Entry:
+        """
+        Get an entry, creating (and storing) it on a miss
+
+        Args
+        ----
+        key: str
+            key of the entry, see texture_key
+        create: Callable[[], tuple[np.array, np.array]]
+            builds the (bgr, mask) entry on a miss
+
+        Returns
+        -------
+        tuple[np.array, np.array]
+            read-only BGR texture and opaque mask (None for opaque textures)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._load_disk(key)
+        if entry is None:
+            entry = tuple(
+                None if a is None else np.ascontiguousarray(a) for a in create()
+            )
+            for array in entry:
+                if array is not None:
+                    array.setflags(write=False)
+            if self.disk_dir is not None:
+                self._save_disk(key, entry)
+        self._insert(key, entry)
+        return entry
+
+
+# Shared by every game of the process, so a restart reuses the textures
+default_cache = TextureCache(disk_dir=_DISK_DIR)
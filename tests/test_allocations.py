@@ -0,0 +1,51 @@
+import tracemalloc
+
+import pytest
+from screeninfo import Monitor
+
+from benchmark import _run_frame, synthetic_fossils
+from frame_source import SyntheticSource
+from game import Game
+
+# Same bound as alloc_peak_bytes in src/benchmark_budgets.json
+_ALLOC_BOUND = 64 * 1024
+_FRAMES = 300
+_WARMUP = 20
+
+
+def _game(kernel, incremental):
+    game = Game(
+        [],
+        source=SyntheticSource(fps=0),
+        projector=Monitor(x=0, y=0, width=1920, height=1080),
+        display=False,
+        incremental=incremental,
+        kernel=kernel,
+    )
+    game._init_scene(synthetic_fossils(50, seed=0), seed=0)
+    return game
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+@pytest.mark.parametrize("kernel", ["numpy", "compiled"])
+def test_frames_allocate_little(kernel, incremental):
+    if kernel == "compiled":
+        pytest.importorskip("reveal_kernel")
+    game = _game(kernel, incremental)
+    source = SyntheticSource(fps=0, seed=0)
+    # Scratch buffers and lookup tables are made by the first frames
+    for _ in range(_WARMUP):
+        _run_frame(game, source.next_frame(), None, False)
+    frames = [source.next_frame().copy() for _ in range(_FRAMES)]
+
+    tracemalloc.start()
+    peak = 0
+    try:
+        for frame in frames:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            _run_frame(game, frame, None, False)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    assert peak <= _ALLOC_BOUND
@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+import pytest
+
+from auto_calibration import _INVALID_DEPTH, detect_corners, fit_plane
+
+_SHAPE = (480, 640)
+# Clockwise from the top-left one, as detect_corners returns them
+_CORNERS = np.array([[62, 40], [590, 54], [576, 442], [46, 426]], dtype=np.float32)
+_PLANE = (0.05, -0.03, 900.0)
+
+
+def _plane(plane=_PLANE):
+    a, b, c = plane
+    ys, xs = np.indices(_SHAPE, dtype=np.float32)
+    return a * xs + b * ys + c
+
+
+def _frames(count=5, seed=0):
+    """Depth frames of a tilted sandbox filling most of the view, with noise
+    and missing measures"""
+    rng = np.random.default_rng(seed)
+    inside = np.zeros(_SHAPE, dtype=np.uint8)
+    cv2.fillPoly(inside, [np.rint(_CORNERS).astype(np.int32)], 1)
+    frames = []
+    for _ in range(count):
+        # The rim and the room around the box are much closer than the sand
+        depth = np.where(inside.view(bool), _plane(), 700.0)
+        depth += rng.normal(0, 1.0, _SHAPE)
+        frame = np.rint(depth).astype(np.uint16)
+        frame[rng.random(_SHAPE) < 0.02] = _INVALID_DEPTH
+        frames.append(frame)
+    return frames
+
+
+def test_detect_corners_of_a_tilted_plane():
+    corners = detect_corners(_frames())
+    assert corners.shape == (4, 2)
+    np.testing.assert_allclose(corners, _CORNERS, atol=2.0)
+
+
+def test_fit_plane_ignores_outliers():
+    rng = np.random.default_rng(1)
+    depth = _plane() + rng.normal(0, 0.5, _SHAPE)
+    # A third of the pixels are hands, buckets and sensor spikes
+    outliers = rng.random(_SHAPE) < 0.3
+    depth[outliers] = rng.uniform(400, 1400, np.count_nonzero(outliers))
+    valid = rng.random(_SHAPE) > 0.05
+    a, b, c = fit_plane(depth.astype(np.float32), valid)
+    assert a == pytest.approx(_PLANE[0], abs=1e-3)
+    assert b == pytest.approx(_PLANE[1], abs=1e-3)
+    assert c == pytest.approx(_PLANE[2], abs=0.5)
+
+
+def test_fit_plane_needs_measures():
+    depth = _plane()
+    with pytest.raises(ValueError):
+        fit_plane(depth, np.zeros(_SHAPE, dtype=bool))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from frame_source import FrameSource, ReplaySource, open_source
+
+
+def _save(tmp_path, count):
+    path = str(tmp_path / "recording.npy")
+    np.save(path, np.full((count, 480, 640), 600, dtype=np.uint16))
+    return path
+
+
+def test_replay_options(tmp_path):
+    path = _save(tmp_path, 3)
+    source = open_source(f"replay:{path}")
+    assert isinstance(source, ReplaySource)
+    assert source.realtime and source.loop
+
+    source = open_source(f"replay:{path}?realtime=0&loop=0")
+    assert not source.realtime and not source.loop
+    frames = []
+    source.set_callback(lambda frame, timestamp: frames.append(timestamp))
+    source.start()
+    source.run()
+    assert len(frames) == 3 and not source.running
+
+    for query in ("fast=1", "realtime=yes", "realtime"):
+        with pytest.raises(ValueError):
+            open_source(f"replay:{path}?{query}")
+
+
+def test_empty_recording(tmp_path):
+    with pytest.raises(ValueError):
+        open_source(f"replay:{_save(tmp_path, 0)}")
+
+
+def test_sources_implement_run():
+    with pytest.raises(TypeError):
+        FrameSource()
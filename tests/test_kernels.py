@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from frame_source import SyntheticSource
+from kernels import select
+
+_SHAPE = (480, 640)
+_LAYERS = 3
+_FOSSILS = 20
+_FRAMES = 150
+
+
+def _scene(seed=0):
+    rng = np.random.default_rng(seed)
+    # Stacked like create_layers: a pixel fills its layers from the first
+    stacked = rng.integers(0, _LAYERS + 1, _SHAPE)
+    ids = np.where(
+        np.arange(_LAYERS)[:, None, None] < stacked,
+        rng.integers(0, _FOSSILS, (_LAYERS, *_SHAPE)),
+        -1,
+    )
+    # Layers sorted by depth, never reached where empty
+    thresholds = np.sort(rng.integers(560, 640, (_LAYERS, *_SHAPE)), axis=0)
+    thresholds[ids < 0] = 65535
+    images = rng.integers(0, 256, (_LAYERS + 1, *_SHAPE, 3), dtype=np.uint8)
+    return ids, thresholds.astype(np.uint16), images
+
+
+def _outputs():
+    return (
+        np.zeros(_SHAPE, dtype=np.uint8),
+        np.zeros((*_SHAPE, 3), dtype=np.uint8),
+        np.zeros(_FOSSILS, dtype=np.int64),
+    )
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_compiled_matches_numpy(dtype):
+    pytest.importorskip("reveal_kernel")
+    ids, thresholds, images = _scene()
+    thresholds = thresholds.astype(dtype)
+    kernels = {name: select(name) for name in ("numpy", "compiled")}
+    frames = {name: _outputs() for name in kernels}
+    previous = {name: np.zeros(_SHAPE, dtype=np.uint8) for name in kernels}
+    changes = {name: np.zeros(np.prod(_SHAPE), dtype=np.int64) for name in kernels}
+    source = SyntheticSource(fps=0, seed=0)
+    for _ in range(_FRAMES):
+        depth = source.next_frame().astype(dtype)
+        counts = {}
+        for name, (_, reveal_frame, reveal_changes) in kernels.items():
+            levels, image, frame_counts = frames[name]
+            reveal_frame(depth, thresholds, images, ids, levels, image, frame_counts)
+            levels = np.zeros(_SHAPE, dtype=np.uint8)
+            count = reveal_changes(
+                depth, thresholds, previous[name], levels, changes[name]
+            )
+            counts[name] = count
+            previous[name] = levels
+        np.testing.assert_array_equal(frames["numpy"][0], frames["compiled"][0])
+        np.testing.assert_array_equal(frames["numpy"][1], frames["compiled"][1])
+        np.testing.assert_array_equal(frames["numpy"][2], frames["compiled"][2])
+        np.testing.assert_array_equal(previous["numpy"], previous["compiled"])
+        assert counts["numpy"] == counts["compiled"]
+        np.testing.assert_array_equal(
+            changes["numpy"][: counts["numpy"]],
+            changes["compiled"][: counts["compiled"]],
+        )
+
+
+def test_counts_match_reference():
+    ids, thresholds, images = _scene(seed=1)
+    _, reveal_frame, _ = select("numpy")
+    levels, image, counts = _outputs()
+    depth = SyntheticSource(fps=0, seed=1).next_frame()
+    reveal_frame(depth, thresholds, images, ids, levels, image, counts)
+    revealed = depth >= thresholds
+    np.testing.assert_array_equal(levels, revealed.sum(axis=0))
+    expected = np.bincount(ids[revealed & (ids >= 0)], minlength=_FOSSILS)
+    np.testing.assert_array_equal(counts, expected)
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+from recorder import SessionRecorder
+
+
+def _session(root, name, events_bytes):
+    # An older session of the root that only holds events
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "events.jsonl"), "w") as f:
+        f.write("x" * (events_bytes - 1) + "\n")
+    return path
+
+
+def _record(root, quota, events):
+    recorder = SessionRecorder(root, frame_shape=(48, 64), quota_bytes=quota)
+    recorder.start()
+    recorder.record_frame(np.full((48, 64), 600, dtype=np.uint16), 0.0)
+    for i in range(events):
+        recorder.record_event("reveal", seen_bones=i)
+    recorder.stop()
+    return recorder
+
+
+def test_events_count_toward_the_quota(tmp_path):
+    root = str(tmp_path)
+    old = _session(root, "00000000-000000", 4000)
+    recorder = _record(root, 3000, events=3)
+    # The old events made room for the new session
+    assert not os.path.exists(old)
+    assert recorder.stats()["dropped_events"] == 0
+    size = sum(
+        os.path.getsize(os.path.join(recorder.path, name))
+        for name in os.listdir(recorder.path)
+        if name != "session.json"
+    )
+    assert size == recorder.stats()["record_bytes"] <= 3000
+
+
+def test_events_over_the_quota_are_dropped(tmp_path):
+    recorder = _record(str(tmp_path), 500, events=20)
+    stats = recorder.stats()
+    assert stats["recorded"] == 1
+    assert 0 < stats["dropped_events"] < 20
+    assert stats["record_bytes"] <= 500
@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+
+from init_ressources import load_objects_texture
+from texture_cache import TextureCache
+
+
+def _image(tmp_path):
+    path = str(tmp_path / "fossil.png")
+    image = np.zeros((60, 80, 4), dtype=np.uint8)
+    image[10:50, 20:60] = (40, 80, 120, 255)
+    cv2.imwrite(path, image)
+    return [{"name": "fossil", "path": path, "scale_factor": 0.5}]
+
+
+def test_rotations_share_an_entry(tmp_path):
+    config = _image(tmp_path)
+    cache = TextureCache()
+    shapes = set()
+    for _ in range(5):
+        (fossil,) = load_objects_texture(config, cache=cache)
+        assert fossil.mask.shape == fossil.texture.shape[:2]
+        shapes.add(fossil.texture.shape)
+    # Drawn at random angles, decoded once
+    assert len(cache._entries) == 1
+    assert len(shapes) > 1
+
+
+def test_disk_store(tmp_path):
+    config = _image(tmp_path)
+    config[0]["rotation"] = 0
+    (first,) = load_objects_texture(config, cache=TextureCache(disk_dir=tmp_path))
+    cache = TextureCache(disk_dir=tmp_path)
+    (second,) = load_objects_texture(config, cache=cache)
+    bgr, mask = next(iter(cache._entries.values()))
+    assert isinstance(bgr, np.memmap) and isinstance(mask, np.memmap)
+    np.testing.assert_array_equal(first.texture, second.texture)
+    np.testing.assert_array_equal(first.mask, second.mask)
+
+
+def test_seeded_load(tmp_path):
+    config = _image(tmp_path) * 4
+    loads = [
+        load_objects_texture(config, rng=np.random.default_rng(7)) for _ in range(2)
+    ]
+    for first, second in zip(*loads):
+        assert first.depth == second.depth
+        np.testing.assert_array_equal(first.texture, second.texture)